@@ -0,0 +1,137 @@
+"""
+Generates a synthetic save folder, like the ones the monitor writes to ../../save/<server>/, covering any number of
+days of matches and player history.
+
+Map popularity follows a Zipf-like distribution, every map has its own typical playtime, the player count follows a
+daily cycle, and each player sample holds up to 12 random online players like OCC's server list ping does. Player
+samples are taken every sample_interval seconds (60 by default, instead of the monitor's 10, to keep generating years
+of data fast).
+
+Run from the repository root: PYTHONPATH=. python benchmarks/generate_save.py <folder> --days 365
+"""
+
+import argparse
+import datetime
+import math
+import pathlib
+import random
+from src.monitor.storage import (
+    FlatFileStorage,
+    MapHistoryEntry,
+    PlayerSample,
+    SqliteStorage,
+)
+
+START_DATE = datetime.datetime(2022, 1, 1)
+
+
+def generate_save(
+    directory,
+    days,
+    backend="flat",
+    maps=60,
+    players=3000,
+    sample_interval=60,
+    seed=0,
+):
+    """
+    :param directory: pathlib.Path of the save folder to create, must not exist yet
+    :param days: How many days of data to generate
+    :param backend: "flat" or "sqlite" (default is flat)
+    :param maps: How many different maps are played (default is 60)
+    :param players: How many different players join (default is 3000)
+    :param sample_interval: Seconds between player samples (default is 60)
+    :param seed: Seed of the random data, the same seed gives the same folder (default is 0)
+    :return: Dict with the number of matches and samples generated
+    """
+    rng = random.Random(seed)
+    directory = pathlib.Path(directory)
+    storage = FlatFileStorage(directory, flush_bytes=1 << 20)
+    storage.create()
+    storage.init_first_write(START_DATE)
+
+    map_names = [f"Map {index}" for index in range(maps)]
+    map_weights = [1 / (rank + 1) for rank in range(maps)]
+    map_playtimes = {name: rng.uniform(300, 1800) for name in map_names}
+    player_names = [f"Player_{index}" for index in range(players)]
+
+    end = START_DATE + datetime.timedelta(days=days)
+    time = START_DATE
+    next_sample = time
+    online = set()
+    playcounts = {}
+    matches = samples = 0
+    while time < end:
+        name = rng.choices(map_names, map_weights)[0]
+        if rng.random() < 0.01:
+            name = "SYS_QUERYERROR"
+        playtime = max(30, int(rng.gauss(map_playtimes.get(name, 60), 120)))
+
+        # Players during the match, following a daily cycle between 20 and 120
+        match_end = time + datetime.timedelta(seconds=playtime)
+        start_players = len(online)
+        while next_sample < match_end:
+            hour = next_sample.hour + next_sample.minute / 60
+            target = int(70 + 50 * math.sin((hour - 9) / 24 * 2 * math.pi))
+            target = max(0, target + rng.randint(-5, 5))
+            for _ in range(rng.randint(0, 3)):
+                if online:
+                    online.discard(rng.choice(sorted(online)))
+            while len(online) < target:
+                online.add(rng.choice(player_names))
+            while len(online) > target:
+                online.discard(rng.choice(sorted(online)))
+            sample = rng.sample(sorted(online), min(12, len(online)))
+            storage.append_player_sample(PlayerSample(next_sample, len(online), sample))
+            samples += 1
+            next_sample += datetime.timedelta(seconds=sample_interval)
+
+        storage.append_match(
+            MapHistoryEntry(
+                name, time, playtime, start_players, len(online) - start_players
+            )
+        )
+        playcounts[name] = playcounts.get(name, 0) + 1
+        matches += 1
+        time = match_end
+
+    storage.write_active_map(name)
+    storage.write_game_time(0)
+    storage.write_online_players(sorted(online)[:12])
+    storage.flush()
+    # map_data in its original format, without the change log
+    with open(directory / "map_data", "w") as file:
+        for name, playcount in playcounts.items():
+            file.write(f"{name} | {playcount}\n")
+
+    if backend == "sqlite":
+        database = SqliteStorage(directory)
+        database.import_from(FlatFileStorage(directory))
+        database.close()
+    return {"matches": matches, "samples": samples}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", help="Save folder to create")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--backend", choices=("flat", "sqlite"), default="flat")
+    parser.add_argument("--maps", type=int, default=60)
+    parser.add_argument("--players", type=int, default=3000)
+    parser.add_argument("--sample-interval", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = generate_save(
+        pathlib.Path(args.directory),
+        args.days,
+        args.backend,
+        args.maps,
+        args.players,
+        args.sample_interval,
+        args.seed,
+    )
+    print(
+        f"Generated {counts['matches']} matches and {counts['samples']} player samples "
+        f"over {args.days} days in {args.directory}"
+    )
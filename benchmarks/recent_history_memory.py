@@ -0,0 +1,136 @@
+"""
+Compares the memory used by keeping the last samples and matches of a server as objects, with and without __slots__,
+and in a RecentHistory (monitor.py).
+Run from the repository root: PYTHONPATH=. python benchmarks/recent_history_memory.py
+"""
+
+import argparse
+import datetime
+import tracemalloc
+from src.monitor.monitor import Match, RecentHistory, TimedData
+
+
+class DictTimedData:
+    """
+    TimedData as it was before it had __slots__.
+    """
+
+    def __init__(self, online_players, is_complete, playercount, game_time):
+        self.playercount = playercount
+        self.online_players = online_players
+        self._is_complete = is_complete
+        self.game_time = game_time
+
+
+class DictMatch:
+    """
+    Match as it was before it had __slots__.
+    """
+
+    def __init__(
+        self,
+        start_date,
+        playtime,
+        name,
+        start_players,
+        end_players,
+        is_event,
+        detection_latency=None,
+    ):
+        self.start_date = start_date
+        self.playtime = playtime
+        self.name = name
+        self.start_players = start_players
+        self.end_players = end_players
+        self.is_event = is_event
+        self.detection_latency = detection_latency
+
+
+def make_objects(timed_class, match_class, samples, matches, start):
+    # Samples are kept with the time they were taken at, like a consumer of get_timed() would have to
+    timeds = [
+        (
+            start + datetime.timedelta(seconds=10 * i),
+            timed_class([], False, i % 80, i % 900),
+        )
+        for i in range(samples)
+    ]
+    played = [
+        match_class(
+            start + datetime.timedelta(seconds=900 * i),
+            900,
+            f"Map {i % 40}",
+            i % 80,
+            (i + 5) % 80,
+            False,
+            2.5,
+        )
+        for i in range(matches)
+    ]
+    return timeds, played
+
+
+def make_recent_history(samples, matches, start):
+    recent = RecentHistory(samples, matches)
+    for i in range(samples):
+        recent.add_sample(start + datetime.timedelta(seconds=10 * i), i % 80, i % 900)
+    for i in range(matches):
+        recent.add_match(
+            Match(
+                start + datetime.timedelta(seconds=900 * i),
+                900,
+                f"Map {i % 40}",
+                i % 80,
+                (i + 5) % 80,
+                False,
+                2.5,
+            )
+        )
+    return recent
+
+
+def measure(function, *args):
+    """
+    :return: Bytes still allocated by what function returned
+    """
+    tracemalloc.start()
+    result = function(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=4096)
+    parser.add_argument("--matches", type=int, default=256)
+    args = parser.parse_args()
+
+    start = datetime.datetime(2022, 1, 1)
+    results = [
+        (
+            "Objects (dict)",
+            measure(
+                make_objects,
+                DictTimedData,
+                DictMatch,
+                args.samples,
+                args.matches,
+                start,
+            ),
+        ),
+        (
+            "Objects (__slots__)",
+            measure(make_objects, TimedData, Match, args.samples, args.matches, start),
+        ),
+        (
+            "RecentHistory",
+            measure(make_recent_history, args.samples, args.matches, start),
+        ),
+    ]
+
+    print(f"{args.samples} samples, {args.matches} matches")
+    baseline = results[0][1]
+    for name, size in results:
+        print(f"{name:<20} {size / 1024:>10.1f} KiB {size / baseline:>7.1%}")
@@ -0,0 +1,247 @@
+"""
+Times and memory profiles the data layer (DataAnalyzer, DataWriter, the API's data_load and the session index) on
+synthetic save folders of several sizes (see generate_save.py), and compares the results with stored baselines.
+
+Run from the repository root: PYTHONPATH=. python benchmarks/run_benchmarks.py
+    --save-baselines    Store the results as the new baselines (benchmarks/baselines.json)
+    --days 30 365       Dataset sizes to run, in days of data
+    --backend sqlite    Storage backend of the generated folders
+
+Generated folders are cached in --data-directory, and copied before each run, so every run starts from the same data.
+Baselines depend on the machine, only compare results from the same one.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import pathlib
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from benchmarks.generate_save import START_DATE, generate_save
+from src.api import data_load
+from src.monitor.columnar import ColumnarHistory
+from src.monitor.monitor import DataAnalyzer, DataWriter, Match, TimedData
+from src.monitor.sessions import rebuild_sessions
+from src.monitor.storage import MapHistoryEntry, open_storage
+
+BASELINES_FILE = pathlib.Path(__file__).parent / "baselines.json"
+
+
+class Benchmark:
+    """
+    One function to measure. setup() runs before each repetition and isn't measured, its result is passed to run().
+    """
+
+    def __init__(self, name, run, setup=None):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda: None)
+
+
+def get_benchmarks(save_directory, server, days):
+    directory = save_directory / server
+    middle = START_DATE + datetime.timedelta(days=days // 2)
+
+    def analyzer_from_scratch():
+        ColumnarHistory(open_storage(directory)).clear()
+        return DataAnalyzer(server, save_directory=save_directory)
+
+    def analyzer_after_one_match():
+        analyzer = DataAnalyzer(server, save_directory=save_directory)
+        analyzer.analyze_maps()
+        entry = MapHistoryEntry("Map 0", datetime.datetime.now(), 600, 50, 2)
+        open_storage(directory).append_match(entry)
+        return analyzer
+
+    writer = None
+
+    def get_writer():
+        nonlocal writer
+        if writer is None:
+            writer = DataWriter(server, save_directory=save_directory)
+        return writer
+
+    def write_query(writer_):
+        match = Match(datetime.datetime.now(), 600, "Map 0", 50, 52, False)
+        writer_.write_data(match, "Map 1")
+        writer_.write_timeds(TimedData([], False, 52, 0))
+
+    def clear_cache():
+        data_load._cache.clear()  # noqa
+
+    return [
+        Benchmark(
+            "analyze_maps (from scratch)",
+            lambda analyzer: analyzer.analyze_maps(),
+            analyzer_from_scratch,
+        ),
+        Benchmark(
+            "analyze_maps (one new match)",
+            lambda analyzer: analyzer.analyze_maps(),
+            analyzer_after_one_match,
+        ),
+        Benchmark("DataWriter write_data + write_timeds", write_query, get_writer),
+        # Without the cache of data_load, so the files are parsed like after they changed
+        Benchmark(
+            "load_map_data",
+            lambda _: data_load.load_map_data(directory, "Map 0"),
+            clear_cache,
+        ),
+        Benchmark(
+            "load_map_data (cached)",
+            lambda _: data_load.load_map_data(directory, "Map 0"),
+            lambda: data_load.load_map_data(directory, "Map 0"),
+        ),
+        Benchmark(
+            "load_server_data",
+            lambda _: data_load.load_server_data(directory),
+            clear_cache,
+        ),
+        Benchmark(
+            "load_server_data (cached)",
+            lambda _: data_load.load_server_data(directory),
+            lambda: data_load.load_server_data(directory),
+        ),
+        Benchmark(
+            "load_map_history (one map, all time)",
+            lambda _: data_load.load_map_history(directory, "Map 0"),
+        ),
+        Benchmark(
+            "iter_player_samples (one day)",
+            lambda _: sum(
+                1
+                for _ in data_load.get_storage(directory).iter_player_samples(
+                    middle, middle + datetime.timedelta(days=1)
+                )
+            ),
+        ),
+        Benchmark(
+            "rebuild_sessions",
+            lambda _: rebuild_sessions(data_load.get_storage(directory)),
+        ),
+    ]
+
+
+def measure(benchmark, repeat):
+    """
+    :return: (median seconds, peak bytes allocated during one run)
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):  # The analyzer prints its progress
+        for _ in range(repeat):
+            argument = benchmark.setup()
+            start = time.perf_counter()
+            benchmark.run(argument)
+            times.append(time.perf_counter() - start)
+
+        argument = benchmark.setup()
+        tracemalloc.start()
+        benchmark.run(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def prepare_data(data_directory, backend, days, seed):
+    """
+    :return: pathlib.Path of a fresh copy of the generated save directory
+    """
+    cached = data_directory / f"{backend}-{days}d-seed{seed}"
+    if not cached.is_dir():
+        print(f"Generating {days} days of data ({backend})...")
+        generate_save(cached / "server", days, backend, seed=seed)
+    work = data_directory / "work"
+    if work.exists():
+        shutil.rmtree(work)
+    shutil.copytree(cached, work)
+    data_load._storages.clear()  # noqa - the copy replaces the folder the API had open
+    return work
+
+
+def run(args):
+    results = {}
+    for days in args.days:
+        save_directory = prepare_data(
+            args.data_directory, args.backend, days, args.seed
+        )
+        for benchmark in get_benchmarks(save_directory, "server", days):
+            key = f"{args.backend}/{days}d/{benchmark.name}"
+            seconds, peak = measure(benchmark, args.repeat)
+            results[key] = {"seconds": seconds, "peak_bytes": peak}
+    return results
+
+
+def report(results, baselines, threshold):
+    """
+    Print the results next to their baselines.
+    :return: Number of regressions (slower or using more memory than threshold times the baseline)
+    """
+    regressions = 0
+    print(
+        f"{'Benchmark':<62} {'Time':>10} {'Baseline':>10} {'Peak':>10} {'Baseline':>10}"
+    )
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        line = f"{key:<62} {result['seconds'] * 1000:>8.2f}ms"
+        if baseline is None:
+            print(f"{line} {'-':>10} {result['peak_bytes'] / 1024:>8.0f}KB {'-':>10}")
+            continue
+        line += f" {baseline['seconds'] * 1000:>8.2f}ms"
+        line += f" {result['peak_bytes'] / 1024:>8.0f}KB {baseline['peak_bytes'] / 1024:>8.0f}KB"
+        slower = result["seconds"] > baseline["seconds"] * threshold
+        bigger = result["peak_bytes"] > baseline["peak_bytes"] * threshold
+        if slower or bigger:
+            regressions += 1
+            line += "  REGRESSION"
+            if slower:
+                line += f" time x{result['seconds'] / baseline['seconds']:.2f}"
+            if bigger:
+                line += f" memory x{result['peak_bytes'] / baseline['peak_bytes']:.2f}"
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--days", type=int, nargs="+", default=[30, 180, 365])
+    parser.add_argument("--backend", choices=("flat", "sqlite"), default="flat")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--data-directory",
+        type=pathlib.Path,
+        default=pathlib.Path(tempfile.gettempdir()) / "overcast_benchmarks",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.25,
+        help="Report results this many times worse than the baseline (default is 1.25)",
+    )
+    parser.add_argument("--save-baselines", action="store_true")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    baselines = {}
+    if BASELINES_FILE.is_file():
+        with open(BASELINES_FILE, "r") as file:
+            baselines = json.load(file)
+    regressions = report(results, baselines, args.threshold)
+
+    if args.save_baselines:
+        baselines.update(results)
+        with open(BASELINES_FILE, "w") as file:
+            json.dump(baselines, file, indent=4, sort_keys=True)
+        print(f"Saved {len(results)} baselines to {BASELINES_FILE}")
+    elif regressions:
+        print(f"{regressions} regressions.")
+        sys.exit(1)
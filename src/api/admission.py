@@ -0,0 +1,245 @@
+"""
+Admission control of the API: a token bucket per client and endpoint class, and a limit on the requests of each class
+being served at once, so a client hammering expensive endpoints can't starve the cheap ones. Requests over a limit are
+rejected right away, with 429 (the client is over its rate) or 503 (the class is saturated).
+
+The limiter state is kept in a memory-mapped file shared by every API worker, so the limits hold across gunicorn
+workers. Updates are serialized with fcntl record locks on the part of the file they change, and a thread lock within a
+worker.
+
+Layout (little endian):
+    0   Header: magic b"OAAC", number of classes, worker slots, bucket slots
+    16  Class totals: requests being served of each class, int32 each
+    ... Worker slots: pid, then the requests it is serving of each class, int32 each. A worker that died is found by its
+        pid when a new one claims a slot, and its requests are taken off the totals.
+    ... Bucket slots: key hash, tokens, time of the last update. A bucket is found by the hash of its client and class,
+        and a client whose hash collides with another's just gets a full bucket.
+"""
+
+import collections
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Requests per second and burst each client gets, and the most requests served at once by all workers together
+AdmissionLimit = collections.namedtuple(
+    "AdmissionLimit", ["rate", "burst", "concurrency"]
+)
+
+_MAGIC = b"OAAC"
+_HEADER = struct.Struct("<4sIII")
+_COUNT = struct.Struct("<i")
+_BUCKET = struct.Struct("<Qdd")
+
+
+class AdmissionController:
+    """
+    Admits or rejects requests, with the limits of every endpoint class. Thread and process safe.
+    """
+
+    def __init__(self, path, limits, worker_slots=64, bucket_slots=65536):
+        """
+        :param path: pathlib.Path of the shared state file, created with its folder if it doesn't exist
+        :param limits: Dict of endpoint class -> AdmissionLimit. Every worker must use the same classes.
+        :param worker_slots: Most API workers (default is 64)
+        :param bucket_slots: Number of token buckets, clients over it share buckets (default is 65536)
+        """
+        self._limits = limits
+        self._columns = {name: index for index, name in enumerate(limits)}
+        self._worker_slots = worker_slots
+        self._bucket_slots = bucket_slots
+
+        self._totals_offset = _HEADER.size
+        self._worker_size = _COUNT.size * (1 + len(limits))
+        self._workers_offset = self._totals_offset + _COUNT.size * len(limits)
+        self._buckets_offset = self._workers_offset + self._worker_size * worker_slots
+        size = self._buckets_offset + _BUCKET.size * bucket_slots
+
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        header = _HEADER.pack(_MAGIC, len(limits), worker_slots, bucket_slots)
+        with self._file_lock(0, 0):  # The whole file
+            if os.pread(self._fd, _HEADER.size, 0) != header:
+                # New, or made with other settings. Requests being served with the old ones are forgotten.
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, header, 0)
+        self._map = mmap.mmap(self._fd, size)
+        self._pid = None  # Process the worker slot was claimed for. Workers forked from a parent claim their own.
+        self._worker_slot = None
+
+    def _file_lock(self, offset, length):
+        """
+        :return: Context manager holding an exclusive lock on that part of the file (all of it if length is 0)
+        """
+        return _RecordLock(self._fd, offset, length)
+
+    def _claim_worker_slot(self):
+        """
+        Claim a free worker slot for this process, freeing the slots of workers that died.
+        """
+        self._pid = os.getpid()
+        self._worker_slot = None
+        # The totals and every worker slot
+        with self._file_lock(
+            self._totals_offset, self._buckets_offset - self._totals_offset
+        ):
+            for slot in range(self._worker_slots):
+                offset = self._workers_offset + slot * self._worker_size
+                pid = _COUNT.unpack_from(self._map, offset)[0]
+                if pid != 0 and pid != self._pid and _is_alive(pid):
+                    continue
+                # Take the requests a dead worker was serving off the totals
+                for column in range(len(self._limits)):
+                    count_offset = offset + _COUNT.size * (1 + column)
+                    total_offset = self._totals_offset + _COUNT.size * column
+                    count = _COUNT.unpack_from(self._map, count_offset)[0]
+                    total = _COUNT.unpack_from(self._map, total_offset)[0]
+                    _COUNT.pack_into(self._map, total_offset, max(0, total - count))
+                    _COUNT.pack_into(self._map, count_offset, 0)
+                _COUNT.pack_into(self._map, offset, 0)
+                if self._worker_slot is None:
+                    _COUNT.pack_into(self._map, offset, self._pid)
+                    self._worker_slot = slot
+        if self._worker_slot is None:
+            print(
+                "[ERROR] No free admission worker slot, requests of this worker aren't counted"
+            )
+
+    def _find_bucket(self, client, endpoint_class):
+        """
+        :return: (key hash, offset) of the client's bucket
+        """
+        key = int.from_bytes(
+            hashlib.blake2b(
+                f"{endpoint_class}|{client}".encode("utf-8"), digest_size=8
+            ).digest(),
+            "little",
+        )
+        return key, self._buckets_offset + (key % self._bucket_slots) * _BUCKET.size
+
+    def _take_token(self, client, endpoint_class, now):
+        """
+        :return: Seconds until the client gets a token, 0 if it got one
+        """
+        limit = self._limits[endpoint_class]
+        key, offset = self._find_bucket(client, endpoint_class)
+        with self._file_lock(offset, _BUCKET.size):
+            saved_key, tokens, updated = _BUCKET.unpack_from(self._map, offset)
+            if saved_key != key:
+                tokens, updated = limit.burst, now
+            tokens = min(limit.burst, tokens + max(0.0, now - updated) * limit.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / limit.rate
+            _BUCKET.pack_into(self._map, offset, key, tokens, now)
+        return wait
+
+    def _refund_token(self, client, endpoint_class):
+        """
+        Give back the token taken for a request that wasn't served.
+        """
+        key, offset = self._find_bucket(client, endpoint_class)
+        with self._file_lock(offset, _BUCKET.size):
+            saved_key, tokens, updated = _BUCKET.unpack_from(self._map, offset)
+            # Unless another client's took over the bucket since
+            if saved_key == key:
+                tokens = min(self._limits[endpoint_class].burst, tokens + 1)
+                _BUCKET.pack_into(self._map, offset, key, tokens, updated)
+
+    def _change_count(self, endpoint_class, change):
+        """
+        Add change to the requests being served of a class, unless it's at its limit.
+        :return: If it was changed
+        """
+        column = self._columns[endpoint_class]
+        total_offset = self._totals_offset + _COUNT.size * column
+        with self._file_lock(total_offset, _COUNT.size):
+            total = _COUNT.unpack_from(self._map, total_offset)[0]
+            if change > 0 and total >= self._limits[endpoint_class].concurrency:
+                return False
+            _COUNT.pack_into(self._map, total_offset, max(0, total + change))
+            # The worker's own count is only changed under the same lock, see _claim_worker_slot
+            if self._worker_slot is not None:
+                count_offset = (
+                    self._workers_offset
+                    + self._worker_slot * self._worker_size
+                    + _COUNT.size * (1 + column)
+                )
+                count = _COUNT.unpack_from(self._map, count_offset)[0]
+                _COUNT.pack_into(self._map, count_offset, max(0, count + change))
+        return True
+
+    def admit(self, client, endpoint_class):
+        """
+        :param client: Address of the client
+        :param endpoint_class: Class of the requested endpoint, one of the limits
+        :return: None if the request is admitted, release() must be called once it's served. Otherwise (status code,
+            seconds to retry after) of the rejection.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._claim_worker_slot()
+            wait = self._take_token(client, endpoint_class, time.monotonic())
+            if wait > 0:
+                return 429, math.ceil(wait)
+            if not self._change_count(endpoint_class, 1):
+                # The client isn't to blame, rejecting the request doesn't count against its rate
+                self._refund_token(client, endpoint_class)
+                return 503, 1
+        return None
+
+    def release(self, endpoint_class):
+        """
+        :param endpoint_class: Class of an admitted request that was served
+        """
+        with self._lock:
+            self._change_count(endpoint_class, -1)
+
+    def get_stats(self):
+        """
+        :return: Dict of endpoint class -> requests being served by every worker
+        """
+        return {
+            name: _COUNT.unpack_from(
+                self._map, self._totals_offset + _COUNT.size * column
+            )[0]
+            for name, column in self._columns.items()
+        }
+
+
+class _RecordLock:
+    """
+    Exclusive fcntl lock on part of a file, held within a with block. Only excludes other processes.
+    """
+
+    __slots__ = ("_fd", "_offset", "_length")
+
+    def __init__(self, fd, offset, length):
+        self._fd = fd
+        self._offset = offset
+        self._length = length
+
+    def __enter__(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._length, self._offset)
+
+    def __exit__(self, *_):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, self._length, self._offset)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Running as another user
+    return True
@@ -0,0 +1,86 @@
+"""
+In-process cache of the results the API parses from the save folders.
+
+Every result is stored with the (modification time, size, inode) of the files it was read from, and is only returned
+while they are unchanged, so the monitor writing a file invalidates what was read from it. Checking costs one stat()
+per file, and nothing is parsed while the files stay the same.
+"""
+
+import collections
+import os
+import threading
+
+
+def get_signature(paths):
+    """
+    :return: Tuple identifying the current version of the files, None for a file that doesn't exist
+    """
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+        else:
+            signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+    return tuple(signature)
+
+
+class FileCache:
+    """
+    Least recently used cache of results read from files, validated by stat() on every access.
+    Thread safe. Two threads missing the same key at once both load it.
+    """
+
+    def __init__(self, max_entries=1024):
+        """
+        :param max_entries: Most results to keep, the least recently used are evicted (default is 1024)
+        """
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()  # Key -> (signature, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, paths, load):
+        """
+        :param key: Hashable key of the result
+        :param paths: The files the result is read from
+        :param load: Function reading the result, called if it isn't cached or the files changed
+        :return: The result
+        """
+        # The files are checked before loading, so a change during the load invalidates the result next time
+        signature = get_signature(paths)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = load()
+        with self._lock:
+            self._entries[key] = (signature, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        :return: Dict with the number of hits, misses, evictions and cached entries
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+            }
@@ -0,0 +1,121 @@
+"""
+Conditional and compressed JSON responses.
+
+A response is described by the version of the data it is built from (see the get_*_version functions of data_load).
+Its ETag is derived from that version and the request URL, so a client sending it back in If-None-Match gets a 304
+without the body being built, and so does one sending If-Modified-Since when the data has a modification time. Built
+bodies are kept per URL until the version changes, with their gzip encoding once a client accepted it, so repeated
+requests neither serialize nor compress again.
+"""
+
+import collections
+import gzip
+import hashlib
+import threading
+import flask
+
+# Bodies smaller than this are sent as they are, compressing them saves less than the headers weigh
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+
+class _EncodedBodies:
+    """
+    Least recently used cache of URL -> (ETag, identity body, gzip body or None). Thread safe.
+    """
+
+    def __init__(self, max_entries=512):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, etag):
+        """
+        :return: (identity body, gzip body or None) built for that ETag, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, etag, body, gzip_body):
+        with self._lock:
+            self._entries[key] = (etag, body, gzip_body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_bodies = _EncodedBodies()
+
+
+def get_etag(version):
+    """
+    :param version: repr()-able value that changes whenever the data of the response does
+    :return: The ETag of the response to the current request, without quotes
+    """
+    key = f"{flask.request.full_path}|{version!r}".encode("utf-8")
+    return hashlib.blake2b(key, digest_size=12).hexdigest()
+
+
+def _is_not_modified(etag, last_modified):
+    request = flask.request
+    if request.if_none_match:
+        # Both encodings of the body are the same data
+        return request.if_none_match.contains_weak(
+            etag
+        ) or request.if_none_match.contains_weak(etag + "-gzip")
+    if last_modified is not None and request.if_modified_since is not None:
+        # HTTP dates have a resolution of one second
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def conditional_response(version, build, last_modified=None):
+    """
+    :param version: repr()-able value that changes whenever the data the response is built from does, e.g. the file
+        versions returned by data_load.get_data_version
+    :param build: Function returning the JSON serializable response, only called if the body isn't cached
+    :param last_modified: Timezone aware datetime the data last changed at, or None if it isn't known
+    :return: flask.Response, 304 if the client's copy is still current
+    """
+    etag = get_etag(version)
+    gzip_accepted = flask.request.accept_encodings["gzip"] > 0
+    if _is_not_modified(etag, last_modified):
+        response = flask.Response(status=304)
+        # Answer with the ETag of the encoding the client has
+        if gzip_accepted and flask.request.if_none_match.contains_weak(etag + "-gzip"):
+            etag += "-gzip"
+    else:
+        key = flask.request.full_path
+        cached = _bodies.get(key, etag)
+        if cached is None:
+            body, gzip_body = flask.jsonify(build()).get_data(), None
+        else:
+            body, gzip_body = cached
+        if gzip_accepted and gzip_body is None and len(body) >= GZIP_MIN_SIZE:
+            gzip_body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+        if cached is None or gzip_body is not cached[1]:
+            _bodies.put(key, etag, body, gzip_body)
+
+        if gzip_accepted and gzip_body is not None:
+            response = flask.Response(gzip_body, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+            # The gzip encoding gets its own ETag, caches must not hand it to clients that didn't accept it
+            etag += "-gzip"
+        else:
+            response = flask.Response(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Vary"] = "Accept-Encoding"
+    # Clients may keep the response, but have to check it is still current before using it
+    response.cache_control.no_cache = True
+    return response
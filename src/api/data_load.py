@@ -1,43 +1,146 @@
-def load_map_data(directory, map_name):
-    is_found = False
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "map_data"), "r"
-    ) as file:
-        data = file.read()
+import datetime
+from src.api.cache import FileCache, get_signature
+from src.api.map_index import MapIndex
+from src.api.map_list import MapList
+from src.monitor.live_state import LiveStateReader
+from src.monitor.player_index import PlayerIndexReader, get_player_index_files
+from src.monitor.rollups import get_rollup_files, query_player_counts
+from src.monitor.storage import open_storage
+
+# Save folder -> Storage. The backend of a folder is detected the first time it is used.
+_storages = {}
+# Save folder -> LiveStateReader, each keeps the live state file of its folder mapped
+_live_states = {}
+# Save folder -> PlayerIndexReader, each keeps the player index of its folder mapped
+_player_indexes = {}
+# Parsed results of the storage readers, reused until the files they were read from change
+_cache = FileCache()
+
+
+def get_storage(directory):
+    storage = _storages.get(str(directory))
+    if storage is None:
+        storage = open_storage(directory)
+        _storages[str(directory)] = storage
+    return storage
+
+
+def _read_cached(directory, reader):
+    """
+    :param reader: Name of the Storage method to call
+    :return: What the method returns. The result is shared between calls, it must not be changed.
+    """
+    storage = get_storage(directory)
+    return _cache.get(
+        (str(directory), reader),
+        storage.get_source_files(reader),
+        getattr(storage, reader),
+    )
+
+
+def get_cache_stats():
+    """
+    :return: Dict with the hits, misses, evictions and entries of the cache of parsed results
+    """
+    return _cache.get_stats()
+
+
+def _get_files_version(paths):
+    """
+    :return: (version, last modified) of the files, see get_data_version
+    """
+    signature = get_signature(paths)
+    mtimes = [entry[0] for entry in signature if entry is not None]
+    if not mtimes:
+        return signature, None
+    return signature, datetime.datetime.fromtimestamp(
+        max(mtimes) / 1e9, datetime.timezone.utc
+    )
+
+
+def get_data_version(directory, *readers):
+    """
+    :param readers: Names of the Storage methods a response is built from
+    :return: (version, last modified) of the files they read. The version changes whenever one of the files does, the
+        last modified time is a UTC datetime, None if none of the files exist.
+    """
+    storage = get_storage(directory)
+    return _get_files_version(
+        [path for reader in readers for path in storage.get_source_files(reader)]
+    )
+
+
+def get_player_history_version(directory):
+    """
+    :return: (version, last modified) of the player count rollups, see get_data_version
+    """
+    return _get_files_version(get_rollup_files(directory))
+
+
+def load_playcounts(directory):
+    return _read_cached(directory, "read_playcounts")
+
+
+def load_map_index(directory):
+    """
+    :return: MapIndex of the maps played on the server, not counting SYS_ entries. Rebuilt when map_data changes.
+    """
+    storage = get_storage(directory)
+    return _cache.get(
+        (str(directory), "map_index"),
+        storage.get_source_files("read_playcounts"),
+        lambda: MapIndex(
+            name for name in load_playcounts(directory) if not name.startswith("SYS_")
+        ),
+    )
+
+
+def find_map(directory, map_name):
+    """
+    :param map_name: Name of the map, in any case
+    :return: The name the map is saved as, or None if it was never played
+    """
+    if map_name in load_playcounts(directory):
+        return map_name
+    return load_map_index(directory).find(map_name)
+
+
+def search_maps(directory, prefix, limit=25):
+    """
+    :return: List of the names of the maps starting with the prefix (in any case), in alphabetical order
+    """
+    return load_map_index(directory).search(prefix, limit)
+
+
+def load_map_list(directory):
+    """
+    :return: MapList of every map played on the server. Rebuilt when map_data or the map statistics change.
+    """
+    storage = get_storage(directory)
+    return _cache.get(
+        (str(directory), "map_list"),
+        storage.get_source_files("read_playcounts")
+        + storage.get_source_files("read_map_statistics"),
+        lambda: MapList(
+            load_playcounts(directory),
+            _read_cached(directory, "read_map_statistics"),
+        ),
+    )
 
-        map_playcount = 0
-        for line in data.splitlines():
-            split = line.split(" | ")
-            mapname_to_check = split[0]
-            playcount = int(split[1])
 
-            if mapname_to_check == map_name:
-                # The requested map exists
-                is_found = True
-                map_playcount = playcount
-                break
+def load_map_data(directory, map_name):
+    playcounts = load_playcounts(directory)
+    is_found = map_name in playcounts
+    map_playcount = playcounts.get(map_name, 0)
 
     # Load cached data, if any
-    cached_data_found = False
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "map_average_cache"), "r"
-    ) as file:
-        data = file.read()
-
-        map_avg_playtime = 0
-        map_avg_playercount_change = 0
-        for line in data.splitlines():
-            split = line.split(" | ")
-            mapname = split[0]
-            playtime = float(split[1])
-            pcount_change = float(split[2])
-
-            if mapname_to_check == mapname:
-                # The requested map exists
-                cached_data_found = True
-                map_avg_playtime = playtime
-                map_avg_playercount_change = pcount_change
-                break
+    statistics = _read_cached(directory, "read_map_statistics").get(map_name)
+    cached_data_found = statistics is not None
+    if cached_data_found:
+        map_avg_playtime = statistics.avg_playtime
+        map_avg_playercount_change = statistics.avg_player_change
+    else:
+        map_avg_playtime, map_avg_playercount_change = 0, 0
 
     return (
         is_found,
@@ -45,53 +148,128 @@ def load_map_data(directory, map_name):
         map_playcount,
         map_avg_playtime,
         map_avg_playercount_change,
+        statistics,
     )
 
 
+def load_map_history(directory, map_name, start=None, end=None):
+    """
+    :return: List of dicts, one for each time the map was played between start and end
+    """
+    return [
+        {
+            "start_date": str(entry.start_date),
+            "playtime": entry.playtime,
+            "start_players": entry.start_players,
+            "player_change": entry.player_change,
+        }
+        for entry in get_storage(directory).query_map_history(map_name, start, end)
+    ]
+
+
 def load_server_data(directory):
-    # Read files
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "first_write"), "r"
-    ) as file:
-        monitoring_since = file.read()
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "last_cache_time"), "r"
-    ) as file:
-        last_cache = file.read()
-    # Count number of maps in file
-    invalid = 0
-    count = None
-    with open((directory / "map_data"), "r") as fp:
-        for count, line in enumerate(fp):
-            if line.startswith("SYS_"):
-                invalid += 1
-    maps_tracked = count + 1 - invalid
+    storage = get_storage(directory)
+
+    def load():
+        monitoring_since = storage.read_first_write()
+        last_cache = storage.read_last_cache_time()
+        # Count number of maps, not counting SYS_ entries
+        maps_tracked = 0
+        for name in load_playcounts(directory):
+            if not name.startswith("SYS_"):
+                maps_tracked += 1
+        return monitoring_since, last_cache, maps_tracked
 
-    return monitoring_since, last_cache, maps_tracked
+    return _cache.get(
+        (str(directory), "server_data"),
+        storage.get_source_files("read_first_write")
+        + storage.get_source_files("read_last_cache_time")
+        + storage.get_source_files("read_playcounts"),
+        load,
+    )
 
 
 def load_active_map(directory):
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "active_map"), "r"
-    ) as file:
-        return file.read()
+    return _read_cached(directory, "read_active_map")
 
 
 def load_game_time(directory):
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "game_time"), "r"
-    ) as file:
-        return int(file.read().strip())
+    return _read_cached(directory, "read_game_time")
 
 
 def load_players(directory):
-    with open(  # noqa - safety is checked elsewhere
-        (directory / "online"), "r"
-    ) as file:
-        players = []
-        for line in file.readlines():
-            players.append(line.strip())
-        return players
+    return _read_cached(directory, "read_online_players")
+
+
+def load_player_history(directory, start, end, width):
+    """
+    :param width: Width of the buckets in seconds, a multiple of 60
+    :return: List of dicts with the min, max and mean player count of each bucket between start and end that has
+        samples, from the player count rollups (see rollups.py)
+    """
+    return [
+        {"time": str(time), "min": minimum, "max": maximum, "mean": mean}
+        for time, minimum, maximum, mean in query_player_counts(
+            directory, start, end, width
+        )
+    ]
+
+
+def get_player_index_version(directory):
+    """
+    :return: (version, last modified) of the player index, see get_data_version
+    """
+    return _get_files_version(get_player_index_files(directory))
+
+
+def load_player(directory, player_name, recent=10):
+    """
+    :param player_name: Name of the player, in any case
+    :param recent: Most sessions to return
+    :return: (PlayerSummary, list of their latest Session, newest first), or None if the player has no ended session
+    """
+    reader = _player_indexes.get(str(directory))
+    if reader is None:
+        reader = PlayerIndexReader(directory)
+        _player_indexes[str(directory)] = reader
+    return reader.lookup(player_name, recent)
+
+
+def iter_player_snapshots(directory, start, end):
+    """
+    :return: Iterator of dicts with the time, playercount and players of each player sample between start and end,
+        oldest first. Samples are read as they are iterated, and player_history is only read from shortly before start
+        (see SegmentedLog.iter_lines), so any range is streamed in constant memory.
+    """
+    for sample in get_storage(directory).iter_player_samples(start, end):
+        yield {
+            "time": str(sample.time),
+            "playercount": sample.playercount,
+            "players": sample.players,
+        }
+
+
+def _get_live_state_reader(directory):
+    reader = _live_states.get(str(directory))
+    if reader is None:
+        reader = LiveStateReader(directory)
+        _live_states[str(directory)] = reader
+    return reader
+
+
+def load_live_state(directory):
+    """
+    :return: Dict with the current_map, event, game_time, playercount, players and time published by the monitor, or
+        None if there is none (load the data from the storage instead)
+    """
+    return _get_live_state_reader(directory).read()
+
+
+def get_live_state_version(directory):
+    """
+    :return: Sequence number of the live state, it changes every time the monitor publishes one. None if there is none.
+    """
+    return _get_live_state_reader(directory).get_sequence()
 
 
 def load_occ_backup_data(directory):
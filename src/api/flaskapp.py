@@ -1,13 +1,50 @@
+import datetime
+import itertools
+import json
+import os
 import flask
 import pathlib
+from werkzeug.middleware.proxy_fix import ProxyFix
 from src.monitor.monitor import get_monitor_version
+from src.api.admission import AdmissionController, AdmissionLimit
+from src.api.cache import get_signature
+from src.api.conditional import conditional_response
+from src.api.map_list import SORT_KEYS
+from src.monitor.storage import HISTOGRAM_BIN_SECONDS
 from data_load import *
 
 DEVELOPMENT = False
-API_VERSION = "3.0.6"
+API_VERSION = "3.10.2"
 MONITOR_SERVERS = [
     "Overcast Community"
 ]  # Folders inside ../../save/ from where the API can serve data from.
+# Player count history: named resolutions, and the most buckets one response can have
+PLAYER_HISTORY_RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+PLAYER_HISTORY_MAX_BUCKETS = 10000
+# Most sessions a player lookup can return
+PLAYER_MAX_RECENT_SESSIONS = 100
+# Player snapshots streamed per chunk of the response
+PLAYER_SNAPSHOTS_PER_CHUNK = 100
+# Most map names one search can return
+MAP_SEARCH_MAX_LIMIT = 100
+# Most maps one page of the map listing can have
+MAP_LIST_MAX_PER_PAGE = 500
+# Admission control (see admission.py). Endpoints not listed are cheap, they are served from caches or indexes.
+ENDPOINT_CLASSES = {
+    "map_history": "expensive",
+    "player_history": "expensive",
+    "player_snapshots": "expensive",
+}
+ADMISSION_LIMITS = {
+    "cheap": AdmissionLimit(rate=10, burst=40, concurrency=64),
+    "expensive": AdmissionLimit(rate=0.5, burst=5, concurrency=4),
+}
+# File the limiter state is shared between the workers in
+ADMISSION_FILE = "../../save/api_admission"
+# Number of reverse proxies in front of the API. The address of each client is taken from the X-Forwarded-For header
+# they set, so each client gets its own rate limit. 0 if clients connect to the API directly, or they could pick any
+# address.
+TRUSTED_PROXIES = int(os.environ.get("API_TRUSTED_PROXIES", "1"))
 
 
 def has_access(server):
@@ -16,7 +53,76 @@ def has_access(server):
     return False
 
 
+def get_time_argument(name):
+    """
+    :param name: Name of the query string argument
+    :return: The argument parsed as an ISO 8601 datetime, or None if it wasn't given. Times with a UTC offset are
+        converted to the local time, the monitor saves naive local times.
+    :raises ValueError: If the argument isn't a valid datetime
+    """
+    value = flask.request.args.get(name)
+    if value is None:
+        return None
+    if value.endswith(("Z", "z")):
+        value = (
+            value[:-1] + "+00:00"
+        )  # Only accepted by fromisoformat since Python 3.11
+    time = datetime.datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        try:
+            time = time.astimezone().replace(tzinfo=None)
+        except OverflowError as ex:
+            raise ValueError(f"{value} is out of range") from ex
+    return time
+
+
 app = flask.Flask(__name__)
+if TRUSTED_PROXIES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+admission = AdmissionController(pathlib.Path(ADMISSION_FILE), ADMISSION_LIMITS)
+
+
+@app.before_request
+def admit_request():
+    """
+    Reject the request right away if its client is over its rate, or too many requests of its class are being served.
+    """
+    endpoint_class = ENDPOINT_CLASSES.get(flask.request.endpoint, "cheap")
+    rejection = admission.admit(flask.request.remote_addr, endpoint_class)
+    if rejection is not None:
+        status, retry_after = rejection
+        message = (
+            "Too many requests, slow down"
+            if status == 429
+            else "Server busy, try again later"
+        )
+        response = flask.jsonify(message)
+        response.status_code = status
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+    flask.g.admitted_class = endpoint_class
+    return None
+
+
+def _release_request():
+    endpoint_class = flask.g.pop("admitted_class", None)
+    if endpoint_class is not None:
+        admission.release(endpoint_class)
+
+
+@app.after_request
+def release_when_sent(response):
+    # Streamed responses are still being served after this, the request is released once they are sent
+    endpoint_class = flask.g.pop("admitted_class", None)
+    if endpoint_class is not None:
+        response.call_on_close(lambda: admission.release(endpoint_class))
+    return response
+
+
+@app.teardown_request
+def release_on_error(_):
+    # Only still admitted if after_request didn't run, because the request failed
+    _release_request()
 
 
 @app.route("/", methods=["GET"])
@@ -30,6 +136,8 @@ def index():
             "monitor_version": get_monitor_version(),
             "monitored_server_count": len(MONITOR_SERVERS),
             "monitored_servers": MONITOR_SERVERS,
+            "cache": get_cache_stats(),
+            "requests_being_served": admission.get_stats(),
         }
     )
 
@@ -47,18 +155,31 @@ def server_data(server_name):
     directory = pathlib.Path(f"../../save/{server_name}")
 
     if directory.is_dir():
-        monitoring_since, last_cache, maps_tracked = load_server_data(directory)
-        player_sample = load_players(directory)
-        # Return response
-        return flask.jsonify(
-            {
+        live_version = get_live_state_version(directory)
+        readers = ["read_first_write", "read_last_cache_time", "read_playcounts"]
+        if live_version is None:
+            readers.append("read_online_players")
+        version, last_modified = get_data_version(directory, *readers)
+        if live_version is not None:
+            # The players change with every live state, whose time isn't known without reading it
+            version, last_modified = (version, live_version), None
+
+        def build():
+            monitoring_since, last_cache, maps_tracked = load_server_data(directory)
+            live_state = load_live_state(directory)
+            if live_state is None:
+                player_sample = load_players(directory)
+            else:
+                player_sample = live_state["players"]
+            return {
                 "name": server_name,
                 "monitoring_since": monitoring_since,
                 "last_cache_update": last_cache,
                 "maps_tracked": maps_tracked,
                 "player_sample": player_sample,
             }
-        )
+
+        return conditional_response(version, build, last_modified)
     return flask.jsonify("Requested server not found"), 404
 
 
@@ -74,18 +195,35 @@ def current_map(server_name):
     directory = pathlib.Path(f"../../save/{server_name}")
 
     if directory.is_dir():
-        active_map = load_active_map(directory)
-        event = False
-        if active_map == "SYS_EVENT":
-            event = True
-            if server_name == "Overcast Community":
-                #  This is a terrible implementation, but it works.
-                #  (Also, it's hard to avoid it without a major refactor)
-                active_map = load_occ_backup_data(directory)
-        game_time = load_game_time(directory)
-        return flask.jsonify(
-            {"current_map": active_map, "game_time": game_time, "event": event}
-        )
+        live_version = get_live_state_version(directory)
+        if live_version is None:
+            version, last_modified = get_data_version(
+                directory, "read_active_map", "read_game_time"
+            )
+        else:
+            version, last_modified = live_version, None
+        # The backup map is shown during events
+        version = (version, get_signature([directory / "backup_current_map.txt"]))
+
+        def build():
+            # Use the live state the monitor publishes, the files only if there is none
+            live_state = load_live_state(directory)
+            if live_state is None:
+                active_map = load_active_map(directory)
+                game_time = load_game_time(directory)
+            else:
+                active_map = live_state["current_map"]
+                game_time = live_state["game_time"]
+            event = False
+            if active_map == "SYS_EVENT":
+                event = True
+                if server_name == "Overcast Community":
+                    #  This is a terrible implementation, but it works.
+                    #  (Also, it's hard to avoid it without a major refactor)
+                    active_map = load_occ_backup_data(directory)
+            return {"current_map": active_map, "game_time": game_time, "event": event}
+
+        return conditional_response(version, build, last_modified)
     return flask.jsonify("Requested server not found"), 404
 
 
@@ -94,7 +232,7 @@ def map_data(server_name, map_name):
     """
     Returns data about a specific map on a server
     :param server_name: Name of the server
-    :param map_name: Name of the map
+    :param map_name: Name of the map, in any case
     """
     if not has_access(server_name):
         return flask.jsonify("Requested server not found or forbidden"), 403
@@ -102,6 +240,13 @@ def map_data(server_name, map_name):
     directory = pathlib.Path(f"../../save/{server_name}")
 
     if directory.is_dir():
+        # The version is taken before loading, so data changing meanwhile is loaded again by the next request
+        version, last_modified = get_data_version(
+            directory, "read_playcounts", "read_map_statistics"
+        )
+        map_name = find_map(directory, map_name)
+        if map_name is None:
+            return flask.jsonify("Requested map not found"), 404
         # Load data for map
         (
             is_found,
@@ -109,23 +254,375 @@ def map_data(server_name, map_name):
             map_playcount,
             map_avg_playtime,
             map_avg_playercount_change,
+            statistics,
         ) = load_map_data(directory, map_name)
 
         if not is_found:
             return flask.jsonify("Requested map not found"), 404
-        return flask.jsonify(
-            {
+        # Statistics other than the averages are null until the analyzer of this version ran
+        has_statistics = statistics is not None and statistics.count is not None
+
+        def build():
+            return {
                 "server_name": server_name,
                 "map_name": map_name,
                 "found_in_cache": cached_data_found,
                 "playcount": map_playcount,
                 "map_avg_playtime": map_avg_playtime,
                 "map_avg_playercount_change": map_avg_playercount_change,
+                "map_median_playtime": (
+                    statistics.median_playtime if has_statistics else None
+                ),
+                "map_p90_playtime": statistics.p90_playtime if has_statistics else None,
+                "map_playtime_std_dev": (
+                    statistics.std_playtime if has_statistics else None
+                ),
+                "map_median_playercount_change": (
+                    statistics.median_player_change if has_statistics else None
+                ),
+                "map_p90_playercount_change": (
+                    statistics.p90_player_change if has_statistics else None
+                ),
+                "map_playercount_change_std_dev": (
+                    statistics.std_player_change if has_statistics else None
+                ),
+                "playtime_histogram": (
+                    {
+                        "bin_seconds": HISTOGRAM_BIN_SECONDS,
+                        "counts": statistics.playtime_histogram,
+                    }
+                    if has_statistics
+                    else None
+                ),
+            }
+
+        return conditional_response(version, build, last_modified)
+    return flask.jsonify("Requested server not found"), 404
+
+
+@app.route("/<string:server_name>/maps/", methods=["GET"])
+def map_list(server_name):
+    """
+    Returns a page of every map played on a server, with their playcount and averages
+    :param server_name: Name of the server
+    """
+    if not has_access(server_name):
+        return flask.jsonify("Requested server not found or forbidden"), 403
+
+    directory = pathlib.Path(f"../../save/{server_name}")
+
+    if directory.is_dir():
+        sort = flask.request.args.get("sort", "playcount")
+        if sort not in SORT_KEYS:
+            return (
+                flask.jsonify(f"Invalid sort, expected one of {', '.join(SORT_KEYS)}"),
+                400,
+            )
+        order = flask.request.args.get("order", "asc" if sort == "name" else "desc")
+        if order not in ("asc", "desc"):
+            return flask.jsonify("Invalid order, expected asc or desc"), 400
+        try:
+            page = int(flask.request.args.get("page", 1))
+            per_page = int(flask.request.args.get("per_page", 50))
+        except ValueError:
+            return flask.jsonify("Invalid page or per_page, expected a number"), 400
+        if page < 1 or not 1 <= per_page <= MAP_LIST_MAX_PER_PAGE:
+            return (
+                flask.jsonify(
+                    f"Invalid page or per_page, expected page 1 or more and per_page 1 to {MAP_LIST_MAX_PER_PAGE}"
+                ),
+                400,
+            )
+
+        version, last_modified = get_data_version(
+            directory, "read_playcounts", "read_map_statistics"
+        )
+
+        def build():
+            maps = load_map_list(directory)
+            return {
+                "server_name": server_name,
+                "sort": sort,
+                "order": order,
+                "page": page,
+                "per_page": per_page,
+                "total": len(maps),
+                "maps": maps.get_page(
+                    sort, order == "desc", (page - 1) * per_page, per_page
+                ),
+            }
+
+        return conditional_response(version, build, last_modified)
+    return flask.jsonify("Requested server not found"), 404
+
+
+@app.route("/<string:server_name>/maps/search/", methods=["GET"])
+def map_search(server_name):
+    """
+    Returns the names of the maps starting with a prefix, for autocompletion
+    :param server_name: Name of the server
+    """
+    if not has_access(server_name):
+        return flask.jsonify("Requested server not found or forbidden"), 403
+
+    directory = pathlib.Path(f"../../save/{server_name}")
+
+    if directory.is_dir():
+        prefix = flask.request.args.get("prefix", "")
+        try:
+            limit = int(flask.request.args.get("limit", 25))
+        except ValueError:
+            return flask.jsonify("Invalid limit, expected a number"), 400
+        if not 1 <= limit <= MAP_SEARCH_MAX_LIMIT:
+            return (
+                flask.jsonify(f"Invalid limit, expected 1 to {MAP_SEARCH_MAX_LIMIT}"),
+                400,
+            )
+
+        version, last_modified = get_data_version(directory, "read_playcounts")
+        return conditional_response(
+            version,
+            lambda: {
+                "server_name": server_name,
+                "prefix": prefix,
+                "maps": search_maps(directory, prefix, limit),
+            },
+            last_modified,
+        )
+    return flask.jsonify("Requested server not found"), 404
+
+
+@app.route("/<string:server_name>/maps/<string:map_name>/history/", methods=["GET"])
+def map_history(server_name, map_name):
+    """
+    Returns every time a map was played on a server, optionally only between two times
+    :param server_name: Name of the server
+    :param map_name: Name of the map, in any case
+    """
+    if not has_access(server_name):
+        return flask.jsonify("Requested server not found or forbidden"), 403
+
+    directory = pathlib.Path(f"../../save/{server_name}")
+
+    if directory.is_dir():
+        try:
+            start = get_time_argument("from")
+            end = get_time_argument("to")
+        except ValueError:
+            return flask.jsonify("Invalid time, expected ISO 8601"), 400
+        map_name = find_map(directory, map_name)
+        if map_name is None:
+            return flask.jsonify("Requested map not found"), 404
+
+        return flask.jsonify(
+            {
+                "server_name": server_name,
+                "map_name": map_name,
+                "history": load_map_history(directory, map_name, start, end),
             }
         )
     return flask.jsonify("Requested server not found"), 404
 
 
+@app.route("/<string:server_name>/players/history/", methods=["GET"])
+def player_history(server_name):
+    """
+    Returns the minimum, maximum and mean player count of a server over time, in buckets of a given resolution
+    :param server_name: Name of the server
+    """
+    if not has_access(server_name):
+        return flask.jsonify("Requested server not found or forbidden"), 403
+
+    directory = pathlib.Path(f"../../save/{server_name}")
+
+    if directory.is_dir():
+        try:
+            start = get_time_argument("from")
+            end = get_time_argument("to")
+        except ValueError:
+            return flask.jsonify("Invalid time, expected ISO 8601"), 400
+        if end is None:
+            end = datetime.datetime.now()
+        if start is None:
+            start = end - datetime.timedelta(days=1)
+        seconds = (end - start).total_seconds()
+
+        resolution = flask.request.args.get("resolution")
+        if resolution is None:
+            # The finest resolution that fits in the bucket limit
+            width = next(
+                (
+                    width
+                    for width in PLAYER_HISTORY_RESOLUTIONS.values()
+                    if seconds / width <= PLAYER_HISTORY_MAX_BUCKETS
+                ),
+                None,
+            )
+        elif resolution in PLAYER_HISTORY_RESOLUTIONS:
+            width = PLAYER_HISTORY_RESOLUTIONS[resolution]
+        elif resolution.isdigit() and int(resolution) > 0 and int(resolution) % 60 == 0:
+            width = int(resolution)
+        else:
+            return (
+                flask.jsonify(
+                    "Invalid resolution, expected minute, hour, day or a multiple of 60 seconds"
+                ),
+                400,
+            )
+        if width is None or seconds / width > PLAYER_HISTORY_MAX_BUCKETS:
+            return flask.jsonify("Too many buckets, use a coarser resolution"), 400
+
+        version, last_modified = get_player_history_version(directory)
+        # Without from and to, the range moves with the current time
+        version = (version, start.timestamp() // width, -(-end.timestamp() // width))
+        return conditional_response(
+            version,
+            lambda: {
+                "server_name": server_name,
+                "resolution": width,
+                "history": load_player_history(directory, start, end, width),
+            },
+            last_modified,
+        )
+    return flask.jsonify("Requested server not found"), 404
+
+
+@app.route("/<string:server_name>/players/snapshots/", methods=["GET"])
+def player_snapshots(server_name):
+    """
+    Returns the player count and online players of every query of a server between two times, streamed as it is read
+    :param server_name: Name of the server
+    """
+    if not has_access(server_name):
+        return flask.jsonify("Requested server not found or forbidden"), 403
+
+    directory = pathlib.Path(f"../../save/{server_name}")
+
+    if directory.is_dir():
+        try:
+            start = get_time_argument("from")
+            end = get_time_argument("to")
+        except ValueError:
+            return flask.jsonify("Invalid time, expected ISO 8601"), 400
+        if end is None:
+            end = datetime.datetime.now()
+        if start is None:
+            start = end - datetime.timedelta(hours=1)
+        if start > end:
+            return flask.jsonify("Invalid time range, from is after to"), 400
+        # Errors finding the start of the range are answered as errors, once the response starts it can only be cut off
+        snapshots = iter_player_snapshots(directory, start, end)
+        first = next(snapshots, None)
+
+        def generate():
+            yield f'{{"server_name": {json.dumps(server_name)}, "snapshots": ['
+            # Snapshots are sent a chunk at a time, so memory use doesn't grow with the range
+            separator, chunk = "", []
+            for snapshot in itertools.chain(
+                [] if first is None else [first], snapshots
+            ):
+                chunk.append(json.dumps(snapshot))
+                if len(chunk) == PLAYER_SNAPSHOTS_PER_CHUNK:
+                    yield separator + ",".join(chunk)
+                    separator, chunk = ",", []
+            yield (separator if chunk else "") + ",".join(chunk) + "]}"
+
+        return flask.Response(generate(), mimetype="application/json")
+    return flask.jsonify("Requested server not found"), 404
+
+
+@app.route("/<string:server_name>/players/<string:player_name>/", methods=["GET"])
+def player_data(server_name, player_name):
+    """
+    Returns when a player was seen on a server, how long they played and their latest sessions
+    :param server_name: Name of the server
+    :param player_name: Name of the player, in any case
+    """
+    if not has_access(server_name):
+        return flask.jsonify("Requested server not found or forbidden"), 403
+
+    directory = pathlib.Path(f"../../save/{server_name}")
+
+    if directory.is_dir():
+        try:
+            recent = int(flask.request.args.get("recent", 10))
+        except ValueError:
+            return flask.jsonify("Invalid recent, expected a number"), 400
+        if not 0 <= recent <= PLAYER_MAX_RECENT_SESSIONS:
+            return (
+                flask.jsonify(
+                    f"Invalid recent, expected 0 to {PLAYER_MAX_RECENT_SESSIONS}"
+                ),
+                400,
+            )
+
+        # The version is taken before loading, so data changing meanwhile is loaded again by the next request
+        version, last_modified = get_player_index_version(directory)
+        live_version = get_live_state_version(directory)
+        if live_version is None:
+            players_version, players_modified = get_data_version(
+                directory, "read_online_players"
+            )
+            version = (version, players_version)
+            if last_modified is None or (
+                players_modified is not None and players_modified > last_modified
+            ):
+                last_modified = players_modified
+        else:
+            version, last_modified = (version, live_version), None
+
+        found = load_player(directory, player_name, recent)
+        live_state = load_live_state(directory)
+        online_players = (
+            load_players(directory) if live_state is None else live_state["players"]
+        )
+        online_name = next(
+            (
+                name
+                for name in online_players
+                if name.casefold() == player_name.casefold()
+            ),
+            None,
+        )
+        if found is None and online_name is None:
+            return flask.jsonify("Requested player not found"), 404
+
+        def build():
+            if found is None:
+                # Online for the first time, their session ends in the index when they leave
+                return {
+                    "server_name": server_name,
+                    "player_name": online_name,
+                    "online": True,
+                    "sessions": 0,
+                    "total_seconds": 0,
+                    "first_seen": None,
+                    "last_seen": None,
+                    "recent_sessions": [],
+                }
+            summary, sessions = found
+            return {
+                "server_name": server_name,
+                "player_name": summary.name,
+                "online": online_name is not None,
+                "sessions": summary.sessions,
+                "total_seconds": summary.total_seconds,
+                "first_seen": str(summary.first_seen),
+                "last_seen": str(summary.last_seen),
+                "recent_sessions": [
+                    {
+                        "start": str(session.start),
+                        "end": str(session.end),
+                        "seconds": int((session.end - session.start).total_seconds()),
+                    }
+                    for session in sessions
+                ],
+            }
+
+        return conditional_response(version, build, last_modified)
+    return flask.jsonify("Requested server not found"), 404
+
+
 if __name__ == "__main__":
     if DEVELOPMENT:
         app.run(host="127.0.0.1", port=7000)
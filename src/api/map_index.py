@@ -0,0 +1,52 @@
+"""
+Sorted index of the map names of a server, for case-insensitive lookups and prefix searches in O(log n).
+"""
+
+import bisect
+
+
+class MapIndex:
+    """
+    Map names sorted by their case-folded form. Built once per version of map_data (see data_load.load_map_index).
+    """
+
+    def __init__(self, names):
+        """
+        :param names: Iterable of map names
+        """
+        pairs = sorted((name.casefold(), name) for name in names)
+        self._keys = [key for key, _ in pairs]
+        self._names = [name for _, name in pairs]
+
+    def __len__(self):
+        return len(self._names)
+
+    def find(self, name):
+        """
+        :param name: Map name, in any case
+        :return: The saved name of the map, or None if there is no such map. If several maps only differ in case, the
+            one matching the case exactly is preferred.
+        """
+        key = name.casefold()
+        index = bisect.bisect_left(self._keys, key)
+        if index == len(self._keys) or self._keys[index] != key:
+            return None
+        for candidate in range(index, bisect.bisect_right(self._keys, key)):
+            if self._names[candidate] == name:
+                return name
+        return self._names[index]
+
+    def search(self, prefix, limit=25):
+        """
+        :param prefix: Start of the map names, in any case
+        :param limit: Most names to return (default is 25, the most choices a Discord autocomplete can show)
+        :return: List of map names starting with the prefix, in alphabetical order
+        """
+        key = prefix.casefold()
+        start = bisect.bisect_left(self._keys, key)
+        results = []
+        for index in range(start, min(start + limit, len(self._keys))):
+            if not self._keys[index].startswith(key):
+                break
+            results.append(self._names[index])
+        return results
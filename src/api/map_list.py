@@ -0,0 +1,69 @@
+"""
+Every map of a server with its playcount and averages, presorted by each sort key, so a page of the listing is a slice.
+"""
+
+# Sort key -> field of the rows it sorts by
+SORT_KEYS = {
+    "name": "map_name",
+    "playcount": "playcount",
+    "avg_playtime": "map_avg_playtime",
+    "avg_playercount_change": "map_avg_playercount_change",
+}
+
+
+class MapList:
+    """
+    The rows of every map, sorted both ways by every sort key. Built once per version of map_data and
+    map_average_cache (see data_load.load_map_list).
+    """
+
+    def __init__(self, playcounts, statistics):
+        """
+        :param playcounts: Dict of map name -> playcount, maps starting with SYS_ are left out
+        :param statistics: Dict of map name -> MapStatistics
+        """
+        self._rows = []
+        for name, playcount in playcounts.items():
+            if name.startswith("SYS_"):
+                continue
+            map_statistics = statistics.get(name)
+            self._rows.append(
+                {
+                    "map_name": name,
+                    "playcount": playcount,
+                    "map_avg_playtime": (
+                        map_statistics.avg_playtime if map_statistics else None
+                    ),
+                    "map_avg_playercount_change": (
+                        map_statistics.avg_player_change if map_statistics else None
+                    ),
+                }
+            )
+
+        # (sort key, descending) -> rows in that order. Maps without a value are last both ways, ties are by name.
+        by_name = sorted(self._rows, key=lambda row: row["map_name"].casefold())
+        self._views = {("name", False): by_name, ("name", True): by_name[::-1]}
+        for sort, field in SORT_KEYS.items():
+            if sort == "name":
+                continue
+            missing = [row for row in by_name if row[field] is None]
+            present = [row for row in by_name if row[field] is not None]
+            # sorted() is stable, so rows with the same value stay sorted by name
+            ascending = sorted(present, key=lambda row: row[field])
+            descending = sorted(present, key=lambda row: row[field], reverse=True)
+            self._views[(sort, False)] = ascending + missing
+            self._views[(sort, True)] = descending + missing
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get_page(self, sort="playcount", descending=True, offset=0, limit=50):
+        """
+        :param sort: One of SORT_KEYS (default is playcount)
+        :param descending: Sort from the highest value (default is True)
+        :param offset: Number of rows to skip
+        :param limit: Most rows to return
+        :return: List of row dicts with the map_name, playcount, map_avg_playtime and map_avg_playercount_change.
+            The averages are None for maps that weren't analyzed yet.
+        """
+        return self._views[(sort, descending)][offset : offset + limit]
@@ -1,19 +1,90 @@
+import asyncio
+import collections
+import time
 import discord
 from discord.ext import commands
 import requests
 from cogs.current_map import format_seconds  # noqa
 
+# Most names the API returns for a prefix (its default limit)
+SEARCH_LIMIT = 25
+# Seconds the names of a prefix are reused for
+SEARCH_CACHE_SECONDS = 300
+SEARCH_CACHE_SIZE = 256
+
+# Case-folded prefix -> (time the names were fetched, names), the most recently used last
+_search_cache = collections.OrderedDict()
+
+
+def _search_maps(prefix):
+    try:
+        api_response = requests.get(
+            "https://quanteey.xyz/Overcast%20Community/maps/search/",
+            params={"prefix": prefix, "limit": SEARCH_LIMIT},
+            timeout=2,
+        )
+    except requests.RequestException:
+        return None
+    if api_response.status_code == 200:
+        return api_response.json()["maps"]
+    return None
+
+
+def _get_cached_names(key):
+    """
+    :return: The names of the maps starting with the case-folded prefix, from the cache, or None if they aren't in it.
+        Found from a shorter prefix whose names were all returned, so typing on doesn't ask the API again.
+    """
+    now = time.monotonic()
+    for length in range(len(key), -1, -1):
+        cached = _search_cache.get(key[:length])
+        if cached is None or now - cached[0] > SEARCH_CACHE_SECONDS:
+            continue
+        _search_cache.move_to_end(key[:length])
+        names = cached[1]
+        if length == len(key):
+            return names
+        if len(names) < SEARCH_LIMIT:
+            return [name for name in names if name.casefold().startswith(key)]
+    return None
+
+
+async def autocomplete_map_name(ctx: discord.AutocompleteContext):
+    # Map names starting with what was typed so far, not case sensitive
+    key = ctx.value.casefold()
+    names = _get_cached_names(key)
+    if names is not None:
+        return names
+
+    # Autocomplete runs on every key typed, the request is made in a thread to not block the bot meanwhile
+    names = await asyncio.get_running_loop().run_in_executor(
+        None, _search_maps, ctx.value
+    )
+    if names is None:
+        return []
+    _search_cache[key] = (time.monotonic(), names)
+    _search_cache.move_to_end(key)
+    while len(_search_cache) > SEARCH_CACHE_SIZE:
+        _search_cache.popitem(last=False)
+    return names
+
 
 class MapData(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
     @discord.slash_command()
-    async def get_map_data(self, interaction: discord.Interaction, map_name: str):
+    async def get_map_data(
+        self,
+        interaction: discord.Interaction,
+        map_name: discord.Option(str, autocomplete=autocomplete_map_name),
+    ):
         api_response = requests.get(
             f"https://quanteey.xyz/Overcast%20Community/maps/{map_name}"
         )
         if api_response.status_code == 200:
+            # The API finds the map in any case, show the name it is saved as
+            map_name = api_response.json()["map_name"]
             found_in_cache = api_response.json()["found_in_cache"]
             playcount = api_response.json()["playcount"]
             map_avg_playtime = int(api_response.json()["map_avg_playtime"])
@@ -0,0 +1,114 @@
+from src.monitor.scheduler import SYSTEM_CLOCK
+
+
+class WriteStats:
+    """
+    Counts what the buffered writers wrote, and what they saved compared to opening, writing and closing the file
+    (3 syscalls) on every call.
+    """
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.bytes_saved = 0  # Bytes of unchanged contents that weren't rewritten
+        self.syscalls = 0
+        self.syscalls_saved = 0
+
+    def to_dict(self):
+        return {
+            "bytes_written": self.bytes_written,
+            "bytes_saved": self.bytes_saved,
+            "syscalls": self.syscalls,
+            "syscalls_saved": self.syscalls_saved,
+        }
+
+
+class BufferedAppender:
+    """
+    Collects appends to a file in memory, and writes them with one write() once the buffer is big or old enough.
+    """
+
+    def __init__(
+        self, path, max_bytes=65536, max_age=60, clock=SYSTEM_CLOCK, stats=None
+    ):
+        """
+        :param path: pathlib.Path of the file to append to, can be changed with set_path()
+        :param max_bytes: Flush once this many bytes are buffered (default is 64 KiB)
+        :param max_age: Flush once the oldest buffered data is this many seconds old (default is 60)
+        :param clock: Where the age of the buffer is measured with (default is the system clock)
+        :param stats: WriteStats to count into (default is a new one)
+        """
+        self._path = path
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._clock = clock
+        self.stats = stats if stats is not None else WriteStats()
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_calls = 0
+        self._oldest = None  # Monotonic time the oldest buffered data was appended at
+
+    def set_path(self, path):
+        """
+        Append to another file from now on. What is buffered is written to the old one first.
+        """
+        self.flush()
+        self._path = path
+
+    def append(self, data: str):
+        if not self._buffer:
+            self._oldest = self._clock.monotonic()
+        self._buffer.append(data)
+        self._buffered_bytes += len(data)
+        self._buffered_calls += 1
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if not self._buffer:
+            return
+        if (
+            self._buffered_bytes >= self._max_bytes
+            or self._clock.monotonic() - self._oldest >= self._max_age
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = "".join(self._buffer)
+        with open(self._path, "a") as file:
+            file.write(data)
+        self.stats.bytes_written += len(data)
+        self.stats.syscalls += 3
+        self.stats.syscalls_saved += 3 * (self._buffered_calls - 1)
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_calls = 0
+        self._oldest = None
+
+
+class CoalescingFile:
+    """
+    A small file that is only rewritten when its contents change.
+    """
+
+    def __init__(self, path, stats=None):
+        """
+        :param path: pathlib.Path of the file
+        :param stats: WriteStats to count into (default is a new one)
+        """
+        self._path = path
+        self.stats = stats if stats is not None else WriteStats()
+        self._contents = None  # Unknown until we wrote the file once
+
+    def write(self, data: str):
+        if data == self._contents:
+            self.stats.bytes_saved += len(data)
+            self.stats.syscalls_saved += 3
+            return
+        with open(self._path, "w") as file:
+            file.write(data)
+        self._contents = data
+        self.stats.bytes_written += len(data)
+        self.stats.syscalls += 3
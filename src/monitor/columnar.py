@@ -0,0 +1,245 @@
+"""
+Map history as NumPy columns, and per-map statistics computed from them with vectorized group-bys.
+
+The columns are cached in <save folder>/history_columns/, one raw file of native-endian values per column, memory-mapped
+with numpy.memmap when loaded. meta.json keeps the map names, the number of valid rows and the map history cursor (see
+Storage.read_map_history_since) they include, so each load only parses the matches saved since the last one, and only
+appends them to the column files.
+"""
+
+import json
+import pathlib
+import numpy as np
+from src.monitor.storage import (
+    HISTOGRAM_BIN_SECONDS,
+    HISTOGRAM_BINS,
+    MapStatistics,
+    StaleCursorError,
+    write_atomic,
+)
+
+# Column name -> dtype. Start times are UNIX timestamps, map names are stored as ids into HistoryColumns.names.
+COLUMNS = {
+    "map_id": np.int32,
+    "start_time": np.float64,
+    "playtime": np.int32,
+    "start_players": np.int32,
+    "player_change": np.int32,
+}
+
+
+class HistoryColumns:
+    """
+    Every saved match, as one array per field. Row i of each array is the i-th match of map_history.
+    """
+
+    def __init__(self, names=None, columns=None, cursor=None):
+        """
+        :param names: List of map names, indexed by map id
+        :param columns: Dict of column name -> array (see COLUMNS)
+        :param cursor: Map history cursor of the last match included
+        """
+        self.names = names if names is not None else []
+        self.columns = columns or {
+            name: np.empty(0, dtype) for name, dtype in COLUMNS.items()
+        }
+        self.cursor = cursor
+        self._ids = {name: index for index, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.columns["map_id"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def get_map_id(self, name):
+        """
+        :return: Id of the map name, interning it if it's new
+        """
+        map_id = self._ids.get(name)
+        if map_id is None:
+            map_id = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return map_id
+
+    def extend(self, entries, cursor):
+        """
+        Add matches after the last row. The arrays are replaced by in-memory copies, memory-mapped ones aren't changed.
+        :param entries: List of MapHistoryEntry
+        :param cursor: Map history cursor of the last entry
+        """
+        new = {
+            "map_id": [self.get_map_id(entry.name) for entry in entries],
+            "start_time": [entry.start_date.timestamp() for entry in entries],
+            "playtime": [entry.playtime for entry in entries],
+            "start_players": [entry.start_players for entry in entries],
+            "player_change": [entry.player_change for entry in entries],
+        }
+        for name, dtype in COLUMNS.items():
+            self.columns[name] = np.concatenate(
+                (self.columns[name], np.array(new[name], dtype))
+            )
+        self.cursor = cursor
+
+
+class ColumnarHistory:
+    """
+    Loads the map history of a storage as HistoryColumns, keeping them cached in a folder.
+    """
+
+    def __init__(self, storage, directory=None):
+        """
+        :param storage: Storage to read the map history from
+        :param directory: pathlib.Path of the cache folder (default is <save folder>/history_columns)
+        """
+        self._storage = storage
+        self._directory = pathlib.Path(
+            directory
+            if directory is not None
+            else storage.directory / "history_columns"
+        )
+        self._meta_file = self._directory / "meta.json"
+
+    def _read_cache(self):
+        """
+        :return: The cached HistoryColumns, or None if there is no valid cache
+        """
+        if not self._meta_file.is_file():
+            return None
+        try:
+            with open(self._meta_file, "r") as file:
+                meta = json.load(file)
+            rows = meta["rows"]
+            columns = {}
+            for name, dtype in COLUMNS.items():
+                if rows == 0:
+                    # numpy.memmap can't map an empty file
+                    columns[name] = np.empty(0, dtype)
+                    continue
+                # A column file can be longer than meta.json says, if saving was interrupted before meta.json was
+                # replaced. Mapping a longer file than it is raises ValueError.
+                columns[name] = np.memmap(
+                    self._directory / f"{name}.bin", dtype, "r", shape=(rows,)
+                )
+            return HistoryColumns(meta["names"], columns, meta["cursor"])
+        except (OSError, ValueError, KeyError) as ex:
+            print(f"[ERROR] Invalid history column cache, loading from scratch: {ex}")
+            return None
+
+    def _write_cache(self, history, start):
+        """
+        :param history: HistoryColumns to save
+        :param start: Rows before this one are already in the column files
+        """
+        self._directory.mkdir(parents=True, exist_ok=True)
+        for name in COLUMNS:
+            column = history[name]
+            with open(self._directory / f"{name}.bin", "ab") as file:
+                # Drop whatever an interrupted save appended after the valid rows
+                file.truncate(start * column.itemsize)
+                file.write(column[start:].tobytes())
+        # meta.json is replaced last, it says how many rows of the columns are valid
+        write_atomic(
+            self._meta_file,
+            json.dumps(
+                {"names": history.names, "cursor": history.cursor, "rows": len(history)}
+            ),
+        )
+
+    def load(self):
+        """
+        Load the cached columns, and add the matches saved since. The cache is updated if there were any.
+        :return: HistoryColumns of the whole map history
+        """
+        history = self._read_cache() or HistoryColumns()
+        start = len(history)
+        try:
+            entries, cursor = self._storage.read_map_history_since(history.cursor)
+        except StaleCursorError:
+            # map_history was replaced since the cache was saved. Start over.
+            print("map_history was replaced, loading the history columns from scratch.")
+            history = HistoryColumns()
+            start = 0
+            entries, cursor = self._storage.read_map_history_since(None)
+        if entries or not self._meta_file.is_file():
+            history.extend(entries, cursor)
+            self._write_cache(history, start)
+        return history
+
+    def clear(self):
+        """
+        Delete the cache, the next load() reads the whole map history.
+        """
+        self._meta_file.unlink(missing_ok=True)
+
+
+def _sort_by_group(values, group_ids):
+    """
+    :param values: Array of int32 values
+    :param group_ids: Array of non-negative int64 group ids
+    :return: The values sorted by group, then by value
+    """
+    # One sort of (group id << 32 | value) keys is several times faster than a lexsort of the two arrays
+    keys = (group_ids << 32) | (values.astype(np.int64) + (1 << 31))
+    keys.sort()
+    return ((keys & 0xFFFFFFFF) - (1 << 31)).astype(np.float64)
+
+
+def _group_quantiles(sorted_values, offsets, counts, quantile):
+    """
+    :param sorted_values: Values sorted by group, then by value
+    :param offsets: Index of the first value of each group, only groups with at least one value
+    :param counts: Number of values of each group
+    :param quantile: Between 0 and 1
+    :return: The quantile of each group, interpolated linearly like numpy.quantile's default
+    """
+    position = offsets + quantile * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, offsets + counts - 1)
+    fraction = position - lower
+    return sorted_values[lower] * (1 - fraction) + sorted_values[upper] * fraction
+
+
+def compute_map_statistics(history: HistoryColumns):
+    """
+    Group the matches by map, all maps at once.
+    :return: List of MapStatistics, one for each map played at least once
+    """
+    map_ids = history["map_id"].astype(np.int64)
+    counts = np.bincount(map_ids, minlength=len(history.names))
+    played = np.flatnonzero(counts)
+    # Sorting by map id puts every map's matches next to each other, starting at its offset
+    offsets = (np.cumsum(counts) - counts)[played]
+    played_counts = counts[played]
+
+    results = []
+    for column in ("playtime", "player_change"):
+        values = history[column].astype(np.float64)
+        sums = np.bincount(map_ids, weights=values, minlength=len(counts))
+        means = sums / np.maximum(counts, 1)
+        squared_deviations = np.bincount(
+            map_ids, weights=(values - means[map_ids]) ** 2, minlength=len(counts)
+        )
+        # Sample standard deviation, 0 for maps played once
+        std = np.sqrt(squared_deviations / np.maximum(counts - 1, 1))
+        sorted_values = _sort_by_group(history[column], map_ids)
+        results += (
+            means[played],
+            _group_quantiles(sorted_values, offsets, played_counts, 0.5),
+            _group_quantiles(sorted_values, offsets, played_counts, 0.9),
+            std[played],
+        )
+
+    bins = np.clip(history["playtime"] // HISTOGRAM_BIN_SECONDS, 0, HISTOGRAM_BINS - 1)
+    histograms = np.bincount(
+        map_ids * HISTOGRAM_BINS + bins, minlength=len(counts) * HISTOGRAM_BINS
+    ).reshape(len(counts), HISTOGRAM_BINS)[played]
+
+    # Rows of (average, median, p90, standard deviation) of the playtime, then the same of the player change
+    rows = np.column_stack(results).tolist()
+    return [
+        MapStatistics(history.names[map_id], count, *row, histogram)
+        for map_id, count, row, histogram in zip(
+            played.tolist(), played_counts.tolist(), rows, histograms.tolist()
+        )
+    ]
@@ -0,0 +1,302 @@
+import asyncio
+import pathlib
+import signal
+from src.monitor.events import EventServer
+from src.monitor.metrics import NULL_METRICS, Metrics
+from src.monitor.monitor import ServerMonitor, DataWriter, DataAnalyzer
+from src.monitor.scheduler import DeadlineScheduler, Job, PeriodicJob, SYSTEM_CLOCK
+
+
+class MonitoredServer:
+    """
+    Groups the ServerMonitor, DataWriter and DataAnalyzer of one tracked server.
+    """
+
+    def __init__(
+        self,
+        name,
+        monitor: ServerMonitor,
+        writer: DataWriter,
+        analyzer: DataAnalyzer,
+        metrics=NULL_METRICS,
+        events=None,
+    ):
+        """
+        :param name: Name of the server. Same as the name of the save folder.
+        :param monitor: The ServerMonitor querying the server
+        :param writer: The DataWriter saving the server's data
+        :param analyzer: The DataAnalyzer caching the server's map averages
+        :param metrics: Where the time taken by each phase is measured (default is nowhere, see metrics.py)
+        :param events: EventServer to publish map changes and game time updates to (default is none, see events.py)
+        """
+        self.name = name
+        self.monitor = monitor
+        self.writer = writer
+        self.analyzer = analyzer
+        self._events = events
+
+        self._metrics = metrics
+        self._phase_labels = {
+            phase: {"server": name, "phase": phase}
+            for phase in ("write_data", "write_timeds", "analyze")
+        }
+
+    async def query(self, timeout=None):
+        """
+        Query the server, then save whatever the monitor produced.
+        :param timeout: Timeout of the status query in seconds
+        """
+        await self.monitor.async_query(timeout)
+        match = self.monitor.get_pending()
+        active = self.monitor.get_active()
+        timeds = self.monitor.get_timed()
+        with self._metrics.timer("phase_seconds", self._phase_labels["write_data"]):
+            self.writer.write_data(match, active)
+        with self._metrics.timer("phase_seconds", self._phase_labels["write_timeds"]):
+            self.writer.write_timeds(timeds)
+        if self._events is not None:
+            self._publish_events(match, timeds)
+        if match is not None:
+            # The analysis is incremental, so keeping the averages up to date after every match is cheap
+            await self.analyze()
+
+    def _publish_events(self, match, timeds):
+        state = self.writer.get_state()
+        if state is None:
+            return
+        data = {
+            "current_map": state["current_map"],
+            "event": state["event"],
+            "game_time": state["game_time"],
+            "playercount": state["playercount"],
+            "time": state["time"],
+        }
+        if match is not None:
+            self._events.publish(
+                self.name,
+                "map",
+                dict(
+                    data,
+                    previous_map=match.name,
+                    playtime=match.playtime,
+                    player_change=match.get_player_change(),
+                ),
+            )
+        if timeds is not None:
+            self._events.publish(self.name, "game_time", data)
+
+    async def analyze(self):
+        with self._metrics.timer("phase_seconds", self._phase_labels["analyze"]):
+            self.analyzer.analyze_maps()
+        self.monitor.set_expected_playtimes(self.analyzer.get_average_playtimes())
+
+
+class MonitorEngine:
+    """
+    Runs any number of MonitoredServers in one asyncio event loop.
+
+    Queries and analyses run at the deadlines given by the monitors and analyzers (see scheduler.py). Every status
+    query has its own timeout, so a slow or hung server only delays itself.
+    """
+
+    def __init__(
+        self,
+        query_timeout=5,
+        save_directory="../../save",
+        verbose=False,
+        clock=SYSTEM_CLOCK,
+        flush_interval=60,
+        backend="flat",
+        metrics=NULL_METRICS,
+        metrics_interval=300,
+        events_port=None,
+        keepalive_interval=15,
+        max_event_subscribers=None,
+    ):
+        """
+        :param query_timeout: Give up on a status query after this many seconds (default is 5)
+        :param save_directory: The folder the server folders are created in (default is ../../save)
+        :param verbose: Should the monitors, writers and the engine print out debug information
+        :param clock: Where the engine gets the time from (default is the system clock)
+        :param flush_interval: Write buffered data to the disk at least every x seconds (default is 60)
+        :param backend: Storage backend to save to, "flat" or "sqlite" (default is flat, see storage.py)
+        :param metrics: Metrics to record into (default is none, see metrics.py). If enabled, they are written to
+            <save_directory>/metrics.prom and summarized in the log every metrics_interval seconds.
+        :param metrics_interval: Seconds between metrics reports (default is 300)
+        :param events_port: Serve a Server-Sent Events stream of every server's map changes and game time on this port
+            (default is none, see events.py)
+        :param keepalive_interval: Seconds between keepalives sent to the event subscribers (default is 15)
+        :param max_event_subscribers: Most event subscribers, more are rejected (default is as many as the file
+            descriptor limit allows, up to 10000, see events.get_max_subscribers)
+        """
+        self._query_timeout = query_timeout
+        self._save_directory = save_directory
+        self._verbose = verbose
+        self._clock = clock
+        self._flush_interval = flush_interval
+        self._backend = backend
+        self._metrics = metrics
+
+        self._servers = []
+        self._scheduler = DeadlineScheduler(clock, metrics)
+        self._scheduler.add_job(
+            PeriodicJob("flush", flush_interval, self._flush_if_due, clock)
+        )
+        if metrics.enabled:
+            self._scheduler.add_job(
+                PeriodicJob("metrics", metrics_interval, self._report_metrics, clock)
+            )
+        if events_port is None:
+            self._events = None
+        else:
+            self._events = EventServer(
+                port=events_port,
+                verbose=verbose,
+                max_subscribers=max_event_subscribers,
+            )
+            self._scheduler.add_job(
+                PeriodicJob(
+                    "events keepalive", keepalive_interval, self._send_keepalive, clock
+                )
+            )
+
+    def add_server(
+        self,
+        name,
+        address,
+        port=25565,
+        query_time=30,
+        analyze_cooldown=43200,
+        adaptive=False,
+        query_budget=None,
+    ):
+        """
+        Create and register the monitor, writer and analyzer for a server.
+        :param name: Name of the server. Used in naming the save folder.
+        :param address: Address to query
+        :param port: Port of the server (default is 25565)
+        :param query_time: Time between each query in seconds (default is 30)
+        :param analyze_cooldown: Run caching every x seconds (default is 43200)
+        :param adaptive: Query more often near the end of a map, see ServerMonitor (default is False)
+        :param query_budget: Most queries per hour on average in adaptive mode (default is no limit)
+        :return: The created MonitoredServer
+        """
+        server = MonitoredServer(
+            name,
+            ServerMonitor(
+                address,
+                query_time=query_time,
+                verbose=self._verbose,
+                port=port,
+                clock=self._clock,
+                adaptive=adaptive,
+                query_budget=query_budget,
+                metrics=self._metrics,
+                metrics_labels={"server": name},
+            ),
+            DataWriter(
+                name,
+                verbose=self._verbose,
+                save_directory=self._save_directory,
+                flush_interval=self._flush_interval,
+                clock=self._clock,
+                backend=self._backend,
+                query_time=query_time,
+            ),
+            DataAnalyzer(
+                name,
+                analyze_cooldown=analyze_cooldown,
+                save_directory=self._save_directory,
+                clock=self._clock,
+                backend=self._backend,
+            ),
+            metrics=self._metrics,
+            events=self._events,
+        )
+        if self._events is not None:
+            self._events.add_server(name)
+        self._servers.append(server)
+        self._scheduler.add_job(
+            Job(
+                f"{name} query",
+                server.monitor.next_deadline,
+                lambda: server.query(self._query_timeout),
+            )
+        )
+        self._scheduler.add_job(
+            Job(f"{name} analysis", server.analyzer.next_deadline, server.analyze)
+        )
+        return server
+
+    def get_servers(self):
+        return self._servers
+
+    def get_events(self):
+        """
+        :return: The EventServer, or None if events aren't served
+        """
+        return self._events
+
+    async def _flush_if_due(self):
+        for server in self._servers:
+            server.writer.flush_if_due()
+
+    async def _send_keepalive(self):
+        self._events.send_keepalive()
+
+    async def _report_metrics(self):
+        self._metrics.write_textfile(
+            pathlib.Path(self._save_directory) / "metrics.prom"
+        )
+        print("------- Metrics -------")
+        for line in self._metrics.summary():
+            print(line)
+
+    def flush(self):
+        for server in self._servers:
+            server.writer.flush()
+
+    def close(self):
+        for server in self._servers:
+            server.writer.close()
+
+    async def run(self):
+        """
+        Monitor every registered server until stop() is called, or the process gets SIGTERM or SIGINT.
+        Buffered data is written to the disk before returning.
+        """
+        if self._verbose:
+            print(f"Monitoring {len(self._servers)} servers.")
+        loop = asyncio.get_running_loop()
+        signals = (signal.SIGTERM, signal.SIGINT)
+        for signum in signals:
+            loop.add_signal_handler(signum, self.stop)
+        try:
+            if self._events is not None:
+                await self._events.start()
+            await self._scheduler.run()
+        finally:
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+            if self._events is not None:
+                await self._events.close()
+            self.close()
+            if self._verbose:
+                print("Stopped, buffered data written.")
+
+    def stop(self):
+        self._scheduler.stop()
+
+
+# Servers monitored when running this file. (Name of the save folder, address)
+MONITORED_SERVERS = [("Overcast Community", "play.oc.tc")]
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH
+    print(f"Started - Saving to {str(pathlib.Path('../../save/'))} ")
+
+    engine = MonitorEngine(verbose=True, metrics=Metrics(), events_port=7001)
+    for server_name, server_address in MONITORED_SERVERS:
+        engine.add_server(server_name, server_address, query_time=10)
+
+    asyncio.run(engine.run())
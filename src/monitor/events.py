@@ -0,0 +1,279 @@
+"""
+Server-Sent Events stream of the map changes and game time of every monitored server, served by the monitor itself.
+
+Clients connect to http://<host>:<port>/<server name>/events/ and get an event as soon as the monitor records it,
+instead of polling /current_map/ on the API. Only local connections are accepted by default, the stream is served to the
+public through the reverse proxy in front of the API. Subscribers are plain connections of the monitor's event loop, so an idle
+one costs a socket and a few KiB, and no thread. Every event is serialized once, and the same bytes are written to all
+subscribers of its server.
+
+Events (the data is JSON):
+    map         The map changed. The current_map, event, game_time, playercount and time, with the previous_map, its
+                playtime and its player_change.
+    game_time   Sent after every query. The current_map, event, game_time, playercount and time.
+
+Every event has an id. A client reconnecting with the Last-Event-ID header gets the recent events it missed first.
+"""
+
+import asyncio
+import collections
+import json
+import urllib.parse
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+# Subscribers with more unsent bytes than this are too slow to keep up, and are disconnected
+MAX_BUFFERED_BYTES = 262144
+# Events of each server kept for clients reconnecting with Last-Event-ID
+REPLAY_EVENTS = 64
+# Seconds a client has to send its request in
+REQUEST_TIMEOUT = 10
+# Most subscribers of all servers together, more are rejected with 503 so the queries never wait on the subscribers.
+# Each subscriber is a file descriptor, the default is lowered to what the process' limit allows (see
+# get_max_subscribers).
+MAX_SUBSCRIBERS = 10000
+# File descriptors left for everything else: the save files, the status queries, the metrics
+RESERVED_FILE_DESCRIPTORS = 256
+
+_RESPONSE_HEADERS = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/event-stream\r\n"
+    b"Cache-Control: no-cache\r\n"
+    b"Connection: close\r\n"
+    b"Access-Control-Allow-Origin: *\r\n"
+    b"\r\n"
+    # Reconnect after 5 seconds if the connection is lost
+    b"retry: 5000\n\n"
+)
+_KEEPALIVE = b": keepalive\n\n"
+
+
+class _Stream:
+    """
+    Subscribers and recent events of one server.
+    """
+
+    def __init__(self):
+        self.subscribers = set()  # asyncio.StreamWriter of each subscriber
+        self.recent = collections.deque(maxlen=REPLAY_EVENTS)  # (id, serialized event)
+        self.last_id = 0
+
+
+def get_max_subscribers(wanted=MAX_SUBSCRIBERS):
+    """
+    Raises the process' limit of open file descriptors (RLIMIT_NOFILE) up to its hard limit if needed, to hold wanted
+    subscribers open at once.
+    :param wanted: Number of subscribers wanted (default is MAX_SUBSCRIBERS)
+    :return: wanted, or fewer if the hard limit doesn't allow as many
+    """
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = wanted + RESERVED_FILE_DESCRIPTORS
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        except (ValueError, OSError):
+            soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        return max(0, min(wanted, soft - RESERVED_FILE_DESCRIPTORS))
+    return wanted
+
+
+class EventServer:
+    """
+    Serves the event streams of the MonitorEngine's servers on one port. Runs in the engine's event loop, everything
+    but start() and close() must be called from it.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=7001,
+        verbose=False,
+        max_buffered_bytes=MAX_BUFFERED_BYTES,
+        max_subscribers=None,
+    ):
+        """
+        :param host: Address to listen on (default is 127.0.0.1, only the reverse proxy connects)
+        :param port: Port to listen on (default is 7001)
+        :param verbose: Print subscriptions and disconnections
+        :param max_buffered_bytes: Disconnect subscribers with more unsent bytes than this (default is 256 KiB)
+        :param max_subscribers: Most subscribers of all servers together (default is MAX_SUBSCRIBERS, or as many as
+            the file descriptor limit allows, see get_max_subscribers)
+        """
+        self._host = host
+        self._port = port
+        self._verbose = verbose
+        self._max_buffered_bytes = max_buffered_bytes
+        if max_subscribers is None:
+            max_subscribers = get_max_subscribers()
+        self._max_subscribers = max_subscribers
+        self._subscribers = 0
+        self._streams = {}  # Server name -> _Stream
+        self._server = None
+        self.events = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def add_server(self, name):
+        """
+        :param name: Name of the server, subscribed to at /<name>/events/
+        """
+        self._streams[name] = _Stream()
+
+    def get_port(self):
+        """
+        :return: The port listened on, the one picked by the system if 0 was given
+        """
+        if self._server is None:
+            return self._port
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self._host, self._port
+        )
+        if self._verbose:
+            print(
+                f"Serving events on port {self.get_port()}, "
+                f"to at most {self._max_subscribers} subscribers."
+            )
+
+    async def close(self):
+        """
+        Stop listening, and disconnect every subscriber.
+        """
+        if self._server is None:
+            return
+        self._server.close()
+        for stream in self._streams.values():
+            for writer in stream.subscribers:
+                writer.close()
+            stream.subscribers.clear()
+        await self._server.wait_closed()
+        self._server = None
+
+    def publish(self, server_name, event, data):
+        """
+        Send an event to every subscriber of a server.
+        :param server_name: Name of the server
+        :param event: Type of the event, e.g. "map"
+        :param data: JSON serializable data of the event
+        """
+        stream = self._streams[server_name]
+        stream.last_id += 1
+        frame = (
+            f"id: {stream.last_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+        ).encode("utf-8")
+        stream.recent.append((stream.last_id, frame))
+        self.events += 1
+        self._broadcast(stream, frame)
+
+    def send_keepalive(self):
+        """
+        Send a comment to every subscriber, so proxies don't close idle connections and dead ones are noticed.
+        """
+        for stream in self._streams.values():
+            self._broadcast(stream, _KEEPALIVE)
+
+    def _broadcast(self, stream, frame):
+        # write() only appends to the transport's buffer, so nothing waits for slow subscribers
+        for writer in list(stream.subscribers):
+            if (
+                writer.is_closing()
+                or writer.transport.get_write_buffer_size() > self._max_buffered_bytes
+            ):
+                # The client reconnects, and gets the recent events it missed with Last-Event-ID
+                stream.subscribers.discard(writer)
+                writer.close()
+                self.dropped += 1
+                continue
+            writer.write(frame)
+
+    def get_stats(self):
+        """
+        :return: Dict with the number of subscribers, events published, slow subscribers dropped and subscriptions
+            rejected because there were too many subscribers
+        """
+        return {
+            "subscribers": self._subscribers,
+            "events": self.events,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+        }
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT
+            )
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            ConnectionError,
+        ):
+            writer.close()
+            return
+
+        lines = request.decode("latin-1").split("\r\n")
+        request_line = lines[0].split(" ")
+        if len(request_line) != 3:
+            self._reject(writer, b"400 Bad Request")
+            return
+        method, target, _ = request_line
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or parts[1] != "events" or parts[0] not in self._streams:
+            self._reject(writer, b"404 Not Found")
+            return
+        if method != "GET":
+            self._reject(writer, b"405 Method Not Allowed")
+            return
+        if self._subscribers >= self._max_subscribers:
+            self.rejected += 1
+            self._reject(writer, b"503 Service Unavailable\r\nRetry-After: 30")
+            return
+        stream = self._streams[parts[0]]
+
+        writer.write(_RESPONSE_HEADERS)
+        last_event_id = headers.get("last-event-id", "")
+        if last_event_id.isdigit():
+            for event_id, frame in stream.recent:
+                if event_id > int(last_event_id):
+                    writer.write(frame)
+        stream.subscribers.add(writer)
+        self._subscribers += 1
+        if self._verbose:
+            print(f"Event subscriber connected to {parts[0]}.")
+
+        try:
+            # Clients don't send anything else, reading only notices them disconnecting
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self._subscribers -= 1
+            stream.subscribers.discard(writer)
+            writer.close()
+            if self._verbose:
+                print(f"Event subscriber disconnected from {parts[0]}.")
+
+    @staticmethod
+    def _reject(writer, status):
+        writer.write(
+            b"HTTP/1.1 "
+            + status
+            + b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+        )
+        writer.close()
@@ -0,0 +1,206 @@
+"""
+A local stand-in for a Minecraft server, answering Server List Ping (the protocol mcstatus' status() uses). The tests
+(tests/test_engine.py) monitor slow, hung and normal ones, and 60 at once.
+Running this file starts a lot of them and monitors all of them with one MonitorEngine for longer, to check how many
+servers one process can keep up with.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+import uuid
+
+
+def _encode_varint(value):
+    data = b""
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data += bytes([byte | 0x80])
+        else:
+            return data + bytes([byte])
+
+
+def _decode_varint(data, offset=0):
+    value = 0
+    for i in range(5):
+        byte = data[offset + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, offset + i + 1
+    raise IOError("VarInt is too big")
+
+
+async def _read_varint(reader):
+    value = 0
+    for i in range(5):
+        byte = (await reader.readexactly(1))[0]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value
+    raise IOError("VarInt is too big")
+
+
+def _make_packet(packet_id, payload):
+    data = _encode_varint(packet_id) + payload
+    return _encode_varint(len(data)) + data
+
+
+def make_occ_motd(map_name):
+    """
+    Build a MOTD the same shape as OCC's, so ServerMonitor can read the map name out of it.
+    :param map_name: Name of the map to advertise
+    """
+    return f"§3§lOvercast Community\n§3» §b{map_name} §3«"
+
+
+class FakeSLPServer:
+    """
+    Minimal Server List Ping server. The advertised map and players can be changed while it is running.
+    """
+
+    def __init__(
+        self, map_name="Airship Battle", players=None, host="127.0.0.1", port=0
+    ):
+        """
+        :param map_name: Name of the map to advertise
+        :param players: List of player names that are online
+        :param host: Address to listen on (default is 127.0.0.1)
+        :param port: Port to listen on, 0 picks a free one (default is 0)
+        """
+        self.map_name = map_name
+        self.players = players if players is not None else []
+        # Player count to advertise, None for the number of players. Real servers only send a sample of the players.
+        self.playercount = None
+        self.hang = False  # If True, connections are accepted but never answered
+        self.delay = 0  # Seconds to wait before answering a status request
+        self.requests = 0
+
+        self._host = host
+        self._port = port
+        self._server = None
+        self._writers = set()
+
+    @property
+    def port(self):
+        return self._port
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        self._port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in self._writers:
+                writer.close()
+            await self._server.wait_closed()
+
+    def get_status(self):
+        return {
+            "version": {"name": "1.8.9", "protocol": 47},
+            "players": {
+                "max": 500,
+                "online": (
+                    len(self.players) if self.playercount is None else self.playercount
+                ),
+                "sample": [
+                    {"name": name, "id": str(uuid.uuid3(uuid.NAMESPACE_OID, name))}
+                    for name in self.players
+                ],
+            },
+            "description": make_occ_motd(self.map_name),
+        }
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                length = await _read_varint(reader)
+                packet = await reader.readexactly(length)
+                packet_id, offset = _decode_varint(packet)
+                if packet_id != 0 and packet_id != 1:
+                    break
+                if packet_id == 0 and offset == len(packet):
+                    # Status request (the handshake is also packet 0, but it has a payload)
+                    self.requests += 1
+                    if self.hang:
+                        await reader.read()  # Wait until the client gives up
+                        break
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    status = json.dumps(self.get_status()).encode("utf-8")
+                    writer.write(_make_packet(0, _encode_varint(len(status)) + status))
+                elif packet_id == 1:
+                    # Ping, answer with the same payload
+                    writer.write(_make_packet(1, packet[offset:]))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # Cancelled when the event loop shuts down while a client is still connected
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+async def run_load_test(server_count=60, duration=60, query_time=5, hung_count=2):
+    """
+    Monitor a lot of fake servers from one MonitorEngine and print how well it kept up.
+    :param server_count: Number of fake servers that answer normally
+    :param duration: How long to run the test for in seconds
+    :param query_time: Time between each query in seconds
+    :param hung_count: Number of extra fake servers that never answer
+    """
+    from src.monitor.engine import MonitorEngine
+
+    servers = []
+    for i in range(server_count + hung_count):
+        server = FakeSLPServer(
+            f"Map {i}", [f"Player{i}_{n}" for n in range(random.randint(0, 40))]
+        )
+        server.hang = i >= server_count
+        await server.start()
+        servers.append(server)
+
+    with tempfile.TemporaryDirectory() as save_directory:
+        engine = MonitorEngine(query_timeout=2, save_directory=save_directory)
+        for i, server in enumerate(servers):
+            engine.add_server(
+                f"Fake {i}", "127.0.0.1", port=server.port, query_time=query_time
+            )
+
+        async def change_maps():
+            while True:
+                await asyncio.sleep(1)
+                random.choice(servers[:server_count]).map_name = f"Map {time.time()}"
+
+        changer = asyncio.create_task(change_maps())
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        asyncio.get_running_loop().call_later(duration, engine.stop)
+        await engine.run()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        changer.cancel()
+
+    for server in servers:
+        await server.close()
+
+    answered = sum(server.requests for server in servers[:server_count])
+    print(f"Monitored {server_count} servers (+{hung_count} hung) for {wall:.1f}s")
+    print(f"Status requests answered: {answered} ({answered / wall:.1f}/s)")
+    print(f"CPU time: {cpu:.2f}s ({cpu / wall:.1%} of one core)")
+
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--servers", type=int, default=60)
+    parser.add_argument("--duration", type=int, default=60)
+    parser.add_argument("--query-time", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(run_load_test(args.servers, args.duration, args.query_time))
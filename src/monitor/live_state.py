@@ -0,0 +1,135 @@
+"""
+Live state of a monitored server (current map, game time, online players), shared between the monitor and the API
+workers through a memory-mapped file in the server's save folder.
+
+The monitor is the only writer. Readers map the file once, and then read it without any syscalls. The file is
+protected by a sequence lock: the writer makes the sequence number odd before changing the payload and even again
+after, and readers retry if the number was odd or changed while they copied the payload, so they never see a half
+written state.
+
+Layout (little endian):
+    0   4 bytes     Magic, b"OALS"
+    8   uint64      Sequence number
+    16  uint32      Length of the payload
+    32  ...         Payload, UTF-8 JSON
+"""
+
+import json
+import mmap
+import os
+import struct
+
+LIVE_STATE_FILE = "live_state"
+LIVE_STATE_SIZE = 65536
+
+_MAGIC = b"OALS"
+_SEQUENCE = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+_SEQUENCE_OFFSET = 8
+_LENGTH_OFFSET = 16
+_PAYLOAD_OFFSET = 32
+
+
+class LiveStateWriter:
+    """
+    Publishes the live state of one server. Only one writer may use a file at a time.
+    """
+
+    def __init__(self, directory, size=LIVE_STATE_SIZE):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        :param size: Size of the file in bytes, the payload can use all but 32 of them (default is 64 KiB)
+        """
+        fd = os.open(directory / LIVE_STATE_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        # Continue the sequence of the previous writer, so readers notice the change
+        sequence = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0]
+        if self._map[:4] != _MAGIC:
+            sequence = 0
+        self._sequence = sequence + sequence % 2
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+        self._map[:4] = _MAGIC
+
+    def publish(self, state):
+        """
+        :param state: JSON serializable dict to publish
+        :raises ValueError: If the state doesn't fit in the file
+        """
+        payload = json.dumps(state).encode("utf-8")
+        if len(payload) > len(self._map) - _PAYLOAD_OFFSET:
+            raise ValueError(f"Live state is too big ({len(payload)} bytes)")
+
+        self._sequence += 1  # Odd, readers wait
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+        self._map[_PAYLOAD_OFFSET : _PAYLOAD_OFFSET + len(payload)] = payload
+        _LENGTH.pack_into(self._map, _LENGTH_OFFSET, len(payload))
+        self._sequence += 1  # Even, the state is consistent again
+        _SEQUENCE.pack_into(self._map, _SEQUENCE_OFFSET, self._sequence)
+
+    def close(self):
+        self._map.close()
+
+
+class LiveStateReader:
+    """
+    Reads the live state of one server. The file is mapped on the first read, and kept mapped.
+    """
+
+    def __init__(self, directory, retries=1000):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        :param retries: How many times to retry a read that raced with the writer before giving up (default is 1000)
+        """
+        self._path = directory / LIVE_STATE_FILE
+        self._retries = retries
+        self._map = None
+
+    def _open(self):
+        try:
+            with open(self._path, "rb") as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):  # ValueError: the file is still empty
+            return False
+        return True
+
+    def read(self):
+        """
+        :return: The last published state, or None if nothing was published or no consistent state could be read
+        """
+        if self._map is None and not self._open():
+            return None
+        if self._map[:4] != _MAGIC:
+            return None
+        for _ in range(self._retries):
+            before = _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0]
+            if before % 2:
+                continue  # Being written
+            if before == 0:
+                return None  # Nothing published yet
+            length = _LENGTH.unpack_from(self._map, _LENGTH_OFFSET)[0]
+            payload = self._map[_PAYLOAD_OFFSET : _PAYLOAD_OFFSET + length]
+            if _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0] == before:
+                return json.loads(payload)
+        return None
+
+    def get_sequence(self):
+        """
+        :return: Sequence number of the live state, it changes every time a state is published. None if nothing was
+            published.
+        """
+        if self._map is None and not self._open():
+            return None
+        if self._map[:4] != _MAGIC:
+            return None
+        return _SEQUENCE.unpack_from(self._map, _SEQUENCE_OFFSET)[0] or None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
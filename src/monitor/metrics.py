@@ -0,0 +1,227 @@
+"""
+Counters and latency histograms of the monitor's hot paths.
+
+The MonitorEngine writes them in the Prometheus text format to <save directory>/metrics.prom (for node_exporter's
+textfile collector), and prints a summary every metrics interval. Metrics are disabled by default: NULL_METRICS
+ignores everything, so the instrumented code only pays for one method call.
+"""
+
+import bisect
+import os
+import pathlib
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Metric name -> help text, the name is prefixed with Metrics.prefix
+METRIC_HELP = {
+    "queries_total": "Status queries made",
+    "query_failures_total": "Status queries that failed, by reason (timeout, error or parse)",
+    "query_seconds": "Time taken by status queries",
+    "map_changes_total": "Map changes detected",
+    "detection_latency_seconds": "Time between the last query that saw a map and the first that saw the next one",
+    "phase_seconds": "Time taken by each phase of handling a query (write_data, write_timeds, analyze)",
+    "job_lateness_seconds": "How long after their deadline scheduled jobs started",
+    "job_failures_total": "Scheduled job runs that raised an exception",
+}
+
+
+def _format_labels(labels):
+    """
+    :param labels: Tuple of (name, value) pairs
+    :return: The labels in the Prometheus format, e.g. {server="Overcast Community"}
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets, with their sum and maximum.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count", "max")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket, and a last one for values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+
+class _Timer:
+    """
+    Context manager observing the time spent in it.
+    """
+
+    __slots__ = ("_metrics", "_name", "_labels", "_start")
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self._metrics.observe(
+            self._name, time.perf_counter() - self._start, self._labels
+        )
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Keeps counters and histograms, each identified by a name and a dict of labels (e.g. {"server": name}).
+    Not thread safe, it is only used from the engine's event loop.
+    """
+
+    enabled = True
+
+    def __init__(self, prefix="overcast_analytics", buckets=DEFAULT_BUCKETS):
+        """
+        :param prefix: Prefix of every metric name (default is overcast_analytics)
+        :param buckets: Upper bounds of the histogram buckets in seconds (default is 1 ms to 10 s)
+        """
+        self.prefix = prefix
+        self._buckets = buckets
+        self._counters = {}  # Name -> {labels tuple: value}
+        self._histograms = {}  # Name -> {labels tuple: Histogram}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, labels=None, amount=1):
+        series = self._counters.setdefault(name, {})
+        key = self._key(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, labels=None):
+        series = self._histograms.setdefault(name, {})
+        key = self._key(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(self._buckets)
+        histogram.observe(value)
+
+    def timer(self, name, labels=None):
+        """
+        :return: Context manager that observes how long its body took in the histogram
+        """
+        return _Timer(self, name, labels)
+
+    def get_counter(self, name, labels=None):
+        return self._counters.get(name, {}).get(self._key(labels), 0)
+
+    def get_histogram(self, name, labels=None):
+        return self._histograms.get(name, {}).get(self._key(labels))
+
+    def render(self):
+        """
+        :return: Every metric in the Prometheus text format
+        """
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {full_name} counter")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+        for name, series in sorted(self._histograms.items()):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {full_name} histogram")
+            for labels, histogram in sorted(series.items()):
+                cumulative = 0
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    bucket_labels = _format_labels(labels + (("le", bound),))
+                    lines.append(f"{full_name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(
+                    f"{full_name}_count{_format_labels(labels)} {histogram.count}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """
+        Atomically replace a file with render(), so a scraper never reads a partial file.
+        :param path: pathlib.Path of the file, should end in .prom
+        """
+        path = pathlib.Path(path)
+        temp_file = path.with_name(path.name + ".tmp")
+        with open(temp_file, "w") as file:
+            file.write(self.render())
+        os.replace(temp_file, path)
+
+    def summary(self):
+        """
+        :return: List of lines summarizing every metric, for the log
+        """
+        lines = []
+        for name, series in sorted(self._counters.items()):
+            for labels, value in sorted(series.items()):
+                lines.append(f"{name}{_format_labels(labels)}: {value}")
+        for name, series in sorted(self._histograms.items()):
+            for labels, histogram in sorted(series.items()):
+                average = histogram.sum / histogram.count if histogram.count else 0
+                lines.append(
+                    f"{name}{_format_labels(labels)}: {histogram.count} samples, "
+                    f"avg {average * 1000:.1f} ms, max {histogram.max * 1000:.1f} ms"
+                )
+        return lines
+
+
+class NullMetrics(Metrics):
+    """
+    Metrics that ignore everything, used when metrics are disabled.
+    """
+
+    enabled = False
+
+    def inc(self, name, labels=None, amount=1):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+    def timer(self, name, labels=None):
+        return _NULL_TIMER
+
+
+NULL_METRICS = NullMetrics()
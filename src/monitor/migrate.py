@@ -0,0 +1,42 @@
+"""
+Import flat file save folders into the SQLite storage backend (see storage.py).
+Stop the monitor before migrating, and start it with the sqlite backend afterwards. The flat files are left in place,
+the API picks up the database after a restart.
+"""
+
+from src.monitor.save_folders import get_save_folders, make_parser
+from src.monitor.storage import SQLITE_FILE, FlatFileStorage, SqliteStorage
+
+
+def migrate_server(directory, force=False):
+    """
+    :param directory: pathlib.Path of the server's save folder
+    :param force: Replace the database if it already exists
+    :return: True if the folder was migrated
+    """
+    if (directory / SQLITE_FILE).is_file() and not force:
+        print(f"Skipping {directory.name}, it already has a database.")
+        return False
+    if not (directory / "map_data").is_file():
+        print(f"Skipping {directory.name}, it isn't a flat file save folder.")
+        return False
+
+    print(f"Migrating {directory.name}")
+    destination = SqliteStorage(directory)
+    destination.import_from(FlatFileStorage(directory))
+    destination.close()
+    return True
+
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH
+    parser = make_parser(__doc__, "migrate")
+    parser.add_argument(
+        "--force", action="store_true", help="Replace existing databases"
+    )
+    args = parser.parse_args()
+
+    directories = get_save_folders(args)
+
+    migrated = sum(migrate_server(directory, args.force) for directory in directories)
+    print(f"Migrated {migrated} save folders.")
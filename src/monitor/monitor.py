@@ -1,7 +1,29 @@
+import asyncio
 import mcstatus
-from time import sleep
 import datetime
 import pathlib
+import sys
+
+if __name__ == "__main__":
+    # Run as a script from src/monitor (python monitor.py). The modules import each other from the src package, so the
+    # repository root has to be importable.
+    sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[2]))
+
+from src.monitor.columnar import ColumnarHistory, compute_map_statistics
+from src.monitor.live_state import LiveStateWriter
+from src.monitor.metrics import NULL_METRICS
+from src.monitor.player_index import PlayerIndex, rebuild_player_index
+from src.monitor.recent import RingBuffer
+from src.monitor.rollups import PlayerRollups, rebuild_rollups
+from src.monitor.scheduler import SYSTEM_CLOCK
+from src.monitor.sessions import SessionIndex, rebuild_sessions
+from src.monitor.storage import (
+    MapHistoryEntry,
+    MapStatistics,
+    PlayerSample,
+    Session,
+    open_storage,
+)
 
 MONITOR_VERSION = "2.0.5"
 
@@ -15,6 +37,8 @@ class TimedData:
     Basic class for storing everything that needs to be saved periodically, rather than at the end of the game
     """
 
+    __slots__ = ("playercount", "online_players", "_is_complete", "game_time")
+
     def __init__(
         self, online_players: list, is_complete: False, playercount: int, game_time: int
     ):
@@ -35,6 +59,16 @@ class Match:
     Basic class for storing all data related to a recently played map.
     """
 
+    __slots__ = (
+        "start_date",
+        "playtime",
+        "name",
+        "start_players",
+        "end_players",
+        "is_event",
+        "detection_latency",
+    )
+
     def __init__(
         self,
         start_date: datetime.datetime,
@@ -43,6 +77,7 @@ class Match:
         start_players,
         end_players,
         is_event: bool,
+        detection_latency=None,
     ):
         self.start_date = start_date
         self.playtime = playtime
@@ -50,6 +85,9 @@ class Match:
         self.start_players = start_players
         self.end_players = end_players
         self.is_event = is_event
+        # Time between the last query that saw this map and the one that saw the next map, so the most the end of the
+        # map could have been missed by. None if unknown.
+        self.detection_latency = detection_latency
 
     def get_end_date(self):
         return self.start_date + datetime.timedelta(seconds=self.playtime)
@@ -58,39 +96,136 @@ class Match:
         return self.end_players - self.start_players
 
 
-class Map:
+class RecentHistory:
     """
-    Class to store data related to a map (Average times etc.)
-    Also has functions to calculate the data.
+    The last samples and matches of one server, kept in memory so they can be queried without reading the disk.
+
+    Every column is a fixed-size typed array (see recent.py), so a sample takes 16 bytes and a match 29 bytes, and
+    the memory used doesn't grow once the buffers are full. Map names are stored once, matches refer to them by id.
     """
 
-    def __init__(self, map_name, average_playtime=None, average_player_change=None):
-        self.map_name = map_name
-        self.average_playtime = average_playtime
-        self.average_player_change = average_player_change
+    # Sample columns: time (UNIX timestamp), playercount, game time
+    _SAMPLE_COLUMNS = "dii"
+    # Match columns: start date (UNIX timestamp), playtime, name id, start players, end players, is event, detection
+    # latency (negative if unknown)
+    _MATCH_COLUMNS = "diiiibf"
+
+    def __init__(self, samples=4096, matches=256):
+        """
+        :param samples: How many samples to keep (default is 4096, over 11 hours with a query every 10 seconds)
+        :param matches: How many matches to keep (default is 256)
+        """
+        self._samples = RingBuffer(samples, self._SAMPLE_COLUMNS)
+        self._matches = RingBuffer(matches, self._MATCH_COLUMNS)
+        self._names = []  # Name id -> map name
+        self._name_ids = {}  # Map name -> name id
 
-        self._playtimes = []
-        self._player_changes = []
+    def add_sample(self, time: datetime.datetime, playercount, game_time):
+        """
+        :param time: When the sample was taken, must not be before the previous sample
+        """
+        self._samples.append(time.timestamp(), playercount, game_time)
+
+    def add_match(self, _match: Match):
+        name_id = self._name_ids.get(_match.name)
+        if name_id is None:
+            name_id = len(self._names)
+            self._names.append(_match.name)
+            self._name_ids[_match.name] = name_id
+        self._matches.append(
+            _match.start_date.timestamp(),
+            _match.playtime,
+            name_id,
+            _match.start_players,
+            _match.end_players,
+            _match.is_event,
+            -1 if _match.detection_latency is None else _match.detection_latency,
+        )
 
-    def calculate_average_playtimes(self):
-        if len(self._playtimes) > 0:
-            self.average_playtime = sum(self._playtimes) / len(self._playtimes)
+    def get_playercounts(self, start=None, end=None):
+        """
+        :param start: Only return samples taken at or after this datetime (default is the oldest kept)
+        :param end: Only return samples taken before this datetime (default is the newest)
+        :return: List of (datetime, playercount, game time), oldest first
+        """
+        low = 0 if start is None else self._samples.bisect_left(0, start.timestamp())
+        if end is None:
+            high = self._samples.size
         else:
-            pass
+            high = self._samples.bisect_left(0, end.timestamp())
+        samples = []
+        for index in range(low, high):
+            time, playercount, game_time = self._samples.get_row(index)
+            samples.append(
+                (datetime.datetime.fromtimestamp(time), playercount, game_time)
+            )
+        return samples
 
-    def calculate_average_player_changes(self):
-        if len(self._player_changes) > 0:
-            self.average_player_change = sum(self._player_changes) / len(
-                self._player_changes
+    def get_recent_playercounts(self, seconds):
+        """
+        :param seconds: How far back from the newest sample to go, e.g. 3600 for the last hour
+        :return: See get_playercounts()
+        """
+        if self._samples.size == 0:
+            return []
+        newest = self._samples.get(0, self._samples.size - 1)
+        return self.get_playercounts(datetime.datetime.fromtimestamp(newest - seconds))
+
+    def get_matches(self, count=None):
+        """
+        :param count: How many of the last matches to return (default is every match kept)
+        :return: List of Match, oldest first
+        """
+        size = self._matches.size
+        count = size if count is None else min(count, size)
+        matches = []
+        for index in range(size - count, size):
+            row = self._matches.get_row(index)
+            matches.append(
+                Match(
+                    datetime.datetime.fromtimestamp(row[0]),
+                    row[1],
+                    self._names[row[2]],
+                    row[3],
+                    row[4],
+                    bool(row[5]),
+                    None if row[6] < 0 else row[6],
+                )
             )
-        else:
-            pass
+        return matches
 
-    def add_playtime(self, time):
-        self._playtimes.append(time)
+    def get_sample_count(self):
+        return self._samples.size
 
-    def add_player_change(self, change):
-        self._player_changes.append(change)
+    def get_match_count(self):
+        return self._matches.size
+
+    def get_memory_size(self):
+        """
+        :return: Bytes used by the buffers, not counting the map names
+        """
+        return self._samples.get_memory_size() + self._matches.get_memory_size()
+
+
+class Map:
+    """
+    Class to store data related to a map (Average times etc.)
+    The data is calculated by the DataAnalyzer, for every map at once (see columnar.py).
+    """
+
+    def __init__(self, map_name, average_playtime=None, average_player_change=None):
+        self.map_name = map_name
+        self.average_playtime = average_playtime
+        self.average_player_change = average_player_change
+        self.statistics = None
+
+    @classmethod
+    def from_statistics(cls, statistics: MapStatistics):
+        map_ = cls(
+            statistics.name, statistics.avg_playtime, statistics.avg_player_change
+        )
+        map_.statistics = statistics
+        return map_
 
 
 class ServerMonitor:
@@ -99,34 +234,87 @@ class ServerMonitor:
 
     Methods:
     tick()
-        This should run once every second. It queries the server, and if a new map is found, it sets the pending_map to
-        the Match object
+        Can be called as often as wanted. If the next query is due, it queries the server, and if a new map is found,
+        it sets the pending_map to the Match object
+    query() / async_query(timeout)
+        Query the server right away. The async version is used by the MonitorEngine (engine.py)
+    next_deadline()
+        returns the monotonic time the next query is due at
+    set_expected_playtimes(playtimes)
+        sets the average playtime of each map, used in adaptive mode
     get_pending_map()
         returns the pending map
+    get_detection_stats()
+        returns how many queries were made, and how quickly map changes were detected
+    get_recent()
+        returns the RecentHistory of the last samples and matches, e.g. get_recent().get_matches(20)
     """
 
-    def __init__(self, address, query_time=30, verbose=False):
+    def __init__(
+        self,
+        address,
+        query_time=30,
+        verbose=False,
+        port=25565,
+        clock=SYSTEM_CLOCK,
+        adaptive=False,
+        min_query_time=5,
+        max_query_time=120,
+        query_budget=None,
+        history_samples=4096,
+        history_matches=256,
+        metrics=NULL_METRICS,
+        metrics_labels=None,
+    ):
         """
         :param address Address to query
         :param query_time Time between each query in seconds. (default is 30)
         :param verbose Should the server monitor print out debug / map information to stdout
+        :param port Port of the server (default is 25565)
+        :param clock Where the monitor gets the time from (default is the system clock)
+        :param adaptive Query rarely early in a match, and more often as the map nears its average playtime. Maps
+            without an average playtime are queried every query_time seconds. (default is False)
+        :param min_query_time Shortest time between queries in adaptive mode (default is 5)
+        :param max_query_time Longest time between queries in adaptive mode (default is 120)
+        :param query_budget Most queries per hour on average in adaptive mode, None for no limit (default is None)
+        :param history_samples How many of the last samples to keep in memory (default is 4096)
+        :param history_matches How many of the last matches to keep in memory (default is 256)
+        :param metrics Where query latencies and failures are counted (Default is nowhere, see metrics.py)
+        :param metrics_labels Labels of this monitor's metrics (Default is {"server": address})
         """
         self._address = address
         self._query_time = query_time
         self._verbose = verbose
+        self._clock = clock
+
+        self._adaptive = adaptive
+        self._min_query_time = min_query_time
+        self._max_query_time = max_query_time
+        self._query_budget = query_budget
+        self._expected_playtimes = {}
+        # Token bucket for the query budget. Can save up 15 minutes worth of queries for the end of a match.
+        self._query_tokens = query_budget / 4 if query_budget else 0
+        self._query_tokens_time = clock.monotonic()
+
+        self._created = clock.monotonic()
+        self._queries = 0
+        self._last_query = None  # Monotonic time the previous query started at
+        self._query_started = None  # Monotonic time the current query started at
+        self._map_changes = 0  # Map changes with a known detection latency
+        self._detection_latency_total = 0
+        self._detection_latency_max = None
 
         self._prev_map = "SYS_INIT"
-        self._start_time = (
-            datetime.datetime.now()
-        )  # This will store the time the last map started.
-        self._current_playtime = 0
+        self._start_time = clock.now()  # This will store the time the last map started.
+        # Same as _start_time, but on the monotonic clock. Used for measuring playtime.
+        self._start_monotonic = clock.monotonic()
         self._starting_players = 0
-        self._query_cooldown = 0
+        self._next_query = clock.monotonic()  # Monotonic time the next query is due at
 
         self._pending_map = None
         self._is_pending = False
 
-        self._server = mcstatus.JavaServer(address)
+        self._server = mcstatus.JavaServer(address, port)
 
         self._online_players = []
 
@@ -135,87 +323,226 @@ class ServerMonitor:
 
         self._is_event = False
 
+        self._recent = RecentHistory(history_samples, history_matches)
+
+        self._metrics = metrics
+        self._metrics_labels = metrics_labels or {"server": address}
+        self._failure_labels = {
+            reason: dict(self._metrics_labels, reason=reason)
+            for reason in ("timeout", "error", "parse")
+        }
+
     def tick(self):
-        # Check if the query cooldown expired, if yes reset it and query the server
-        if self._query_cooldown > 0:
-            self._query_cooldown -= 1
+        # Query the server if the next query is due
+        if self._clock.monotonic() >= self._next_query:
+            self.query()
+
+    async def async_tick(self, timeout=None):
+        """
+        Same as tick(), but queries the server with mcstatus' async API, so many monitors can share one event loop.
+        :param timeout: Give up on the query after this many seconds and treat it as a failed query (default is None)
+        """
+        if self._clock.monotonic() >= self._next_query:
+            await self.async_query(timeout)
+
+    def next_deadline(self):
+        return self._next_query
+
+    def query(self):
+        self._start_query()
+        try:
+            with self._metrics.timer("query_seconds", self._metrics_labels):
+                status = self._server.status()
+        except Exception as ex:  # skipcq: PYL-W0703 - We want to catch every exception
+            print(f"[ERROR] Unable to query server: {ex}")
+            self._metrics.inc("query_failures_total", self._failure_labels["error"])
+            status = None
+        self._handle_status(status)
+
+    async def async_query(self, timeout=None):
+        """
+        :param timeout: Give up on the query after this many seconds and treat it as a failed query (default is None)
+        """
+        self._start_query()
+        try:
+            with self._metrics.timer("query_seconds", self._metrics_labels):
+                status = await asyncio.wait_for(self._server.async_status(), timeout)
+        except asyncio.TimeoutError:
+            print(f"[ERROR] Unable to query server: timed out after {timeout} seconds")
+            self._metrics.inc("query_failures_total", self._failure_labels["timeout"])
+            status = None
+        except Exception as ex:  # skipcq: PYL-W0703 - We want to catch every exception
+            print(f"[ERROR] Unable to query server: {ex}")
+            self._metrics.inc("query_failures_total", self._failure_labels["error"])
+            status = None
+        self._handle_status(status)
+
+    def set_expected_playtimes(self, playtimes):
+        """
+        :param playtimes: Dict of map name -> average playtime in seconds (see DataAnalyzer.get_average_playtimes)
+        """
+        self._expected_playtimes = playtimes
+
+    def get_detection_stats(self):
+        """
+        :return: Dict with the number of queries made, the queries per hour, the number of map changes detected and
+            the average and worst detection latency (see Match.detection_latency) in seconds
+        """
+        hours = (self._clock.monotonic() - self._created) / 3600
+        if self._map_changes > 0:
+            average_latency = self._detection_latency_total / self._map_changes
         else:
+            average_latency = None
+        return {
+            "queries": self._queries,
+            "queries_per_hour": self._queries / hours if hours > 0 else 0,
+            "map_changes": self._map_changes,
+            "avg_detection_latency": average_latency,
+            "max_detection_latency": self._detection_latency_max,
+        }
+
+    def _start_query(self):
+        now = self._clock.monotonic()
+        if self._verbose:
+            print(f"Querying server. [{now - self._start_monotonic:.0f}s]")
+        self._queries += 1
+        self._metrics.inc("queries_total", self._metrics_labels)
+        self._last_query = self._query_started
+        self._query_started = now
+
+    def _get_query_interval(self, now):
+        expected = self._expected_playtimes.get(self._prev_map)
+        if not self._adaptive or expected is None:
+            return self._query_time
+        # Query a quarter of the expected remaining time later, so queries get more frequent as the map nears its
+        # average playtime. Past the average, the map can end any moment, so query as often as allowed.
+        remaining = expected - (now - self._start_monotonic)
+        return min(max(remaining / 4, self._min_query_time), self._max_query_time)
+
+    def _take_query_token(self, deadline):
+        """
+        Delay the deadline until the query budget allows another query, then use up that query.
+        :param deadline: Monotonic time the next query would be due at
+        :return: Monotonic time the next query is due at
+        """
+        rate = self._query_budget / 3600
+        tokens = min(
+            self._query_budget / 4,
+            self._query_tokens + (deadline - self._query_tokens_time) * rate,
+        )
+        if tokens < 1:
+            deadline += (1 - tokens) / rate
+            tokens = 1
+        self._query_tokens = tokens - 1
+        self._query_tokens_time = deadline
+        return deadline
+
+    def _schedule_next_query(self, now):
+        # The next query is due one interval after the previous deadline, not after now, so slow queries don't add
+        # up. If we fell behind by more than a whole interval, skip the missed queries instead of bursting them.
+        interval = self._get_query_interval(now)
+        next_query = self._next_query + interval
+        if next_query <= now:
+            missed = (now - next_query) // interval + 1
+            next_query += missed * interval
+        if self._adaptive and self._query_budget:
+            next_query = self._take_query_token(next_query)
+        self._next_query = next_query
+
+    def _handle_status(self, status):
+        """
+        Process the result of a status query.
+        :param status: The status returned by mcstatus, or None if the query failed
+        """
+        try:
+            if status is None:
+                raise ValueError("No status received")
+            motd = status.description
+            players = status.players.online
+            self._online_players = status.players.sample or []
+            active_map_name = motd.splitlines()[1][
+                6:-4
+            ]  # Get the map name out from OCC's MOTD
+        except Exception as ex:  # skipcq: PYL-W0703 - We want to catch every exception
+            if status is not None:
+                print(f"[ERROR] Unable to parse server status: {ex}")
+                self._metrics.inc("query_failures_total", self._failure_labels["parse"])
+            active_map_name = "SYS_QUERYERROR"
+            players = 0
+            self._online_players = []
+
+        now = self._clock.monotonic()
+
+        # Check if the current map is different from the one we got last query
+        if self._prev_map != active_map_name:
+            if "§" in active_map_name:
+                self._is_event = True
+            else:
+                self._is_event = False
             if self._verbose:
-                print(f"Querying server. [{self._current_playtime}]")
+                print(f"New map detected. {self._prev_map} >> {active_map_name}")
 
-            # Reset cooldown
-            self._query_cooldown = self._query_time
+            # The finished map's playtime is measured with the monotonic clock, so it isn't affected by how often we
+            # were ticked or by changes to the system time.
+            playtime = round(now - self._start_monotonic)
+            if self._last_query is None:
+                detection_latency = None
+            else:
+                detection_latency = self._query_started - self._last_query
+                self._map_changes += 1
+                self._detection_latency_total += detection_latency
+                self._detection_latency_max = max(
+                    detection_latency, self._detection_latency_max or 0
+                )
+                self._metrics.inc("map_changes_total", self._metrics_labels)
+                self._metrics.observe(
+                    "detection_latency_seconds", detection_latency, self._metrics_labels
+                )
 
-            # Query the server
-            try:
-                status = self._server.status()
-                motd = status.description
-                players = status.players.online
-                self._online_players = status.players.sample
-                active_map_name = motd.splitlines()[1][
-                    6:-4
-                ]  # Get the map name out from OCC's MOTD
-            except (
-                Exception  # skipcq: PYL-W0703 - We want to catch every exception
-            ) as ex:
-                print(f"[ERROR] Unable to query server: {ex}")
-                active_map_name = "SYS_QUERYERROR"
-                players = 0
-                self._online_players = []
-
-            # Create timed objects
-            self._timed_data = TimedData(
-                self._online_players,
-                is_complete=False,
-                playercount=players,
-                game_time=self._current_playtime * self._query_time,
+            # Create the Match object, and print some data if verbose
+            self._pending_map = Match(
+                self._start_time,
+                playtime,
+                self._prev_map,
+                self._starting_players,
+                players,
+                self._is_event,
+                detection_latency,
             )
-            self._is_timed_data_pending = True
-
-            # Check if the current map is different from the one we got last query
-            if self._prev_map != active_map_name:
-                if "§" in active_map_name:
-                    self._is_event = True
-                else:
-                    self._is_event = False
-                if self._verbose:
-                    print(f"New map detected. {self._prev_map} >> {active_map_name}")
-
-                self._start_time = datetime.datetime.now()
-
-                # Create the Match object, and print some data if verbose
-                self._pending_map = Match(
-                    self._start_time,
-                    self._current_playtime * self._query_time,
-                    self._prev_map,
-                    self._starting_players,
-                    players,
-                    self._is_event,
+            self._is_pending = True
+            self._recent.add_match(self._pending_map)
+
+            if self._verbose:
+                print(f"------- Finished map -------\n > {self._prev_map} <")
+                print(f"Start time: {str(self._start_time)}")
+                print(f"Playtime: {playtime} seconds.")
+                print(
+                    f"Players at end: {players} [{players - self._starting_players:+g}]"
                 )
-                self._is_pending = True
+                print(f"Is event: {self._is_event}")
+                if detection_latency is not None:
+                    print(f"Detected within {detection_latency:.1f} seconds.")
+                print("---------------------------------\n")
+
+            # Reset the match-tracking variables
+            self._prev_map = active_map_name
+            self._starting_players = players
+            self._start_time = self._clock.now()
+            self._start_monotonic = now
+        elif self._verbose:
+            print("No map change detected.")
+
+        # Create timed objects
+        self._timed_data = TimedData(
+            self._online_players,
+            is_complete=False,
+            playercount=players,
+            game_time=round(now - self._start_monotonic),
+        )
+        self._is_timed_data_pending = True
+        self._recent.add_sample(self._clock.now(), players, self._timed_data.game_time)
 
-                if self._verbose:
-                    print(f"------- Finished map -------\n > {self._prev_map} <")
-                    print(f"Start time: {str(self._start_time)}")
-                    print(
-                        f"Playtime: {self._current_playtime * self._query_time} seconds."
-                    )
-                    print(
-                        f"Players at end: {players} \
-                            [{players - self._starting_players:+g}]"
-                    )
-                    print(f"Is event: {self._is_event}")
-                    print("---------------------------------\n")
-
-                # Reset the match-tracking variables
-                self._prev_map = active_map_name
-                self._starting_players = players
-                self._current_playtime = 0
-            else:
-                # Add one to the current playtime. Time will be obtained by multiplying this with the query time
-                if self._verbose:
-                    print("No map change detected.")
-                self._current_playtime += 1
+        self._schedule_next_query(now)
 
     def get_pending(self):
         if self._is_pending:
@@ -226,6 +553,9 @@ class ServerMonitor:
     def get_active(self):
         return self._prev_map
 
+    def get_recent(self):
+        return self._recent
+
     def get_timed(self):
         if self._is_timed_data_pending:
             self._is_timed_data_pending = False
@@ -236,39 +566,121 @@ class ServerMonitor:
 class DataWriter:
     """
     Class for writing data to the disk. Handles writing the data for one server.
+    Where and how the data is saved is up to the storage backend, see storage.py
     """
 
-    def __init__(self, server_name, verbose=False):
+    def __init__(
+        self,
+        server_name,
+        verbose=False,
+        save_directory="../../save",
+        compact_every=100,
+        flush_bytes=65536,
+        flush_interval=60,
+        clock=SYSTEM_CLOCK,
+        backend="flat",
+        live_state=True,
+        query_time=30,
+    ):
         """
         :param server_name Name of the server. Used in naming the folder.
         :param verbose Display debug information (Default is False)
+        :param save_directory The folder the server folders are created in (Default is ../../save)
+        :param compact_every Rewrite map_data after this many playcount changes were logged (Default is 100)
+        :param flush_bytes Write the buffered player_history once this many bytes are buffered (Default is 64 KiB)
+        :param flush_interval Write the buffered player_history at least every x seconds (Default is 60)
+        :param clock Where the writer gets the time from (default is the system clock)
+        :param backend Storage backend to save to, "flat" or "sqlite" (Default is flat)
+        :param live_state Publish the current map, game time and players for the API in a shared memory file (see
+            live_state.py) after every query (Default is True)
+        :param query_time Time between the monitor's queries in seconds, used to rebuild the player count rollups
+            (Default is 30)
         """
-        self._history_file = pathlib.Path(f"../../save/{server_name}/map_history")
-        self._map_data = pathlib.Path(f"../../save/{server_name}/map_data")
-        self._active_map = pathlib.Path(f"../../save/{server_name}/active_map")
-        self._game_time = pathlib.Path(f"../../save/{server_name}/game_time")
-        self._first_write = pathlib.Path(f"../../save/{server_name}/first_write")
-        self._online_players = pathlib.Path(f"../../save/{server_name}/online")
-        self._misc_data = pathlib.Path(f"../../save/{server_name}/misc")
-        self._player_history = pathlib.Path(f"../../save/{server_name}/player_history")
         self._verbose = verbose
+        self._clock = clock
+
+        # Make sure the storage exists
+        self._storage = open_storage(
+            pathlib.Path(save_directory) / server_name,
+            backend,
+            compact_every=compact_every,
+            flush_bytes=flush_bytes,
+            flush_interval=flush_interval,
+            clock=clock,
+        )
+        self._storage.create()
+        self._storage.init_first_write(clock.now())
 
-        # Make sure files exists
-        pathlib.Path(f"../../save/{server_name}").mkdir(parents=True, exist_ok=True)
-        self._history_file.touch()
-        self._map_data.touch()
-        self._active_map.touch()
-        self._game_time.touch()
-        self._misc_data.touch()
-        self._online_players.touch()
-        self._player_history.touch()
-
-        # Check if first_write exists, if yes then pass, if not then create it.
-        if self._first_write.is_file():
-            pass
+        # Playcounts are kept in memory, so counting a finished match doesn't have to read them
+        self._storage.load_playcounts()
+
+        self._active_map = self._storage.read_active_map()
+        self._state = None  # The last live state, see get_state()
+        if live_state:
+            self._live_state = LiveStateWriter(
+                pathlib.Path(save_directory) / server_name
+            )
+        else:
+            self._live_state = None
+
+        # Player sessions are kept up to date with every query. Only the ongoing ones are kept in memory, ended sessions
+        # are saved, and looked up in the player index. Sessions that were ongoing when the writer stopped were ended by
+        # close(), or are lost if it crashed.
+        session_count = self._storage.count_sessions()
+        if session_count is None:
+            if self._verbose:
+                print("Building the player sessions from the player history.")
+            self._sessions = rebuild_sessions(self._storage)
+        else:
+            self._sessions = SessionIndex()
+
+        # Player name -> sessions index, for the API's player lookups (see player_index.py). Rebuilt if it doesn't have
+        # the same sessions as the storage, e.g. if the monitor crashed between saving a session to both.
+        self._player_index = None
+        if session_count is not None and PlayerIndex.exists(self._storage.directory):
+            self._player_index = PlayerIndex(self._storage.directory)
+            if self._player_index.get_session_count() != session_count:
+                self._player_index.close()
+                self._player_index = None
+        if self._player_index is None:
+            if self._verbose:
+                print("Building the player index from the player sessions.")
+            self._player_index = rebuild_player_index(self._storage)
+
+        # Minute, hour and day rollups of the player count, for the API's charts (see rollups.py)
+        if PlayerRollups.exists(self._storage.directory):
+            self._rollups = PlayerRollups(self._storage.directory)
         else:
-            with open(self._first_write, "w") as file:
-                file.write(str(datetime.datetime.now()))
+            if self._verbose:
+                print("Building the player count rollups from the player history.")
+            self._rollups = rebuild_rollups(self._storage, query_time, end=clock.now())
+
+    def get_playcounts(self):
+        return self._storage.read_playcounts()
+
+    def get_storage(self):
+        return self._storage
+
+    def get_state(self):
+        """
+        :return: Dict with the current_map, event, game_time, playercount, players and time of the last write_timeds(),
+            the same as the published live state. None if nothing was written yet.
+        """
+        return self._state
+
+    def get_sessions(self, player, start=None, end=None):
+        """
+        :param player: Name of the player
+        :param start: Only return sessions that ended after this datetime
+        :param end: Only return sessions that started before this datetime
+        :return: List of Session, oldest first. The end of an ongoing session is None. The times of ended sessions are
+            rounded down to the second.
+        """
+        sessions = self._player_index.get_sessions(player, start, end)
+        ongoing = self._sessions.get_ongoing(player)
+        if ongoing is not None and (end is None or ongoing < end):
+            sessions.append(Session(player, ongoing, None))
+        return sessions
 
     def write_data(self, _match: Match, active_map: str):
         """
@@ -278,56 +690,32 @@ class DataWriter:
         if _match is None:
             pass
         else:
+            entry = MapHistoryEntry(
+                _match.name,
+                _match.start_date,
+                _match.playtime,
+                _match.start_players,
+                _match.get_player_change(),
+            )
             if _match.is_event:
-                with open(self._active_map, "w") as file:
-                    file.write("SYS_EVENT")
-
-                with open(self._history_file, "a") as file:
-                    name = "SYS_EVENT"
-                    stime = str(_match.start_date)
-                    ptime = _match.playtime
-                    splayers = _match.start_players
-                    pchange = _match.get_player_change()
-                    file.write(f"{name} | {stime} | {ptime} | {splayers} | {pchange}\n")
+                self._storage.write_active_map("SYS_EVENT")
+                self._active_map = "SYS_EVENT"
+                self._storage.append_match(entry._replace(name="SYS_EVENT"))
             else:
                 # Writing map history
                 if self._verbose:
                     print("Starting the save - Map History")
-                with open(self._history_file, "a") as file:
-                    name = _match.name
-                    stime = str(_match.start_date)
-                    ptime = _match.playtime
-                    splayers = _match.start_players
-                    pchange = _match.get_player_change()
-                    file.write(f"{name} | {stime} | {ptime} | {splayers} | {pchange}\n")
+                self._storage.append_match(entry)
 
                 if self._verbose:
                     print("Starting the save - Active map")
-                with open(self._active_map, "w") as file:
-                    file.write(active_map)
+                self._storage.write_active_map(active_map)
+                self._active_map = active_map
 
                 # Writing map data
                 if self._verbose:
                     print("Staring the save - Map Data")
-                with open(self._map_data, "r") as file:
-                    data = file.read()
-
-                new_data = ""
-                is_written = False
-                for line in data.splitlines():
-                    split = line.split(" | ")
-                    mapname = split[0]
-                    playcount = int(split[1])
-                    if mapname == _match.name:
-                        is_written = True
-                        new_data += f"{mapname} | {playcount+1}\n"
-                    else:
-                        new_data += f"{mapname} | {playcount}\n"
-                if not is_written:
-                    new_data += f"{_match.name} | 1\n"
-
-                with open(self._map_data, "w") as file:
-                    file.write(new_data)
+                self._storage.increment_playcount(_match.name)
 
                 if self._verbose:
                     print("Write finished.")
@@ -338,126 +726,145 @@ class DataWriter:
         else:
             if self._verbose:
                 print("Writing online players.")
-            with open(self._online_players, "w") as file:
-                for item in timed.get_player_names():
-                    file.write(str(item) + "\n")
-            with open(self._player_history, "a") as file:
-                file.write(
-                    datetime.datetime.now().isoformat()
-                    + "|"
-                    + str(timed.playercount)
-                    + "|"
-                )
-                for item in timed.get_player_names():
-                    file.write(str(item) + "|")
-                file.write("\n")
-            with open(self._game_time, "w") as file:
-                file.write(str(timed.game_time).strip() + "\n")
+            player_names = timed.get_player_names()
+            now = self._clock.now()
+            self._storage.write_online_players(player_names)
+            self._storage.append_player_sample(
+                PlayerSample(now, timed.playercount, player_names)
+            )
+            for session in self._sessions.add_sample(now, player_names):
+                self._storage.append_session(session)
+                self._player_index.add_session(session)
+            self._rollups.add_sample(now, timed.playercount)
+
+            self._state = {
+                "current_map": self._active_map,
+                "event": self._active_map == "SYS_EVENT",
+                "game_time": timed.game_time,
+                "playercount": timed.playercount,
+                "players": player_names,
+                "time": now.isoformat(),
+            }
+            if self._live_state is not None:
+                self._live_state.publish(self._state)
+            self._storage.write_game_time(timed.game_time)
+
+    def flush_if_due(self):
+        """
+        Write the buffered data if it is old enough. Should be called regularly, in case no new data comes in.
+        """
+        self._storage.flush_if_due()
+        self._rollups.flush()
+
+    def flush(self):
+        """
+        Write all buffered data. Must be called before exiting.
+        """
+        self._storage.flush()
+        self._rollups.flush()
+
+    def close(self):
+        """
+        End the ongoing player sessions and write all buffered data. Must be called before exiting.
+        """
+        for session in self._sessions.end_all():
+            self._storage.append_session(session)
+            self._player_index.add_session(session)
+        self._player_index.close()
+        self._storage.flush()
+        self._rollups.close()
+        if self._live_state is not None:
+            self._live_state.close()
+
+    def get_io_stats(self):
+        """
+        :return: Dict with the bytes and syscalls used by the per-query writes, and those saved by buffering
+        """
+        return self._storage.get_io_stats()
 
 
 class DataAnalyzer:
     """
     Class for analyzing the map_history data for one tracked server, and then "caching" it in map_average_cache.
+
+    map_history is loaded as NumPy columns, cached in the save folder so each analysis only parses the matches saved
+    since the last one (see columnar.py). The statistics of every map are then recalculated from the columns at once.
     """
 
-    def __init__(self, server_save_name, analyze_cooldown=43200):
+    def __init__(
+        self,
+        server_save_name,
+        analyze_cooldown=43200,
+        save_directory="../../save",
+        clock=SYSTEM_CLOCK,
+        backend="flat",
+    ):
         """
         :param server_save_name The name of the folder the server data is saved to (../../save/<name>)
         :param analyze_cooldown: Run caching every x seconds
+        :param save_directory The folder the server folders are created in (Default is ../../save)
+        :param clock Where the analyzer gets the time from (default is the system clock)
+        :param backend Storage backend the data is saved in, "flat" or "sqlite" (Default is flat)
         """
         self._server_save_name = server_save_name
         self._analyze_cooldown = analyze_cooldown
-        self._cooldown = 0
+        self._clock = clock
+        # Monotonic time the next analysis is due at
+        self._next_analysis = clock.monotonic()
 
-        self._map_history = pathlib.Path(
-            f"../../save/{self._server_save_name}/map_history"
-        )
-        self._save_file = pathlib.Path(
-            f"../../save/{self._server_save_name}/map_average_cache"
-        )
-        self._last_cache_save = pathlib.Path(
-            f"../../save/{self._server_save_name}/last_cache_time"
+        # Make sure the storage exists
+        self._storage = open_storage(
+            pathlib.Path(save_directory) / self._server_save_name, backend
         )
+        self._storage.create()
+        self._history = ColumnarHistory(self._storage)
 
-        self._maps = (
-            []
-        )  # This list will store the Match objects that will be returned after reading the file
+        # Map name -> Map object, starting with the results of the last analysis
+        self._maps = {
+            name: Map(name, statistics.avg_playtime, statistics.avg_player_change)
+            for name, statistics in self._storage.read_map_statistics().items()
+        }
 
-        # Make sure files exist
-        pathlib.Path(f"../../save/{self._server_save_name}").mkdir(
-            parents=True, exist_ok=True
-        )
-        self._map_history.touch()
-        self._save_file.touch()
-        self._last_cache_save.touch()
+    def get_average_playtimes(self):
+        """
+        :return: Dict of map name -> average playtime in seconds, as of the last analysis
+        """
+        return {
+            name: map_.average_playtime
+            for name, map_ in self._maps.items()
+            if map_.average_playtime is not None
+        }
+
+    def get_maps(self):
+        return self._maps
 
     def tick(self):
-        if self._cooldown > 0:
-            self._cooldown -= 1
-        else:
+        # Analyze if the next analysis is due
+        if self._clock.monotonic() >= self._next_analysis:
             self.analyze_maps()
 
+    def next_deadline(self):
+        return self._next_analysis
+
     def analyze_maps(self):
-        # Calculate average datas for each map (Average playtime, playercount, playercount change)
-        # Read each map line by line from map_history, construct a list of Match objects
-        # Then calculate the averages and write them to a file.
-        # If we run this script for 1 year then the map_history will only be around 1 MB,
-        # so we don't have to worry about loading too much stuff into memory.
-        self._cooldown = self._analyze_cooldown
+        # Calculate the statistics of each map (count, average, median, 90th percentile and standard deviation of the
+        # playtime and player change, and a playtime histogram), then write them to map_average_cache.
+        self._next_analysis = self._clock.monotonic() + self._analyze_cooldown
         print("Starting map average calculations.")
-        # Scan the file
-        with open(self._map_history, "r") as file:
-            for line in file:
-                split = line.split(" | ")
-                name = split[0]
-                playtime = int(split[2])
-                change = int(split[4])
-                # check if a Map with a matching name exists in self._maps
-                found = False
-                for map_ in self._maps:
-                    if map_.map_name == name:
-                        map_.add_playtime(playtime)
-                        map_.add_player_change(change)
-                        found = True
-
-                if not found:
-                    map_to_add = Map(name)
-                    map_to_add.add_playtime(playtime)
-                    map_to_add.add_player_change(change)
-                    self._maps.append(map_to_add)
-        # Make the calculations
-        for map_ in self._maps:
-            map_.calculate_average_playtimes()
-            map_.calculate_average_player_changes()
-        # Get what to write
-        to_write = ""
-        for map_ in self._maps:
-            name = map_.map_name
-            playtime = map_.average_playtime
-            player_change = map_.average_player_change
-            to_write += f"{name} | {playtime} | {player_change}\n"
+        statistics = compute_map_statistics(self._history.load())
+        self._maps = {entry.name: Map.from_statistics(entry) for entry in statistics}
         # Write to disk
-        with open(self._save_file, "w") as file:
-            file.write(to_write)
+        self._storage.write_map_statistics(statistics)
         print("Calculations completed")
-        with open(self._last_cache_save, "w") as file:
-            file.write(str(datetime.datetime.now()))
+        self._storage.write_last_cache_time(self._clock.now())
 
 
 if __name__ == "__main__":
-    # Example run
+    # Example run. The engine can monitor any number of servers in one process, see engine.py
+    from src.monitor.engine import MonitorEngine
+
     print(f"Started - Saving to {str(pathlib.Path('../../save/'))} ")
 
-    occmonitor = ServerMonitor("play.oc.tc", verbose=True, query_time=10)
-    occwriter = DataWriter("Overcast Community", verbose=True)
-    occanalyzer = DataAnalyzer("Overcast Community")
-
-    while True:
-        occmonitor.tick()
-        match = occmonitor.get_pending()
-        active = occmonitor.get_active()
-        timeds = occmonitor.get_timed()
-        occwriter.write_data(match, active)
-        occwriter.write_timeds(timeds)
-        occanalyzer.tick()
-        sleep(1)
+    occengine = MonitorEngine(verbose=True)
+    occengine.add_server("Overcast Community", "play.oc.tc", query_time=10)
+    asyncio.run(occengine.run())
@@ -0,0 +1,368 @@
+"""
+Inverted index of the player sessions (see sessions.py), from player name to their sessions, kept up to date by the
+DataWriter as sessions end, so the API can tell when a player was last seen and how long they played without reading
+every session.
+
+The index is three files in <save folder>/player_index/:
+    names           The name of every player, one per line. The line number is the player's id.
+    heads.bin       One int64 per player id, the number of the record of their latest session
+    sessions.bin    A header, then one fixed-width record per session, in the order they ended. Each record links to
+                    the player's previous session, and has their running session count, total and first start, so
+                    the latest record of a player sums up all their sessions.
+
+The files are only appended to, except the heads, which are changed in place after the record they point to is
+written. API workers map heads.bin and sessions.bin into memory, and only read the lines added to names since their
+last lookup, so looking a player up is one dict lookup, and reading one record per session returned.
+
+Times are the naive datetimes the monitor saves, as seconds since 1970-01-01 in that same time zone.
+
+Run this file to rebuild the index of save folders from their saved sessions.
+"""
+
+import collections
+import heapq
+import mmap
+import os
+import pathlib
+import struct
+import threading
+from src.monitor.save_folders import (
+    from_seconds,
+    get_save_folders,
+    make_parser,
+    to_seconds,
+)
+from src.monitor.storage import Session, open_storage
+
+PLAYER_INDEX_FOLDER = "player_index"
+
+# Sums of the sessions of one player. first_seen is the start of their first session, last_seen the end of their last.
+PlayerSummary = collections.namedtuple(
+    "PlayerSummary", ["name", "sessions", "total_seconds", "first_seen", "last_seen"]
+)
+
+_MAGIC = b"OAPI"
+# Magic, format version
+_HEADER = struct.Struct("<4sI")
+_VERSION = 1
+# Player id, number of their sessions up to this one, start, end, number of the record of their previous session (-1
+# if none), total seconds of their sessions up to this one, start of their first session
+_RECORD = struct.Struct("<IIqqqqq")
+_HEAD = struct.Struct("<q")
+
+
+def get_player_index_files(directory):
+    """
+    :param directory: pathlib.Path of the server's save folder
+    :return: List of pathlib.Path of the names, heads.bin and sessions.bin files
+    """
+    folder = pathlib.Path(directory) / PLAYER_INDEX_FOLDER
+    return [folder / "names", folder / "heads.bin", folder / "sessions.bin"]
+
+
+class PlayerIndex:
+    """
+    Writes the player index of one server.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        :raises ValueError: If the files aren't a player index of this version
+        """
+        names_path, heads_path, sessions_path = get_player_index_files(directory)
+        names_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self._ids = {}
+        self._names = []
+        if names_path.is_file():
+            with open(names_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break  # Only partially written before a crash
+                    self._ids[line[:-1]] = len(self._names)
+                    self._names.append(line[:-1])
+        self._names_file = open(names_path, "a", encoding="utf-8")
+        self._names_file.truncate(
+            sum(len(name.encode("utf-8")) + 1 for name in self._names)
+        )
+
+        exists = sessions_path.is_file() and sessions_path.stat().st_size > 0
+        self._sessions_file = open(sessions_path, "r+b" if exists else "w+b")
+        if exists:
+            magic, version = _HEADER.unpack(self._sessions_file.read(_HEADER.size))
+            if magic != _MAGIC or version != _VERSION:
+                raise ValueError(f"{sessions_path} is not a player index")
+        else:
+            self._sessions_file.write(_HEADER.pack(_MAGIC, _VERSION))
+            self._sessions_file.flush()
+        size = os.path.getsize(sessions_path)
+        self._records = (size - _HEADER.size) // _RECORD.size
+        # Drop a record only partially written before a crash
+        self._sessions_file.truncate(_HEADER.size + self._records * _RECORD.size)
+
+        # Player id -> (record number, session count, total seconds, first start) of their latest session
+        self._latest = []
+        self._heads_file = open(heads_path, "r+b" if heads_path.is_file() else "w+b")
+        heads = self._heads_file.read()
+        for player_id in range(len(self._names)):
+            if (player_id + 1) * _HEAD.size > len(heads):
+                # Added to names, but the crash came before their first session was linked
+                self._latest.append(None)
+                continue
+            head = _HEAD.unpack_from(heads, player_id * _HEAD.size)[0]
+            record = self._read_record(head) if 0 <= head < self._records else None
+            # Heads of players added after them fill the file with zeros, which may point to another player's record
+            if record is None or record[0] != player_id:
+                self._latest.append(None)
+            else:
+                self._latest.append((head, record[1], record[5], record[6]))
+
+    def _read_record(self, number):
+        self._sessions_file.seek(_HEADER.size + number * _RECORD.size)
+        return _RECORD.unpack(self._sessions_file.read(_RECORD.size))
+
+    @staticmethod
+    def exists(directory):
+        return get_player_index_files(directory)[2].is_file()
+
+    def get_session_count(self):
+        """
+        :return: Number of sessions in the index
+        """
+        return self._records
+
+    def _get_id(self, name):
+        player_id = self._ids.get(name)
+        if player_id is None:
+            player_id = self._ids[name] = len(self._names)
+            self._names.append(name)
+            self._latest.append(None)
+            self._names_file.write(name + "\n")
+            self._names_file.flush()
+        return player_id
+
+    def add_session(self, session: Session):
+        """
+        :param session: Ended session. The sessions of each player must be added in the order they ended.
+        """
+        player_id = self._get_id(session.player)
+        start, end = to_seconds(session.start), to_seconds(session.end)
+        latest = self._latest[player_id]
+        if latest is None:
+            previous, count, total, first = -1, 1, end - start, start
+        else:
+            previous = latest[0]
+            count, total, first = latest[1] + 1, latest[2] + end - start, latest[3]
+
+        number = self._records
+        self._sessions_file.seek(_HEADER.size + number * _RECORD.size)
+        self._sessions_file.write(
+            _RECORD.pack(player_id, count, start, end, previous, total, first)
+        )
+        self._sessions_file.flush()
+        self._records += 1
+        # The head is changed last, so readers never follow it to a record that isn't written yet
+        self._heads_file.seek(player_id * _HEAD.size)
+        self._heads_file.write(_HEAD.pack(number))
+        self._heads_file.flush()
+        self._latest[player_id] = (number, count, total, first)
+
+    def get_sessions(self, player, start=None, end=None):
+        """
+        :param player: Name of the player, as saved
+        :param start: Only return sessions that ended after this datetime
+        :param end: Only return sessions that started before this datetime
+        :return: List of Session, oldest first. Times are rounded down to the second.
+        """
+        player_id = self._ids.get(player)
+        latest = None if player_id is None else self._latest[player_id]
+        sessions = []
+        number = -1 if latest is None else latest[0]
+        # From the latest session back, they ended in order
+        while number >= 0:
+            record = self._read_record(number)
+            session = Session(player, from_seconds(record[2]), from_seconds(record[3]))
+            if start is not None and session.end <= start:
+                break
+            if end is None or session.start < end:
+                sessions.append(session)
+            number = record[4]
+        sessions.reverse()
+        return sessions
+
+    def close(self):
+        self._names_file.close()
+        self._sessions_file.close()
+        self._heads_file.close()
+
+
+def rebuild_player_index(storage):
+    """
+    Replace the player index of a server with one rebuilt from its saved sessions.
+    :param storage: Storage of the server
+    :return: The PlayerIndex, open to add more sessions
+    """
+    for path in get_player_index_files(storage.directory):
+        path.unlink(missing_ok=True)
+    index = PlayerIndex(storage.directory)
+    for session in sorted(storage.load_sessions() or [], key=lambda item: item.end):
+        index.add_session(session)
+    return index
+
+
+class PlayerIndexReader:
+    """
+    Looks players up in the player index of one server. Thread safe.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        """
+        self._names_path, self._heads_path, self._sessions_path = (
+            get_player_index_files(directory)
+        )
+        self._lock = threading.Lock()
+        self._ids = {}  # Case-folded name -> ids of every spelling of it
+        self._names = []
+        self._names_offset = 0  # Bytes of names already read
+        self._names_inode = None
+        self._heads = None
+        self._sessions = None
+
+    def _update_names(self):
+        """
+        Read the names added since the last call. Starts over if the index was rebuilt.
+        """
+        try:
+            stat = os.stat(self._names_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self._names_inode or stat.st_size < self._names_offset:
+            self._ids, self._names, self._names_offset = {}, [], 0
+            self._names_inode = stat.st_ino
+            self._close_maps()
+        if stat.st_size == self._names_offset:
+            return
+        with open(self._names_path, "rb") as file:
+            file.seek(self._names_offset)
+            data = file.read()
+        # Only complete lines, a name being written is read next time
+        data = data[: data.rfind(b"\n") + 1]
+        self._names_offset += len(data)
+        for name in data.decode("utf-8").splitlines():
+            # Minecraft names are case-insensitive, but a player can change the case of theirs. Each spelling has its own
+            # id, a lookup adds up all of them.
+            self._ids.setdefault(name.casefold(), []).append(len(self._names))
+            self._names.append(name)
+
+    @staticmethod
+    def _map(path, current, size):
+        """
+        :return: A map of the file covering at least size bytes, current if it already does, None if it's too short
+        """
+        if current is not None and len(current) >= size:
+            return current
+        if current is not None:
+            current.close()
+        try:
+            with open(path, "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):  # ValueError: the file is empty
+            return None
+        return mapped if len(mapped) >= size else None
+
+    def _close_maps(self):
+        for mapped in (self._heads, self._sessions):
+            if mapped is not None:
+                mapped.close()
+        self._heads = self._sessions = None
+
+    def _read_record(self, number):
+        end = _HEADER.size + (number + 1) * _RECORD.size
+        self._sessions = self._map(self._sessions_path, self._sessions, end)
+        if self._sessions is None:
+            return None
+        return _RECORD.unpack_from(self._sessions, end - _RECORD.size)
+
+    def _read_head(self, player_id):
+        """
+        :return: (number, record) of the player id's latest session, or None if it has none
+        """
+        end = (player_id + 1) * _HEAD.size
+        self._heads = self._map(self._heads_path, self._heads, end)
+        if self._heads is None:
+            return None
+        number = _HEAD.unpack_from(self._heads, end - _HEAD.size)[0]
+        record = self._read_record(number)
+        # A zero filled head (see PlayerIndex) can point to another player's record
+        if record is None or record[0] != player_id:
+            return None
+        return number, record
+
+    def lookup(self, name, recent=10):
+        """
+        :param name: Name of the player, in any case. The sessions of every spelling of it are returned.
+        :param recent: Most sessions to return (default is 10)
+        :return: (PlayerSummary, list of their latest sessions as Session, newest first), or None if the player has no
+            ended session. The name of the summary is the spelling of their latest session.
+        """
+        with self._lock:
+            self._update_names()
+            heads = []
+            for player_id in self._ids.get(name.casefold(), []):
+                head = self._read_head(player_id)
+                if head is not None:
+                    heads.append((head[0], head[1], player_id))
+            if not heads:
+                return None
+
+            latest = max(heads)
+            summary = PlayerSummary(
+                self._names[latest[2]],
+                sum(record[1] for _, record, _ in heads),
+                sum(record[5] for _, record, _ in heads),
+                from_seconds(min(record[6] for _, record, _ in heads)),
+                from_seconds(latest[1][3]),
+            )
+            # Records are numbered in the order the sessions ended, so the latest sessions of all spellings are the
+            # highest numbers of their chains
+            queue = [
+                (-number, record, player_id) for number, record, player_id in heads
+            ]
+            heapq.heapify(queue)
+            sessions = []
+            while queue and len(sessions) < recent:
+                _, record, player_id = heapq.heappop(queue)
+                sessions.append(
+                    Session(
+                        self._names[player_id],
+                        from_seconds(record[2]),
+                        from_seconds(record[3]),
+                    )
+                )
+                if record[4] >= 0:
+                    previous = self._read_record(record[4])
+                    if previous is not None:
+                        heapq.heappush(queue, (-record[4], previous, player_id))
+            return summary, sessions
+
+    def close(self):
+        with self._lock:
+            self._close_maps()
+
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH. Stop the monitor before rebuilding.
+    parser = make_parser(__doc__, "rebuild")
+    args = parser.parse_args()
+
+    directories = get_save_folders(args)
+
+    for directory in directories:
+        index = rebuild_player_index(open_storage(directory))
+        print(
+            f"Rebuilt the player index of {directory.name}, {index.get_session_count()} sessions."
+        )
+        index.close()
@@ -0,0 +1,59 @@
+import array
+
+
+class RingBuffer:
+    """
+    Fixed-size columns of numbers, kept in typed arrays. Once full, each new row overwrites the oldest one.
+
+    Rows are addressed by their logical index: 0 is the oldest row kept, size - 1 the newest.
+    """
+
+    def __init__(self, capacity, typecodes):
+        """
+        :param capacity: Most rows kept
+        :param typecodes: array typecode of each column, e.g. "dii" for a float and two ints
+        """
+        self.capacity = capacity
+        self.columns = [
+            array.array(code, bytes(array.array(code).itemsize * capacity))
+            for code in typecodes
+        ]
+        self.size = 0
+        self._next = 0  # Physical index the next row is written to
+
+    def append(self, *values):
+        for column, value in zip(self.columns, values):
+            column[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def get_row(self, index):
+        """
+        :param index: Logical index of the row
+        :return: Tuple of the row's values
+        """
+        physical = (self._next - self.size + index) % self.capacity
+        return tuple(column[physical] for column in self.columns)
+
+    def get(self, column, index):
+        return self.columns[column][(self._next - self.size + index) % self.capacity]
+
+    def bisect_left(self, column, value):
+        """
+        :param column: Column to search, its values must be sorted from the oldest row to the newest
+        :return: Logical index of the first row whose value in the column is >= value
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.get(column, middle) < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_memory_size(self):
+        """
+        :return: Bytes used by the columns
+        """
+        return sum(column.itemsize * len(column) for column in self.columns)
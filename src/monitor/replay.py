@@ -0,0 +1,331 @@
+"""
+Replays a server's timeline of maps and players from a local Server List Ping server (see fake_server.py), and
+monitors it with a MonitorEngine on a VirtualClock, so hours of a server can be simulated in minutes.
+
+The timeline is either synthetic, or recorded in a save folder. While the replay runs, a thread reads the results
+through the API's data layer, so the whole monitor -> writer -> analyzer -> API pipeline is exercised. At the end, the
+map changes and events the monitor detected are compared with the timeline, and the throughput is printed.
+
+Run from src/monitor, with the repository root on PYTHONPATH:
+    python replay.py --hours 6 --speed 500
+    python replay.py --from-save "../../save/Overcast Community" --hours 24 --speed 1000
+"""
+
+import argparse
+import asyncio
+import bisect
+import datetime
+import pathlib
+import random
+import tempfile
+import threading
+import time
+from src.monitor.fake_server import FakeSLPServer
+from src.monitor.scheduler import VirtualClock
+
+
+class Timeline:
+    """
+    What a server advertised over time: the map (a name containing § is an event) and the players online.
+    Offsets are seconds since the start of the timeline.
+    """
+
+    def __init__(self, maps, samples, duration, start=None):
+        """
+        :param maps: List of (offset, map name), sorted by offset. The first one should be at offset 0.
+        :param samples: List of (offset, playercount, list of player names), sorted by offset
+        :param duration: Length of the timeline in seconds
+        :param start: datetime the timeline starts at, if it was recorded
+        """
+        self.maps = maps
+        self.samples = samples
+        self.duration = duration
+        self.start = start
+        self._map_offsets = [offset for offset, _ in maps]
+        self._sample_offsets = [offset for offset, _, _ in samples]
+
+    def get_map(self, offset):
+        index = bisect.bisect_right(self._map_offsets, offset) - 1
+        return self.maps[max(index, 0)][1]
+
+    def get_players(self, offset):
+        """
+        :return: (playercount, list of player names) at the offset
+        """
+        index = bisect.bisect_right(self._sample_offsets, offset) - 1
+        if index < 0:
+            return 0, []
+        return self.samples[index][1], self.samples[index][2]
+
+    def get_map_changes(self, end=None):
+        """
+        :param end: Only count changes before this offset (default is the whole timeline)
+        :return: (number of map changes, number of them to an event)
+        """
+        changes = events = 0
+        for offset, name in self.maps[1:]:
+            if end is not None and offset >= end:
+                break
+            changes += 1
+            if "§" in name:
+                events += 1
+        return changes, events
+
+    @classmethod
+    def synthetic(
+        cls,
+        duration,
+        map_count=40,
+        event_chance=0.05,
+        sample_interval=10,
+        players=500,
+        seed=0,
+    ):
+        """
+        :param duration: Length of the timeline in seconds
+        :param map_count: Number of different maps (default is 40)
+        :param event_chance: Chance of each match being an event (default is 0.05)
+        :param sample_interval: Seconds between changes of the players (default is 10)
+        :param players: Number of different players (default is 500)
+        :param seed: Seed of the random timeline (default is 0)
+        """
+        rng = random.Random(seed)
+        names = [f"Map {index}" for index in range(map_count)]
+        playtimes = {name: rng.uniform(300, 1800) for name in names}
+        maps = []
+        offset = 0
+        while offset < duration:
+            if rng.random() < event_chance:
+                name = f"§dEvent {rng.randint(1, 5)}"
+                playtime = rng.uniform(600, 1200)
+            else:
+                name = rng.choice(names)
+                playtime = max(60.0, rng.gauss(playtimes[name], 120))
+            if maps and maps[-1][1] == name:
+                continue  # The monitor can't see a map change to the same map
+            maps.append((offset, name))
+            offset += playtime
+
+        player_names = [f"Player_{index}" for index in range(players)]
+        online = set()
+        samples = []
+        for offset in range(0, int(duration), sample_interval):
+            target = int(60 + 40 * rng.random())
+            while len(online) < target:
+                online.add(rng.choice(player_names))
+            while len(online) > target:
+                online.discard(rng.choice(sorted(online)))
+            samples.append((offset, len(online), rng.sample(sorted(online), 12)))
+        return cls(maps, samples, duration)
+
+    @classmethod
+    def from_storage(cls, storage, start=None, end=None):
+        """
+        Build the timeline a server had, from what the monitor saved of it.
+        :param storage: Storage of the server's save folder
+        :param start: datetime to start at (default is the first saved match)
+        :param end: datetime to end at (default is the end of the last saved match)
+        """
+        maps = []
+        first = None
+        last_end = None
+        for entry in storage.query_map_history(None, start, end):
+            if entry.name == "SYS_QUERYERROR" or entry.name == "SYS_INIT":
+                continue
+            if first is None:
+                first = start or entry.start_date
+            name = "§dEvent" if entry.name == "SYS_EVENT" else entry.name
+            offset = (entry.start_date - first).total_seconds()
+            if maps and maps[-1][1] == name:
+                continue
+            maps.append((max(offset, 0), name))
+            last_end = offset + entry.playtime
+        if first is None:
+            raise ValueError("No matches saved in that time range")
+
+        duration = (end - first).total_seconds() if end is not None else last_end
+        samples = [
+            ((sample.time - first).total_seconds(), sample.playercount, sample.players)
+            for sample in storage.iter_player_samples(
+                first, first + datetime.timedelta(seconds=duration)
+            )
+        ]
+        return cls(maps, samples, duration, first)
+
+
+class ReplayServer(FakeSLPServer):
+    """
+    A FakeSLPServer advertising what a Timeline had at the current time of a clock.
+    """
+
+    def __init__(self, timeline: Timeline, clock, host="127.0.0.1", port=0):
+        """
+        :param timeline: Timeline to replay, it starts when start() is called
+        :param clock: Clock the timeline is replayed on, usually a VirtualClock
+        """
+        super().__init__(timeline.get_map(0), [], host, port)
+        self._timeline = timeline
+        self._clock = clock
+        self._start = None
+
+    async def start(self):
+        self._start = self._clock.monotonic()
+        await super().start()
+
+    def get_status(self):
+        offset = self._clock.monotonic() - self._start
+        self.map_name = self._timeline.get_map(offset)
+        self.playercount, self.players = self._timeline.get_players(offset)
+        return super().get_status()
+
+
+def _read_api(directories, stop, counts):
+    """
+    Read every server through the API's data layer until stop is set, like API workers would.
+    """
+    from src.api import data_load
+
+    while not stop.is_set():
+        for directory in directories:
+            if not (directory / "map_data").is_file():
+                continue
+            data_load.load_live_state(directory)
+            data_load.load_server_data(directory)
+            data_load.load_map_data(directory, "Map 0")
+            counts["reads"] += 3
+
+
+async def run_replay(
+    timeline, speed=100, query_time=10, server_count=1, adaptive=False
+):
+    """
+    Replay a timeline on server_count servers at once, and print how well the monitor detected it.
+    :param timeline: Timeline to replay
+    :param speed: How many times faster than real time to run (default is 100)
+    :param query_time: Time between each query in (virtual) seconds (default is 10)
+    :param server_count: Number of servers replaying the timeline (default is 1)
+    :param adaptive: Use adaptive query cadence, see ServerMonitor (default is False)
+    :return: Dict with the results
+    """
+    from src.monitor.engine import MonitorEngine
+
+    clock = VirtualClock(speed, timeline.start)
+    servers = [ReplayServer(timeline, clock) for _ in range(server_count)]
+    for server in servers:
+        await server.start()
+
+    with tempfile.TemporaryDirectory() as save_directory:
+        engine = MonitorEngine(
+            query_timeout=2, save_directory=save_directory, clock=clock
+        )
+        for index, server in enumerate(servers):
+            engine.add_server(
+                f"Replay {index}",
+                "127.0.0.1",
+                port=server.port,
+                query_time=query_time,
+                adaptive=adaptive,
+            )
+
+        stop = threading.Event()
+        counts = {"reads": 0}
+        directories = [
+            pathlib.Path(save_directory) / f"Replay {index}"
+            for index in range(server_count)
+        ]
+        reader = threading.Thread(target=_read_api, args=(directories, stop, counts))
+        reader.start()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        asyncio.get_running_loop().call_later(
+            clock.real_seconds(timeline.duration), engine.stop
+        )
+        await engine.run()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        simulated = clock.monotonic()
+        stop.set()
+        reader.join()
+
+        first = engine.get_servers()[0]
+        history = list(first.writer.get_storage().query_map_history())
+        stats = first.monitor.get_detection_stats()
+    for server in servers:
+        await server.close()
+
+    # The first saved match is SYS_INIT, ended by the first query. A match is saved as SYS_EVENT when the map after it
+    # is an event, so the other matches line up with the timeline's map changes.
+    detected = len(history) - 1
+    detected_events = sum(1 for entry in history[1:] if entry.name == "SYS_EVENT")
+    expected, expected_events = timeline.get_map_changes(simulated)
+    queries = sum(
+        server.monitor.get_detection_stats()["queries"]
+        for server in engine.get_servers()
+    )
+    results = {
+        "simulated_seconds": simulated,
+        "wall_seconds": wall,
+        "speed": simulated / wall,
+        "queries_per_second": queries / wall,
+        "map_changes": expected,
+        "map_changes_detected": detected,
+        "events": expected_events,
+        "events_detected": detected_events,
+        "avg_detection_latency": stats["avg_detection_latency"],
+        "api_reads_per_second": counts["reads"] / wall,
+        "cpu_seconds": cpu,
+    }
+
+    print(
+        f"Replayed {simulated / 3600:.1f} hours on {server_count} servers in {wall:.1f}s ({simulated / wall:.0f}x)"
+    )
+    print(f"Queries: {queries} ({queries / wall:.1f}/s), CPU time: {cpu:.1f}s")
+    print(
+        f"Map changes detected: {detected} of {expected}, events: {detected_events} of {expected_events}"
+    )
+    if stats["avg_detection_latency"] is not None:
+        print(f"Average detection latency: {stats['avg_detection_latency']:.1f}s")
+    print(f"API reads: {counts['reads']} ({counts['reads'] / wall:.0f}/s)")
+    return results
+
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--hours", type=float, default=6, help="Hours of timeline to replay"
+    )
+    parser.add_argument("--speed", type=float, default=500)
+    parser.add_argument("--query-time", type=float, default=10)
+    parser.add_argument("--servers", type=int, default=1)
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument(
+        "--from-save",
+        type=pathlib.Path,
+        help="Save folder to replay the recorded timeline of",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.from_save is not None:
+        from src.monitor.storage import open_storage
+
+        replay_storage = open_storage(args.from_save)
+        first_match = next(replay_storage.query_map_history(), None)
+        if first_match is None:
+            raise SystemExit(f"{args.from_save} has no saved matches")
+        replay_timeline = Timeline.from_storage(
+            replay_storage,
+            first_match.start_date,
+            first_match.start_date + datetime.timedelta(hours=args.hours),
+        )
+    else:
+        replay_timeline = Timeline.synthetic(args.hours * 3600, seed=args.seed)
+    asyncio.run(
+        run_replay(
+            replay_timeline, args.speed, args.query_time, args.servers, args.adaptive
+        )
+    )
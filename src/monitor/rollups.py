@@ -0,0 +1,327 @@
+"""
+Minute, hour and day rollups of a server's player count (minimum, maximum and mean of the samples in each bucket), kept
+up to date by the DataWriter as samples arrive, so the API can chart any time range without scanning player_history.
+
+Each resolution is one file in <save folder>/player_rollups/: a header with the start of the first bucket, then one
+fixed-width record per bucket, with no gaps (buckets without samples have a count of 0). The record of any time is at a
+computed offset, so a time range is read with one seek, in O(buckets).
+
+Times are the naive datetimes the monitor saves, buckets start at multiples of their width since 1970-01-01 in that
+same time zone.
+
+Run this file to rebuild the rollups of save folders from their player history, e.g. after they were deleted.
+"""
+
+import datetime
+import itertools
+import math
+import os
+import pathlib
+import struct
+from src.monitor.save_folders import (
+    EPOCH,
+    from_seconds,
+    get_save_folders,
+    make_parser,
+    to_seconds,
+)
+from src.monitor.storage import open_storage
+
+ROLLUPS_FOLDER = "player_rollups"
+# Name -> width of the buckets in seconds
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+_MAGIC = b"OARU"
+# Magic, bucket width in seconds, start of the first bucket
+_HEADER = struct.Struct("<4sIq")
+# Minimum, maximum, sum and count of the player counts
+_RECORD = struct.Struct("<iiqI")
+
+
+class _RollupFile:
+    """
+    The rollup of one resolution, open for writing. The bucket samples are added to is only written by flush(), or
+    when a sample of a later bucket arrives.
+    """
+
+    def __init__(self, path, width):
+        self._path = path
+        self._width = width
+        self._first = None  # Start of the first bucket in seconds
+        self._current = None  # Index of the bucket samples are added to
+        self._record = None  # [min, max, sum, count] of the current bucket
+        self._dirty = False
+
+        exists = path.is_file()
+        self._file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            header = self._file.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                magic, width, first = _HEADER.unpack(header)
+                if magic != _MAGIC or width != self._width:
+                    raise ValueError(f"{path} is not a rollup of {self._width}s")
+                self._first = first
+                records = (os.path.getsize(path) - _HEADER.size) // _RECORD.size
+                if records > 0:
+                    self._current = records - 1
+                    self._record = list(self._read_record(self._current))
+
+    def _read_record(self, index):
+        self._file.seek(_HEADER.size + index * _RECORD.size)
+        return _RECORD.unpack(self._file.read(_RECORD.size))
+
+    def _write_record(self, index, record):
+        self._file.seek(_HEADER.size + index * _RECORD.size)
+        self._file.write(_RECORD.pack(*record))
+
+    def add(self, seconds, playercount, count=1):
+        bucket = seconds // self._width * self._width
+        if self._first is None:
+            self._first = bucket
+            self._file.seek(0)
+            self._file.write(_HEADER.pack(_MAGIC, self._width, bucket))
+        if bucket < self._first:
+            return  # Before the whole rollup, only happens if the clock was set back a lot
+        index = (bucket - self._first) // self._width
+
+        if self._current is not None and index < self._current:
+            # The clock was set back, merge the sample into the already written bucket
+            record = list(self._read_record(index))
+            _merge(record, playercount, count)
+            self._write_record(index, record)
+            self._file.flush()
+            return
+        if index != self._current:
+            self.flush()
+            # Buckets skipped over (the monitor wasn't running) are left as zeros, which is an empty record
+            self._file.truncate(_HEADER.size + index * _RECORD.size)
+            self._current = index
+            self._record = [0, 0, 0, 0]
+        _merge(self._record, playercount, count)
+        self._dirty = True
+
+    def flush(self):
+        if self._dirty:
+            self._write_record(self._current, self._record)
+            self._file.flush()
+            self._dirty = False
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def _merge(record, playercount, count=1):
+    """
+    Add count samples of the same player count to a [min, max, sum, count] record.
+    """
+    if record[3] == 0:
+        record[0] = record[1] = playercount
+    else:
+        record[0] = min(record[0], playercount)
+        record[1] = max(record[1], playercount)
+    record[2] += playercount * count
+    record[3] += count
+
+
+class PlayerRollups:
+    """
+    Writes the rollups of every resolution of one server.
+    """
+
+    def __init__(self, directory):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        """
+        folder = pathlib.Path(directory) / ROLLUPS_FOLDER
+        folder.mkdir(parents=True, exist_ok=True)
+        self._files = [
+            _RollupFile(folder / f"{name}.bin", width)
+            for name, width in RESOLUTIONS.items()
+        ]
+
+    @staticmethod
+    def exists(directory):
+        return (pathlib.Path(directory) / ROLLUPS_FOLDER).is_dir()
+
+    def add_sample(self, time, playercount, count=1):
+        """
+        :param time: datetime the sample was taken at
+        :param playercount: Number of players online
+        :param count: Number of samples of that player count taken in the same minute (default is 1)
+        """
+        seconds = to_seconds(time)
+        for file in self._files:
+            file.add(seconds, playercount, count)
+
+    def flush(self):
+        """
+        Write the buckets samples are being added to, so readers see them.
+        """
+        for file in self._files:
+            file.flush()
+
+    def close(self):
+        for file in self._files:
+            file.close()
+
+
+def _iter_queries(samples, query_time, keyframe_interval, end):
+    """
+    The player history only has the samples where something changed, and keyframes (see FlatFileStorage). Every
+    query made after a sample had its player count, until the next sample. A sample is followed by another within
+    keyframe_interval seconds while the monitor runs, so the monitor stopped if there is none.
+    :param samples: Iterator of PlayerSample, oldest first
+    :param query_time: Time between the monitor's queries in seconds
+    :param keyframe_interval: timedelta, the longest time between two samples while the monitor runs
+    :param end: datetime the last sample's player count is carried forward to at most
+    :return: Iterator of (minute start as a datetime, playercount, number of queries in that minute)
+    """
+    minute = RESOLUTIONS["minute"]
+    previous = None
+    for sample in itertools.chain(samples, [None]):
+        if previous is not None:
+            start, playercount = previous
+            stop = min(
+                start + keyframe_interval,
+                (end if sample is None else sample.time) - EPOCH,
+            ).total_seconds()
+            start = start.total_seconds()
+            # Queries at start, start + query_time, ... before stop. At least the one of the sample itself.
+            queries = max(1, math.ceil((stop - start) / query_time))
+            first = 0
+            while first < queries:
+                bucket = (start + first * query_time) // minute * minute
+                # The first query of the next minute
+                last = min(queries, math.ceil((bucket + minute - start) / query_time))
+                yield from_seconds(bucket), playercount, last - first
+                first = last
+        if sample is not None:
+            previous = (sample.time - EPOCH, sample.playercount)
+
+
+def rebuild_rollups(storage, query_time=30, keyframe_interval=3600, end=None):
+    """
+    Replace the rollups of a server with ones rebuilt from its player history. Unchanged samples aren't saved, so
+    the player count of each saved one is counted once per query until the next, like the DataWriter counts them.
+    :param storage: Storage of the server
+    :param query_time: Time between the monitor's queries in seconds (default is 30)
+    :param keyframe_interval: The storage's keyframe interval in seconds, longer gaps between samples are times the
+        monitor wasn't running (default is 3600, see FlatFileStorage)
+    :param end: datetime the last sample is counted until at most (default is now)
+    :return: The PlayerRollups, open to add more samples
+    """
+    folder = storage.directory / ROLLUPS_FOLDER
+    for name in RESOLUTIONS:
+        (folder / f"{name}.bin").unlink(missing_ok=True)
+    rollups = PlayerRollups(storage.directory)
+    for time, playercount, count in _iter_queries(
+        storage.iter_player_samples(),
+        query_time,
+        datetime.timedelta(seconds=keyframe_interval),
+        datetime.datetime.now() if end is None else end,
+    ):
+        rollups.add_sample(time, playercount, count)
+    rollups.flush()
+    return rollups
+
+
+def get_rollup_files(directory):
+    """
+    :param directory: pathlib.Path of the server's save folder
+    :return: List of pathlib.Path of the rollup of every resolution
+    """
+    return [
+        pathlib.Path(directory) / ROLLUPS_FOLDER / f"{name}.bin" for name in RESOLUTIONS
+    ]
+
+
+def read_rollup(directory, resolution, start, end):
+    """
+    :param directory: pathlib.Path of the server's save folder
+    :param resolution: Name of the rollup, see RESOLUTIONS
+    :param start: datetime, the bucket containing it is the first returned
+    :param end: datetime, only buckets starting before it are returned
+    :return: List of (bucket start in seconds, min, max, sum, count), only buckets with samples
+    """
+    width = RESOLUTIONS[resolution]
+    path = pathlib.Path(directory) / ROLLUPS_FOLDER / f"{resolution}.bin"
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with file:
+        header = file.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return []
+        first = _HEADER.unpack(header)[2]
+        records = (os.path.getsize(path) - _HEADER.size) // _RECORD.size
+        start_index = max(0, (to_seconds(start) // width * width - first) // width)
+        # Index of the first bucket starting at or after end
+        end_index = min(records, -((first - to_seconds(end)) // width))
+        if end_index <= start_index:
+            return []
+        file.seek(_HEADER.size + start_index * _RECORD.size)
+        data = file.read((end_index - start_index) * _RECORD.size)
+    buckets = []
+    # A record being written by the monitor can be cut short, only whole ones are read
+    for offset, record in enumerate(
+        _RECORD.iter_unpack(data[: len(data) - len(data) % _RECORD.size])
+    ):
+        if record[3] > 0:
+            buckets.append((first + (start_index + offset) * width, *record))
+    return buckets
+
+
+def query_player_counts(directory, start, end, width):
+    """
+    The player count between two times, in buckets of any multiple of a minute. They are merged from the coarsest
+    rollup whose width divides the bucket width, so the number of records read is as low as possible.
+    :param directory: pathlib.Path of the server's save folder
+    :param start: datetime to start at, rounded down to the bucket width
+    :param end: datetime to end at
+    :param width: Width of the buckets in seconds, a multiple of 60
+    :return: List of (bucket start datetime, min, max, mean), only buckets with samples
+    """
+    if width <= 0 or width % RESOLUTIONS["minute"] != 0:
+        raise ValueError("The width must be a positive multiple of 60 seconds")
+    resolution = max(
+        (name for name, seconds in RESOLUTIONS.items() if width % seconds == 0),
+        key=RESOLUTIONS.get,
+    )
+    start = from_seconds(to_seconds(start) // width * width)
+    merged = []
+    for bucket, minimum, maximum, total, count in read_rollup(
+        directory, resolution, start, end
+    ):
+        bucket = bucket // width * width
+        if merged and merged[-1][0] == bucket:
+            last = merged[-1]
+            last[1] = min(last[1], minimum)
+            last[2] = max(last[2], maximum)
+            last[3] += total
+            last[4] += count
+        else:
+            merged.append([bucket, minimum, maximum, total, count])
+    return [
+        (from_seconds(bucket), minimum, maximum, total / count)
+        for bucket, minimum, maximum, total, count in merged
+    ]
+
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH
+    parser = make_parser(__doc__, "rebuild")
+    parser.add_argument(
+        "--query-time",
+        type=float,
+        default=30,
+        help="Time between the monitor's queries in seconds (default is 30)",
+    )
+    args = parser.parse_args()
+
+    directories = get_save_folders(args)
+
+    for directory in directories:
+        rebuild_rollups(open_storage(directory), args.query_time).close()
+        print(f"Rebuilt the player count rollups of {directory.name}.")
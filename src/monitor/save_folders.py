@@ -0,0 +1,55 @@
+"""
+Helpers shared by the files built in save folders (rollups.py, player_index.py) and the tools rebuilding them
+(sessions.py, rollups.py, player_index.py, migrate.py).
+"""
+
+import argparse
+import calendar
+import datetime
+import pathlib
+
+# Times are the naive datetimes the monitor saves, stored as seconds since 1970-01-01 in that same time zone
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_seconds(date):
+    """
+    :param date: Naive datetime, as saved by the monitor
+    :return: Whole seconds since EPOCH
+    """
+    return calendar.timegm(date.timetuple())
+
+
+def from_seconds(seconds):
+    """
+    :param seconds: Seconds since EPOCH
+    :return: Naive datetime
+    """
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+def make_parser(description, action):
+    """
+    :param description: Description of the tool, shown by --help
+    :param action: What the tool does to each folder, e.g. "rebuild"
+    :return: argparse.ArgumentParser with the save folder arguments, read them with get_save_folders()
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "servers",
+        nargs="*",
+        help=f"Names of the save folders to {action} (default is every folder)",
+    )
+    parser.add_argument("--save-directory", default="../../save")
+    return parser
+
+
+def get_save_folders(args):
+    """
+    :param args: Parsed arguments of a parser from make_parser()
+    :return: List of pathlib.Path of the save folders to work on
+    """
+    save_directory = pathlib.Path(args.save_directory)
+    if args.servers:
+        return [save_directory / name for name in args.servers]
+    return sorted(path for path in save_directory.iterdir() if path.is_dir())
@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import time
+from src.monitor.metrics import NULL_METRICS
+
+
+class SystemClock:
+    """
+    Where the monitor gets the time from. monotonic() is used for deadlines and durations, now() for timestamps that
+    get saved.
+    """
+
+    @staticmethod
+    def monotonic():
+        return time.monotonic()
+
+    @staticmethod
+    def now():
+        return datetime.datetime.now()
+
+    @staticmethod
+    def real_seconds(seconds):
+        """
+        :param seconds: A duration on this clock
+        :return: How long that duration takes in real time
+        """
+        return seconds
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class VirtualClock:
+    """
+    A clock that runs speed times faster than real time, used to replay a server's timeline quickly (see replay.py).
+    Its monotonic time starts at 0.
+    """
+
+    def __init__(self, speed=100, start=None):
+        """
+        :param speed: How many seconds pass on this clock in one real second (default is 100)
+        :param start: datetime now() returns at the start (default is the current time)
+        """
+        self.speed = speed
+        self._start = start if start is not None else datetime.datetime.now()
+        self._real_start = time.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self._real_start) * self.speed
+
+    def now(self):
+        return self._start + datetime.timedelta(seconds=self.monotonic())
+
+    def real_seconds(self, seconds):
+        return seconds / self.speed
+
+
+class Job:
+    """
+    Something the DeadlineScheduler runs over and over. After every run, it is scheduled again at next_deadline().
+    """
+
+    def __init__(self, name, next_deadline, run):
+        """
+        :param name: Name of the job, used in error messages
+        :param next_deadline: Function returning the monotonic time the job should run at next
+        :param run: Coroutine function to run when the deadline is reached
+        """
+        self.name = name
+        self.next_deadline = next_deadline
+        self.run = run
+
+        self.runs = 0
+        self.lateness = 0  # How many seconds after its deadline the job last started
+        self.metrics_labels = {"job": name}
+
+
+class PeriodicJob(Job):
+    """
+    A Job that runs every interval seconds. Each deadline is one interval after the previous one, so they don't drift.
+    """
+
+    def __init__(self, name, interval, run, clock=SYSTEM_CLOCK):
+        """
+        :param name: Name of the job, used in error messages
+        :param interval: Time between runs in seconds
+        :param run: Coroutine function to run
+        :param clock: Where the deadlines are read from (default is the system clock)
+        """
+        super().__init__(name, self._get_next_deadline, run)
+        self._interval = interval
+        self._clock = clock
+        self._deadline = clock.monotonic() + interval
+
+    def _get_next_deadline(self):
+        now = self._clock.monotonic()
+        if self._deadline <= now:
+            # Skip the runs we missed instead of catching up on them
+            self._deadline += (
+                (now - self._deadline) // self._interval + 1
+            ) * self._interval
+        return self._deadline
+
+
+class DeadlineScheduler:
+    """
+    Runs Jobs at absolute deadlines on a monotonic clock, in one asyncio event loop.
+
+    The scheduler sleeps until the earliest deadline, so nothing runs while no work is due. Each job run gets its own
+    task, so a slow job only delays itself.
+    """
+
+    def __init__(self, clock=SYSTEM_CLOCK, metrics=NULL_METRICS):
+        """
+        :param clock: Where the deadlines are read from (default is the system clock)
+        :param metrics: Where the lateness and failures of jobs are counted (default is nowhere, see metrics.py)
+        """
+        self._clock = clock
+        self._metrics = metrics
+        self._queue = []  # Heap of (deadline, order, job)
+        self._order = itertools.count()
+        self._wakeup = None
+        self._running = set()
+        self._stopped = False
+
+    def add_job(self, job: Job):
+        heapq.heappush(self._queue, (job.next_deadline(), next(self._order), job))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stop(self):
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run_job(self, job: Job, deadline):
+        job.lateness = max(0, self._clock.monotonic() - deadline)
+        self._metrics.observe("job_lateness_seconds", job.lateness, job.metrics_labels)
+        try:
+            await job.run()
+        except Exception as ex:  # skipcq: PYL-W0703 - Don't stop the other jobs
+            print(f"[ERROR] Job {job.name} failed: {ex}")
+            self._metrics.inc("job_failures_total", job.metrics_labels)
+        job.runs += 1
+        if not self._stopped:
+            self.add_job(job)
+
+    async def run(self):
+        """
+        Run the jobs until stop() is called. Jobs that are still running at that point are cancelled.
+        """
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        try:
+            while not self._stopped:
+                if self._queue:
+                    delay = self._queue[0][0] - self._clock.monotonic()
+                    if delay <= 0:
+                        deadline, _, job = heapq.heappop(self._queue)
+                        task = asyncio.create_task(self._run_job(job, deadline))
+                        self._running.add(task)
+                        task.add_done_callback(self._running.discard)
+                        continue
+                    timeout = self._clock.real_seconds(delay)
+                else:
+                    timeout = None
+                # Sleep until the earliest deadline, or until a job is (re)added
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self._running):
+                task.cancel()
+            await asyncio.gather(*self._running, return_exceptions=True)
@@ -0,0 +1,344 @@
+import bisect
+import datetime
+import gzip
+import io
+import json
+import os
+import pathlib
+import shutil
+from src.monitor.buffered_writer import BufferedAppender, WriteStats
+
+MANIFEST_FILE = "manifest.json"
+# Segment the lines of a legacy single file log are imported into. Sorts before the segments of every day.
+LEGACY_KEY = "0000-00-00-legacy"
+# Closed segments are compressed in blocks of about this many bytes of lines, each a separate gzip member
+BLOCK_SIZE = 65536
+
+
+def find_line_offset(file, time, timestamp_of):
+    """
+    Binary search a file whose lines are sorted by time, by seeking to byte offsets.
+    :param file: The file, opened in binary mode
+    :param time: datetime to search for
+    :param timestamp_of: Function returning the datetime of a line
+    :return: Offset of the first complete line at or after time, the end of the complete lines if there is none
+    """
+
+    def is_at_or_after(offset):
+        # Whether the first line starting at or after offset is at or after time
+        file.seek(max(offset - 1, 0))
+        if offset > 0:
+            file.readline()  # Skip to the start of the next line
+        line = file.readline()
+        # A partially written last line counts as the end of the file
+        return not line.endswith(b"\n") or timestamp_of(line.decode("utf-8")) >= time
+
+    low, high = 0, file.seek(0, os.SEEK_END)
+    while low < high:
+        middle = (low + high) // 2
+        if is_at_or_after(middle):
+            high = middle
+        else:
+            low = middle + 1
+    file.seek(max(low - 1, 0))
+    if low > 0:
+        file.readline()
+    return file.tell()
+
+
+def get_legacy_backup(legacy_file):
+    """
+    :param legacy_file: pathlib.Path of the single file a log was kept in before
+    :return: pathlib.Path it is kept at once imported into segments
+    """
+    return legacy_file.with_name(legacy_file.name + ".legacy")
+
+
+class _OffsetGzipFile(gzip.GzipFile):
+    """
+    Decompresses a file from a gzip member starting at an offset, to its end. Closes the file when closed.
+    """
+
+    def __init__(self, path, offset=0):
+        self._raw_file = open(path, "rb")
+        self._raw_file.seek(offset)
+        super().__init__(fileobj=self._raw_file, mode="rb")
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._raw_file.close()
+
+
+class SegmentedLog:
+    """
+    An append-only text log, split into one segment per day.
+
+    The segment of the current day is a plain text file. When a line for a later day is appended, it is closed:
+    gzip compressed, and its time range is recorded in the manifest. Readers use the manifest to skip every segment
+    outside the time range they want, and stream the rest one line at a time.
+
+    Lines are expected in chronological order, so readers can skip to a time: the open segment by a binary search on
+    byte offsets, and closed segments with their block index. Closed segments are compressed in blocks of about
+    BLOCK_SIZE bytes, each a separate gzip member (so the whole file is still one valid gzip file), and the index lists
+    the time of the first line and the offset of each block.
+
+    Layout in the log's folder:
+        manifest.json           The closed segments, oldest first, with their time ranges
+        <YYYY-MM-DD>.log        The open segment
+        <YYYY-MM-DD>.log.gz     Closed segments
+        <YYYY-MM-DD>.log.idx    Block index of each closed segment, "<time of the first line> <offset>" per block.
+                                Segments closed before the index existed have none, and are read from the start.
+    """
+
+    def __init__(self, directory, timestamp_of, legacy_file=None, appender=None):
+        """
+        :param directory: pathlib.Path of the folder the segments are kept in
+        :param timestamp_of: Function returning the datetime of a line
+        :param legacy_file: pathlib.Path of the single file the log was kept in before, if any. It is read as the
+            oldest segment until import_legacy_file() is called, which renames it (see get_legacy_backup).
+        :param appender: BufferedAppender to write the open segment with (default is one that writes right away)
+        """
+        self._directory = pathlib.Path(directory)
+        self._timestamp_of = timestamp_of
+        self._legacy_file = legacy_file
+        self._manifest_file = self._directory / MANIFEST_FILE
+        if appender is None:
+            appender = BufferedAppender(None, max_bytes=0, stats=WriteStats())
+        self._appender = appender
+        self._open_key = None  # Day of the open segment we are writing to
+
+    def create(self):
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self.import_legacy_file()
+        # Close every segment left open from before, except the newest one
+        open_keys = self._get_open_keys()
+        for key in open_keys[:-1]:
+            self._close_segment(key)
+        if open_keys:
+            self._open_key = open_keys[-1]
+            self._appender.set_path(self._segment_path(self._open_key))
+
+    def import_legacy_file(self):
+        """
+        Copy the lines of the legacy single file into a closed segment. The file itself is kept, renamed to
+        <name>.legacy, so older versions and other readers of it can still be pointed to it.
+        """
+        if self._legacy_file is None or not self._legacy_file.is_file():
+            return
+        if self._legacy_file.stat().st_size > 0:
+            shutil.copyfile(self._legacy_file, self._segment_path(LEGACY_KEY))
+            self._close_segment(LEGACY_KEY)
+        # Renamed last, an import interrupted before is done again from the start
+        os.replace(self._legacy_file, get_legacy_backup(self._legacy_file))
+
+    def _segment_path(self, key, compressed=False):
+        return self._directory / (f"{key}.log.gz" if compressed else f"{key}.log")
+
+    def _index_path(self, key):
+        return self._directory / f"{key}.log.idx"
+
+    def _get_open_keys(self):
+        if not self._directory.is_dir():
+            return []
+        return sorted(path.name[:-4] for path in self._directory.glob("*.log"))
+
+    def read_manifest(self):
+        """
+        :return: List of dicts with the key, start, end and line count of each closed segment, oldest first
+        """
+        if not self._manifest_file.is_file():
+            return []
+        with open(self._manifest_file, "r") as file:
+            return json.load(file)["segments"]
+
+    def _close_segment(self, key):
+        """
+        Compress a segment and add it to the manifest. Safe to run again if it was interrupted.
+        """
+        path = self._segment_path(key)
+        start = end = None
+        lines = 0
+        with open(path, "r") as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    break  # Only partially written before a crash
+                time = self._timestamp_of(line).isoformat()
+                start = time if start is None or time < start else start
+                end = time if end is None or time > end else end
+                lines += 1
+
+        compressed = self._segment_path(key, compressed=True)
+        temp_file = compressed.with_name(compressed.name + ".tmp")
+        index = []
+        with open(path, "rb") as source, open(temp_file, "wb") as destination:
+            while True:
+                # Whole lines, so every block starts with one
+                block = source.read(BLOCK_SIZE)
+                block += source.readline()
+                if not block:
+                    break
+                first_line = block[: block.find(b"\n") + 1]
+                if first_line:
+                    time = self._timestamp_of(first_line.decode("utf-8")).isoformat()
+                    index.append(f"{time} {destination.tell()}\n")
+                destination.write(gzip.compress(block, mtime=0))
+        # The index is replaced first, it's only used once the segment is in the manifest
+        write_index = self._index_path(key).with_name(f"{key}.log.idx.tmp")
+        with open(write_index, "w") as file:
+            file.write("".join(index))
+        os.replace(write_index, self._index_path(key))
+        os.replace(temp_file, compressed)
+
+        manifest = [entry for entry in self.read_manifest() if entry["key"] != key]
+        if lines > 0:
+            manifest.append({"key": key, "start": start, "end": end, "lines": lines})
+            manifest.sort(key=lambda entry: entry["key"])
+        temp_file = self._manifest_file.with_name(MANIFEST_FILE + ".tmp")
+        with open(temp_file, "w") as file:
+            json.dump({"segments": manifest}, file)
+        os.replace(temp_file, self._manifest_file)
+
+        path.unlink()
+        if lines == 0:
+            compressed.unlink()
+            self._index_path(key).unlink()
+
+    def append(self, line, time):
+        """
+        :param line: Line to append, ending with a newline
+        :param time: datetime of the line, decides which segment it goes to
+        """
+        key = time.date().isoformat()
+        if self._open_key is None or key > self._open_key:
+            self._rotate(key)
+        self._appender.append(line)
+
+    def _rotate(self, key):
+        self._appender.flush()
+        if self._open_key is not None and self._segment_path(self._open_key).is_file():
+            self._close_segment(self._open_key)
+        self._open_key = key
+        self._appender.set_path(self._segment_path(key))
+
+    def flush_if_due(self):
+        self._appender.flush_if_due()
+
+    def flush(self):
+        self._appender.flush()
+
+    def get_segments(self, start=None, end=None):
+        """
+        :param start: Skip segments that end before this datetime
+        :param end: Skip segments that start at or after this datetime
+        :return: List of (key, pathlib.Path, is_compressed) of the segments that can have lines in the range, oldest
+            first
+        """
+        segments = []
+        if self._legacy_file is not None and self._legacy_file.is_file():
+            segments.append((LEGACY_KEY, self._legacy_file, False))
+        for entry in self.read_manifest():
+            if start is not None and entry["end"] < start.isoformat():
+                continue
+            if end is not None and entry["start"] >= end.isoformat():
+                continue
+            segments.append(
+                (entry["key"], self._segment_path(entry["key"], compressed=True), True)
+            )
+        for key in self._get_open_keys():
+            # Open segments have no recorded range, but none of their lines are from before their day
+            if end is not None and datetime.datetime.fromisoformat(key) >= end:
+                continue
+            segments.append((key, self._segment_path(key), False))
+        return segments
+
+    def _read_index(self, key):
+        """
+        :return: (list of the datetimes of the first lines of the blocks, list of their offsets), both empty if the
+            segment has no index
+        """
+        times, offsets = [], []
+        try:
+            with open(self._index_path(key), "r") as file:
+                for line in file:
+                    time, offset = line.split(" ")
+                    times.append(datetime.datetime.fromisoformat(time))
+                    offsets.append(int(offset))
+        except FileNotFoundError:
+            pass
+        return times, offsets
+
+    def _open_segment(self, key, path, is_compressed, mode="r", skip_before=None):
+        """
+        :param mode: "r" or "rb"
+        :param skip_before: Start reading at the first line at or after this datetime in plain segments, and at the
+            last block starting before it in compressed ones. None to read from the start.
+        :return: The opened segment. If the segment was open but got closed since it was listed, the compressed one.
+        """
+        if not is_compressed:
+            try:
+                file = open(path, "rb")
+            except FileNotFoundError:
+                path = self._segment_path(key, compressed=True)
+            else:
+                if skip_before is not None:
+                    file.seek(find_line_offset(file, skip_before, self._timestamp_of))
+                return file if mode == "rb" else io.TextIOWrapper(file, "utf-8")
+
+        offset = 0
+        if skip_before is not None:
+            times, offsets = self._read_index(key)
+            # Lines at skip_before can also be at the end of the block before the one starting at it
+            block = bisect.bisect_left(times, skip_before) - 1
+            if block > 0:
+                offset = offsets[block]
+        file = _OffsetGzipFile(path, offset)
+        return file if mode == "rb" else io.TextIOWrapper(file, "utf-8")
+
+    def iter_lines(self, start=None, end=None, skip_before=None):
+        """
+        :param start: Skip segments that end before this datetime
+        :param end: Skip segments that start at or after this datetime
+        :param skip_before: Skip most lines before this datetime without reading them, see _open_segment (default is
+            to read every line of the segments)
+        :return: Iterator of the complete lines of the segments in the range, oldest first. Lines of those segments
+            that are outside the range are not filtered out.
+        """
+        for key, path, is_compressed in self.get_segments(start, end):
+            with self._open_segment(
+                key, path, is_compressed, skip_before=skip_before
+            ) as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break
+                    yield line
+
+    def read_since(self, cursor=None):
+        """
+        :param cursor: Returned by the previous call, None to read from the start
+        :return: (list of complete lines appended since the cursor, new cursor)
+        :raises LookupError: If the segment the cursor points to doesn't exist anymore
+        """
+        segments = self.get_segments()
+        keys = [key for key, _, _ in segments]
+        if cursor is None:
+            index, offset = 0, 0
+        else:
+            if not isinstance(cursor, list) or cursor[0] not in keys:
+                raise LookupError(f"No segment for cursor {cursor}")
+            index, offset = keys.index(cursor[0]), cursor[1]
+
+        lines = []
+        new_cursor = cursor
+        for key, path, is_compressed in segments[index:]:
+            with self._open_segment(key, path, is_compressed, "rb") as file:
+                data = file.read()
+            if len(data) < offset:
+                raise LookupError(f"Segment {key} is shorter than the cursor")
+            # Only use complete lines, a partially written one will be read next time
+            data = data[offset : data.rfind(b"\n") + 1]
+            lines.extend(data.decode("utf-8").splitlines(keepends=True))
+            new_cursor = [key, offset + len(data)]
+            offset = 0
+        return lines, new_cursor
@@ -0,0 +1,106 @@
+"""
+Player sessions: when each player was online, and for how long.
+
+The DataWriter keeps a SessionIndex up to date from the player samples of every query, and saves each session once it
+ends. Running this file rebuilds the saved sessions of save folders from their player_history, and the player index
+built from them (see player_index.py). Stop the monitor before rebuilding.
+"""
+
+import datetime
+from src.monitor.player_index import rebuild_player_index
+from src.monitor.save_folders import get_save_folders, make_parser
+from src.monitor.storage import Session, open_storage
+
+
+class SessionIndex:
+    """
+    The ongoing sessions of every player. Ended sessions are only returned, to be saved to the storage and the player
+    index (see player_index.py), so the memory used doesn't grow with the history.
+    """
+
+    def __init__(self, max_gap=7200):
+        """
+        :param max_gap: If no sample came in for this many seconds, the monitor was down, and every session is ended
+            at the last sample (default is 2 hours, player_history has a keyframe at least every hour)
+        """
+        self._max_gap = datetime.timedelta(seconds=max_gap)
+        self._online = {}  # Player -> start time of their ongoing session
+        self._last_time = None  # Time of the last sample
+
+    def _end_session(self, player, time):
+        return Session(player, self._online.pop(player), time)
+
+    def add_sample(self, time, players):
+        """
+        :param time: datetime the sample was taken at
+        :param players: Names of the players online at that time
+        :return: List of the sessions that ended with this sample
+        """
+        ended = []
+        if self._last_time is not None and time - self._last_time > self._max_gap:
+            ended = self.end_all()
+        players = set(players)
+        for player in list(self._online):
+            if player not in players:
+                ended.append(self._end_session(player, time))
+        for player in players:
+            if player not in self._online:
+                self._online[player] = time
+        self._last_time = time
+        return ended
+
+    def end_all(self):
+        """
+        End every ongoing session at the time of the last sample.
+        :return: List of the sessions that ended
+        """
+        return [
+            self._end_session(player, self._last_time) for player in list(self._online)
+        ]
+
+    def get_ongoing(self, player):
+        """
+        :param player: Name of the player
+        :return: Start datetime of the player's ongoing session, or None if they aren't online
+        """
+        return self._online.get(player)
+
+
+def rebuild_sessions(storage, max_gap=7200):
+    """
+    Replace the saved sessions with ones rebuilt from the player history. They are saved as they are found, in the
+    order they ended.
+    :param storage: Storage of the server
+    :param max_gap: See SessionIndex
+    :return: The SessionIndex, with no ongoing sessions
+    """
+    index = SessionIndex(max_gap)
+
+    def iter_ended():
+        for sample in storage.iter_player_samples():
+            yield from index.add_sample(sample.time, sample.players)
+        yield from index.end_all()
+
+    storage.write_sessions(iter_ended())
+    return index
+
+
+if __name__ == "__main__":
+    # Run from src/monitor, with the repository root on PYTHONPATH
+    parser = make_parser(__doc__, "rebuild")
+    parser.add_argument(
+        "--max-gap",
+        type=int,
+        default=7200,
+        help="Seconds without samples after which every session is ended",
+    )
+    args = parser.parse_args()
+
+    directories = get_save_folders(args)
+
+    for directory in directories:
+        storage = open_storage(directory)
+        rebuild_sessions(storage, args.max_gap)
+        # The player index is built from the sessions
+        rebuild_player_index(storage).close()
+        print(f"Rebuilt {storage.count_sessions()} sessions for {directory.name}.")
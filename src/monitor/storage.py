@@ -0,0 +1,1111 @@
+"""
+Storage backends for the data of one monitored server.
+
+DataWriter, DataAnalyzer (monitor.py) and the API (data_load.py) only go through the Storage interface, so where the
+data is kept can be changed without touching them. Two backends exist:
+- FlatFileStorage: the original pipe-delimited files in ../../save/<server>/, with map_history and player_history
+  split into daily compressed segments (see segments.py)
+- SqliteStorage: one SQLite database (WAL mode) per server, with indexes on map name and time
+"""
+
+import collections
+import datetime
+import os
+import pathlib
+import sqlite3
+import threading
+from src.monitor.buffered_writer import BufferedAppender, CoalescingFile, WriteStats
+from src.monitor.scheduler import SYSTEM_CLOCK
+from src.monitor.segments import SegmentedLog
+
+SQLITE_FILE = "data.sqlite3"
+HISTOGRAM_BIN_SECONDS = 300
+HISTOGRAM_BINS = 12
+
+# One finished map, as saved in map_history
+MapHistoryEntry = collections.namedtuple(
+    "MapHistoryEntry",
+    ["name", "start_date", "playtime", "start_players", "player_change"],
+)
+# One query's player count and player sample, as saved in player_history
+PlayerSample = collections.namedtuple(
+    "PlayerSample", ["time", "playercount", "players"]
+)
+# Time a player was online, see sessions.py
+Session = collections.namedtuple("Session", ["player", "start", "end"])
+# Statistics of one map's matches, computed by the DataAnalyzer (see columnar.py). playtime_histogram is a list of
+# HISTOGRAM_BINS match counts, one per HISTOGRAM_BIN_SECONDS of playtime. The last bin also counts longer matches.
+MapStatistics = collections.namedtuple(
+    "MapStatistics",
+    [
+        "name",
+        "count",
+        "avg_playtime",
+        "median_playtime",
+        "p90_playtime",
+        "std_playtime",
+        "avg_player_change",
+        "median_player_change",
+        "p90_player_change",
+        "std_player_change",
+        "playtime_histogram",
+    ],
+)
+
+
+class StaleCursorError(Exception):
+    """
+    The cursor given to read_map_history_since() doesn't match the stored history anymore (it was replaced).
+    """
+
+
+def open_storage(directory, backend=None, **kwargs):
+    """
+    :param directory: pathlib.Path of the server's save folder
+    :param backend: "flat" or "sqlite". None picks sqlite if the folder has a database, flat otherwise.
+    :param kwargs: Passed to the backend
+    :return: The Storage of the server
+    """
+    directory = pathlib.Path(directory)
+    if backend is None:
+        backend = "sqlite" if (directory / SQLITE_FILE).is_file() else "flat"
+    if backend == "flat":
+        return FlatFileStorage(directory, **kwargs)
+    if backend == "sqlite":
+        return SqliteStorage(directory, **kwargs)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def write_atomic(path, data):
+    """
+    Replace the contents of a file, so that readers see either the old or the new contents, never a partial write.
+    :param path: pathlib.Path of the file
+    :param data: str to write
+    """
+    temp_file = path.with_name(path.name + ".tmp")
+    with open(temp_file, "w") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)
+
+
+def _parse_time(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
+class Storage:
+    """
+    Interface of the storage backends. Writing methods are used by the monitor, reading methods by the analyzer and
+    the API.
+    """
+
+    def create(self):
+        """
+        Make sure the storage exists. Only the monitor should call this.
+        """
+        raise NotImplementedError
+
+    def get_source_files(self, reader):
+        """
+        :param reader: Name of a reading method, e.g. "read_playcounts"
+        :return: List of pathlib.Path the method reads. Its result only changes when one of them does, used by the API
+            to cache results (see src/api/cache.py).
+        """
+        raise NotImplementedError
+
+    # Server information
+
+    def init_first_write(self, date):
+        """
+        Save the time monitoring started, if it wasn't saved yet.
+        """
+        raise NotImplementedError
+
+    def read_first_write(self):
+        raise NotImplementedError
+
+    def write_last_cache_time(self, date):
+        raise NotImplementedError
+
+    def read_last_cache_time(self):
+        raise NotImplementedError
+
+    # Playcounts
+
+    def load_playcounts(self):
+        """
+        Load the playcounts into memory, so increment_playcount() doesn't have to read them. Only the monitor should
+        call this.
+        """
+        raise NotImplementedError
+
+    def increment_playcount(self, name):
+        raise NotImplementedError
+
+    def read_playcounts(self):
+        """
+        :return: Dict of map name -> playcount
+        """
+        raise NotImplementedError
+
+    # Map history
+
+    def append_match(self, entry: MapHistoryEntry):
+        raise NotImplementedError
+
+    def read_map_history_since(self, cursor=None):
+        """
+        :param cursor: Returned by the previous call, None to read from the start
+        :return: (list of MapHistoryEntry saved since the cursor, new cursor)
+        :raises StaleCursorError: If the history was replaced since the cursor was returned
+        """
+        raise NotImplementedError
+
+    def query_map_history(self, map_name=None, start=None, end=None):
+        """
+        :param map_name: Only return this map (default is every map)
+        :param start: Only return maps started at or after this datetime
+        :param end: Only return maps started before this datetime
+        :return: Iterator of MapHistoryEntry, oldest first
+        """
+        raise NotImplementedError
+
+    # Map statistics (written by the DataAnalyzer)
+
+    def write_map_statistics(self, statistics):
+        """
+        :param statistics: List of MapStatistics, replacing the saved ones
+        """
+        raise NotImplementedError
+
+    def read_map_statistics(self):
+        """
+        :return: Dict of map name -> MapStatistics. Fields that weren't saved (by an older version) are None.
+        """
+        raise NotImplementedError
+
+    def read_map_averages(self):
+        """
+        :return: Dict of map name -> (average playtime, average player change)
+        """
+        return {
+            name: (statistics.avg_playtime, statistics.avg_player_change)
+            for name, statistics in self.read_map_statistics().items()
+        }
+
+    # Live data (written on every query)
+
+    def write_active_map(self, name):
+        raise NotImplementedError
+
+    def read_active_map(self):
+        raise NotImplementedError
+
+    def write_game_time(self, game_time):
+        raise NotImplementedError
+
+    def read_game_time(self):
+        raise NotImplementedError
+
+    def write_online_players(self, players):
+        raise NotImplementedError
+
+    def read_online_players(self):
+        raise NotImplementedError
+
+    # Player history
+
+    def append_player_sample(self, sample: PlayerSample):
+        raise NotImplementedError
+
+    def iter_player_samples(self, start=None, end=None):
+        """
+        :param start: Only return samples taken at or after this datetime
+        :param end: Only return samples taken before this datetime
+        :return: Iterator of PlayerSample, oldest first
+        """
+        raise NotImplementedError
+
+    def read_players_at(self, time, lookback=datetime.timedelta(hours=2)):
+        """
+        :param time: datetime to get the online players at
+        :param lookback: How far before time to look for the last sample. Samples are saved at least every hour while
+            the monitor runs.
+        :return: The last PlayerSample taken at or before time, or None if there is none in the lookback
+        """
+        sample = None
+        for sample in self.iter_player_samples(
+            time - lookback, time + datetime.timedelta(microseconds=1)
+        ):
+            pass
+        return sample
+
+    # Player sessions (kept up to date by the DataWriter, see sessions.py)
+
+    def append_session(self, session: Session):
+        raise NotImplementedError
+
+    def write_sessions(self, sessions):
+        """
+        :param sessions: Iterable of Session to replace the saved sessions with
+        """
+        raise NotImplementedError
+
+    def load_sessions(self):
+        """
+        :return: List of the saved Session, or None if the sessions were never built
+        """
+        raise NotImplementedError
+
+    def count_sessions(self):
+        """
+        :return: Number of saved sessions, without loading them. None if the sessions were never built.
+        """
+        raise NotImplementedError
+
+    # Buffering
+
+    def flush_if_due(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def get_io_stats(self):
+        return WriteStats().to_dict()
+
+
+class FlatFileStorage(Storage):
+    """
+    The original save folder layout. Every dataset is a small pipe-delimited text file, except map_history and
+    player_history, which grow forever: they are kept in map_history_segments/ and player_history_segments/, one
+    segment per day. Old single file logs are imported as the first segment by create(), and kept renamed to
+    map_history.legacy and player_history.legacy.
+
+    player_history only records changes. Each line starts with the time of the sample, and is either
+        a keyframe: <time>|<playercount>|<player>|<player>|...
+        or a delta: <time>|D|<playercount>|+<joined player>|-<left player>|...
+    Samples where nothing changed are not saved. A keyframe is written when the monitor starts, at the start of every
+    segment and every keyframe_interval seconds, so readers never have to go back further than one segment.
+    """
+
+    def __init__(
+        self,
+        directory,
+        compact_every=100,
+        flush_bytes=65536,
+        flush_interval=60,
+        clock=SYSTEM_CLOCK,
+        keyframe_interval=3600,
+    ):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        :param compact_every: Rewrite map_data after this many playcount changes were logged (default is 100)
+        :param flush_bytes: Write the buffered player_history once this many bytes are buffered (default is 64 KiB)
+        :param flush_interval: Write the buffered player_history at least every x seconds (default is 60)
+        :param clock: Where the buffers measure their age with (default is the system clock)
+        :param keyframe_interval: Save all online players in player_history at least every x seconds (default is 3600)
+        """
+        self.directory = pathlib.Path(directory)
+        self._history_file = self.directory / "map_history"
+        self._map_data = self.directory / "map_data"
+        self._map_data_log = self.directory / "map_data_log"
+        self._active_map = self.directory / "active_map"
+        self._game_time = self.directory / "game_time"
+        self._first_write = self.directory / "first_write"
+        self._online_players = self.directory / "online"
+        self._misc_data = self.directory / "misc"
+        self._player_history = self.directory / "player_history"
+        self._map_average_cache = self.directory / "map_average_cache"
+        self._last_cache_time = self.directory / "last_cache_time"
+        self._player_sessions = self.directory / "player_sessions"
+        self._compact_every = compact_every
+        self._keyframe_interval = datetime.timedelta(seconds=keyframe_interval)
+
+        # Playcounts are kept in memory once load_playcounts() is called. map_data is only rewritten every
+        # compact_every changes, the changes in between are appended to map_data_log. Each change has a sequence
+        # number, and map_data stores the last one it includes (as SYS_LOGSEQ), so a crash between the two steps of a
+        # compaction can't count a change twice.
+        self._playcounts = None
+        self._log_sequence = 0
+        self._logged_changes = 0
+
+        # Last saved player sample, player_history lines after a keyframe only contain the changes to it
+        self._last_players = None
+        self._last_playercount = None
+        self._last_keyframe = None
+
+        # The files written on every query go through buffered writers, see buffered_writer.py
+        self._io_stats = WriteStats()
+        self._online_players_file = CoalescingFile(self._online_players, self._io_stats)
+        self._game_time_file = CoalescingFile(self._game_time, self._io_stats)
+        self._active_map_file = CoalescingFile(self._active_map, self._io_stats)
+        self._player_history_buffer = BufferedAppender(
+            None,
+            max_bytes=flush_bytes,
+            max_age=flush_interval,
+            clock=clock,
+            stats=self._io_stats,
+        )
+
+        self._history_log = SegmentedLog(
+            self.directory / "map_history_segments",
+            lambda line: _parse_time(line.split(" | ")[1]),
+            legacy_file=self._history_file,
+            appender=BufferedAppender(None, max_bytes=0, stats=self._io_stats),
+        )
+        self._player_history_log = SegmentedLog(
+            self.directory / "player_history_segments",
+            lambda line: _parse_time(line.split("|", 1)[0]),
+            legacy_file=self._player_history,
+            appender=self._player_history_buffer,
+        )
+
+    def create(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for file in (
+            self._map_data,
+            self._map_data_log,
+            self._active_map,
+            self._game_time,
+            self._misc_data,
+            self._online_players,
+            self._map_average_cache,
+            self._last_cache_time,
+        ):
+            file.touch()
+        self._history_log.create()
+        self._player_history_log.create()
+
+    def get_source_files(self, reader):
+        return {
+            "read_first_write": [self._first_write],
+            "read_last_cache_time": [self._last_cache_time],
+            "read_playcounts": [self._map_data, self._map_data_log],
+            "read_map_statistics": [self._map_average_cache],
+            "read_map_averages": [self._map_average_cache],
+            "read_active_map": [self._active_map],
+            "read_game_time": [self._game_time],
+            "read_online_players": [self._online_players],
+        }[reader]
+
+    def init_first_write(self, date):
+        # Check if first_write exists, if yes then pass, if not then create it.
+        if not self._first_write.is_file():
+            with open(self._first_write, "w") as file:
+                file.write(str(date))
+
+    def read_first_write(self):
+        with open(self._first_write, "r") as file:
+            return file.read()
+
+    def write_last_cache_time(self, date):
+        with open(self._last_cache_time, "w") as file:
+            file.write(str(date))
+
+    def read_last_cache_time(self):
+        with open(self._last_cache_time, "r") as file:
+            return file.read()
+
+    def _read_playcount_files(self):
+        """
+        :return: (Dict of map name -> playcount, last sequence number included)
+        """
+        playcounts = {}
+        snapshot_sequence = 0
+        with open(self._map_data, "r") as file:
+            for line in file:
+                split = line.split(" | ")
+                if split[0] == "SYS_LOGSEQ":
+                    snapshot_sequence = int(split[1])
+                else:
+                    playcounts[split[0]] = int(split[1])
+
+        sequence = snapshot_sequence
+        if self._map_data_log.is_file():
+            with open(self._map_data_log, "r") as file:
+                for line in file:
+                    if not line.endswith("\n"):
+                        break  # Still being written, or only partially written before a crash
+                    split = line.split(" | ")
+                    line_sequence = int(split[1])
+                    if line_sequence > snapshot_sequence:
+                        playcounts[split[0]] = playcounts.get(split[0], 0) + 1
+                        sequence = max(sequence, line_sequence)
+        return playcounts, sequence
+
+    def _compact_playcounts(self):
+        """
+        Atomically replace map_data with the in-memory playcounts, then empty the log.
+        """
+        lines = [
+            f"{name} | {playcount}\n" for name, playcount in self._playcounts.items()
+        ]
+        lines.append(f"SYS_LOGSEQ | {self._log_sequence}\n")
+        write_atomic(self._map_data, "".join(lines))
+
+        with open(self._map_data_log, "w"):
+            pass
+        self._logged_changes = 0
+
+    def load_playcounts(self):
+        self._playcounts, self._log_sequence = self._read_playcount_files()
+        self._compact_playcounts()
+
+    def increment_playcount(self, name):
+        if self._playcounts is None:
+            self.load_playcounts()
+        self._playcounts[name] = self._playcounts.get(name, 0) + 1
+        self._log_sequence += 1
+        with open(self._map_data_log, "a") as file:
+            file.write(f"{name} | {self._log_sequence}\n")
+            file.flush()
+            os.fsync(file.fileno())
+        self._logged_changes += 1
+        if self._logged_changes >= self._compact_every:
+            self._compact_playcounts()
+
+    def read_playcounts(self):
+        if self._playcounts is not None:
+            return dict(self._playcounts)
+        return self._read_playcount_files()[0]
+
+    @staticmethod
+    def _parse_history_line(line):
+        split = line.split(" | ")
+        return MapHistoryEntry(
+            split[0],
+            _parse_time(split[1]),
+            int(split[2]),
+            int(split[3]),
+            int(split[4]),
+        )
+
+    def append_match(self, entry: MapHistoryEntry):
+        self._history_log.append(
+            f"{entry.name} | {entry.start_date} | {entry.playtime} | "
+            f"{entry.start_players} | {entry.player_change}\n",
+            entry.start_date,
+        )
+
+    def read_map_history_since(self, cursor=None):
+        # The cursor is [segment, byte offset in the segment] of what was already read
+        try:
+            lines, cursor = self._history_log.read_since(cursor)
+        except LookupError as ex:
+            raise StaleCursorError(str(ex)) from ex
+        return [self._parse_history_line(line) for line in lines], cursor
+
+    def query_map_history(self, map_name=None, start=None, end=None):
+        for line in self._history_log.iter_lines(start, end, start):
+            if map_name is not None and not line.startswith(f"{map_name} | "):
+                continue
+            entry = self._parse_history_line(line)
+            if start is not None and entry.start_date < start:
+                continue
+            if end is not None and entry.start_date >= end:
+                continue
+            yield entry
+
+    def write_map_statistics(self, statistics):
+        # name | avg playtime | avg player change | count | median playtime | ... | histogram counts split by commas
+        lines = []
+        for entry in statistics:
+            histogram = ",".join(str(count) for count in entry.playtime_histogram)
+            lines.append(
+                f"{entry.name} | {entry.avg_playtime} | {entry.avg_player_change} | {entry.count} | "
+                f"{entry.median_playtime} | {entry.p90_playtime} | {entry.std_playtime} | "
+                f"{entry.median_player_change} | {entry.p90_player_change} | {entry.std_player_change} | "
+                f"{histogram}\n"
+            )
+        write_atomic(self._map_average_cache, "".join(lines))
+
+    def read_map_statistics(self):
+        statistics = {}
+        with open(self._map_average_cache, "r") as file:
+            for line in file:
+                split = line.rstrip("\n").split(" | ")
+                if len(split) < 11:
+                    # Saved by an older version, only the averages are known
+                    statistics[split[0]] = MapStatistics(
+                        split[0],
+                        None,
+                        float(split[1]),
+                        None,
+                        None,
+                        None,
+                        float(split[2]),
+                        None,
+                        None,
+                        None,
+                        None,
+                    )
+                    continue
+                statistics[split[0]] = MapStatistics(
+                    split[0],
+                    int(split[3]),
+                    float(split[1]),
+                    float(split[4]),
+                    float(split[5]),
+                    float(split[6]),
+                    float(split[2]),
+                    float(split[7]),
+                    float(split[8]),
+                    float(split[9]),
+                    [int(count) for count in split[10].split(",")],
+                )
+        return statistics
+
+    def write_active_map(self, name):
+        self._active_map_file.write(name)
+
+    def read_active_map(self):
+        with open(self._active_map, "r") as file:
+            return file.read()
+
+    def write_game_time(self, game_time):
+        self._game_time_file.write(str(game_time).strip() + "\n")
+
+    def read_game_time(self):
+        with open(self._game_time, "r") as file:
+            return int(file.read().strip())
+
+    def write_online_players(self, players):
+        self._online_players_file.write("".join(f"{item}\n" for item in players))
+
+    def read_online_players(self):
+        with open(self._online_players, "r") as file:
+            return [line.strip() for line in file.readlines()]
+
+    def append_player_sample(self, sample: PlayerSample):
+        keyframe = (
+            sample.time.isoformat()
+            + "|"
+            + str(sample.playercount)
+            + "|"
+            + "".join(f"{item}|" for item in sample.players)
+            + "\n"
+        )
+        players = set(sample.players)
+        if (
+            self._last_keyframe is None
+            or sample.time - self._last_keyframe >= self._keyframe_interval
+            or sample.time.date() != self._last_keyframe.date()  # New segment
+        ):
+            line = keyframe
+            self._last_keyframe = sample.time
+        else:
+            joined = sorted(players - self._last_players)
+            left = sorted(self._last_players - players)
+            if not joined and not left and sample.playercount == self._last_playercount:
+                self._io_stats.bytes_saved += len(keyframe)
+                return
+            line = (
+                f"{sample.time.isoformat()}|D|{sample.playercount}|"
+                + "".join(f"+{item}|" for item in joined)
+                + "".join(f"-{item}|" for item in left)
+                + "\n"
+            )
+            self._io_stats.bytes_saved += max(0, len(keyframe) - len(line))
+        self._last_players = players
+        self._last_playercount = sample.playercount
+        self._player_history_log.append(line, sample.time)
+
+    def iter_player_samples(self, start=None, end=None):
+        online = {}  # Players online after the last line, a dict to keep their order
+        # Who is online at start is only known from the last keyframe before it, which is less than a keyframe interval
+        # before start
+        skip_before = None if start is None else start - self._keyframe_interval
+        for line in self._player_history_log.iter_lines(start, end, skip_before):
+            split = line.rstrip("\n").split("|")
+            time = _parse_time(split[0])
+            if end is not None and time >= end:
+                break  # The segments are in chronological order
+            if split[1] == "D":
+                playercount = int(split[2])
+                for change in split[3:-1]:
+                    if change[0] == "+":
+                        online[change[1:]] = None
+                    else:
+                        online.pop(change[1:], None)
+            else:
+                playercount = int(split[1])
+                online = dict.fromkeys(split[2:-1])
+            # Lines before start are still needed to know who was online at start
+            if start is None or time >= start:
+                yield PlayerSample(time, playercount, list(online))
+
+    @staticmethod
+    def _format_session(session: Session):
+        return f"{session.player} | {session.start} | {session.end}\n"
+
+    def append_session(self, session: Session):
+        with open(self._player_sessions, "a") as file:
+            file.write(self._format_session(session))
+
+    def write_sessions(self, sessions):
+        write_atomic(
+            self._player_sessions,
+            "".join(self._format_session(session) for session in sessions),
+        )
+
+    def load_sessions(self):
+        if not self._player_sessions.is_file():
+            return None
+        sessions = []
+        with open(self._player_sessions, "r") as file:
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                split = line.rstrip("\n").split(" | ")
+                sessions.append(
+                    Session(split[0], _parse_time(split[1]), _parse_time(split[2]))
+                )
+        return sessions
+
+    def count_sessions(self):
+        if not self._player_sessions.is_file():
+            return None
+        count = 0
+        with open(self._player_sessions, "rb") as file:
+            # A line only partially written before a crash has no newline, and isn't counted like in load_sessions()
+            for block in iter(lambda: file.read(1048576), b""):
+                count += block.count(b"\n")
+        return count
+
+    def flush_if_due(self):
+        self._player_history_log.flush_if_due()
+
+    def flush(self):
+        self._player_history_log.flush()
+
+    def get_io_stats(self):
+        return self._io_stats.to_dict()
+
+
+class SqliteStorage(Storage):
+    """
+    Keeps everything in one SQLite database per server, in WAL mode so the API can read while the monitor writes.
+    Map history and player history are indexed by time (and map history also by map name), so the API can query them
+    without scanning.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS map_history (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            playtime INTEGER NOT NULL,
+            start_players INTEGER NOT NULL,
+            player_change INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS map_history_name_time ON map_history (name, start_time);
+        CREATE INDEX IF NOT EXISTS map_history_time ON map_history (start_time);
+        CREATE TABLE IF NOT EXISTS playcounts (
+            name TEXT PRIMARY KEY,
+            playcount INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS map_averages (
+            name TEXT PRIMARY KEY,
+            avg_playtime REAL NOT NULL,
+            avg_player_change REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS map_statistics (
+            name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            median_playtime REAL NOT NULL,
+            p90_playtime REAL NOT NULL,
+            std_playtime REAL NOT NULL,
+            median_player_change REAL NOT NULL,
+            p90_player_change REAL NOT NULL,
+            std_player_change REAL NOT NULL,
+            playtime_histogram TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS player_history (
+            time TEXT NOT NULL,
+            playercount INTEGER NOT NULL,
+            players TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS player_history_time ON player_history (time);
+        CREATE TABLE IF NOT EXISTS player_sessions (
+            player TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS player_sessions_player_time ON player_sessions (player, start_time);
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, directory, **_kwargs):
+        """
+        :param directory: pathlib.Path of the server's save folder
+        """
+        self.directory = pathlib.Path(directory)
+        self._database = self.directory / SQLITE_FILE
+        self._local = (
+            threading.local()
+        )  # sqlite3 connections can't be shared between threads
+        self._io_stats = WriteStats()
+        self._state_cache = (
+            {}
+        )  # Last value written to each state key, to skip unchanged writes
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self._database)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, query, parameters=()):
+        with self._connection() as connection:
+            connection.execute(query, parameters)
+        self._io_stats.syscalls += 1  # Counts commits
+
+    def create(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def get_source_files(self, reader):
+        # Every commit changes the write-ahead log, and checkpoints change the database
+        return [self._database, self._database.with_name(SQLITE_FILE + "-wal")]
+
+    def _write_state(self, key, value):
+        if self._state_cache.get(key) == value:
+            self._io_stats.bytes_saved += len(value)
+            self._io_stats.syscalls_saved += 1
+            return
+        self._execute(
+            "INSERT INTO state (key, value) VALUES (?, ?)"
+            " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+        self._state_cache[key] = value
+        self._io_stats.bytes_written += len(value)
+
+    def _read_state(self, key, default=""):
+        row = (
+            self._connection()
+            .execute("SELECT value FROM state WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return default if row is None else row[0]
+
+    def init_first_write(self, date):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO state (key, value) VALUES ('first_write', ?)",
+                (str(date),),
+            )
+
+    def read_first_write(self):
+        return self._read_state("first_write")
+
+    def write_last_cache_time(self, date):
+        self._write_state("last_cache_time", str(date))
+
+    def read_last_cache_time(self):
+        return self._read_state("last_cache_time")
+
+    def load_playcounts(self):
+        pass  # Increments are done by the database
+
+    def increment_playcount(self, name):
+        self._execute(
+            "INSERT INTO playcounts (name, playcount) VALUES (?, 1)"
+            " ON CONFLICT (name) DO UPDATE SET playcount = playcount + 1",
+            (name,),
+        )
+
+    def read_playcounts(self):
+        return dict(
+            self._connection().execute(
+                "SELECT name, playcount FROM playcounts ORDER BY rowid"
+            )
+        )
+
+    @staticmethod
+    def _to_entry(row):
+        return MapHistoryEntry(row[0], _parse_time(row[1]), *row[2:])
+
+    def append_match(self, entry: MapHistoryEntry):
+        self._execute(
+            "INSERT INTO map_history (name, start_time, playtime, start_players, player_change)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                entry.name,
+                entry.start_date.isoformat(" "),
+                entry.playtime,
+                entry.start_players,
+                entry.player_change,
+            ),
+        )
+
+    def read_map_history_since(self, cursor=None):
+        # The cursor is the id of the last row that was already read
+        if cursor is None:
+            last_id = 0
+        elif isinstance(cursor, int) and not isinstance(cursor, bool):
+            last_id = cursor
+        else:
+            # E.g. the [segment, offset] cursor of the flat files, saved before migrating
+            raise StaleCursorError(f"Not a map history row id: {cursor!r}")
+        connection = self._connection()
+        if last_id > (
+            connection.execute("SELECT MAX(id) FROM map_history").fetchone()[0] or 0
+        ):
+            raise StaleCursorError(f"No map history row {last_id}")
+        rows = connection.execute(
+            "SELECT id, name, start_time, playtime, start_players, player_change"
+            " FROM map_history WHERE id > ? ORDER BY id",
+            (last_id,),
+        ).fetchall()
+        if rows:
+            last_id = rows[-1][0]
+        return [self._to_entry(row[1:]) for row in rows], last_id
+
+    def query_map_history(self, map_name=None, start=None, end=None):
+        conditions = []
+        parameters = []
+        if map_name is not None:
+            conditions.append("name = ?")
+            parameters.append(map_name)
+        if start is not None:
+            conditions.append("start_time >= ?")
+            parameters.append(start.isoformat(" "))
+        if end is not None:
+            conditions.append("start_time < ?")
+            parameters.append(end.isoformat(" "))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        for row in self._connection().execute(
+            "SELECT name, start_time, playtime, start_players, player_change"
+            f" FROM map_history {where} ORDER BY start_time",
+            parameters,
+        ):
+            yield self._to_entry(row)
+
+    @staticmethod
+    def _insert_map_statistics(connection, statistics):
+        connection.execute("DELETE FROM map_averages")
+        connection.execute("DELETE FROM map_statistics")
+        connection.executemany(
+            "INSERT INTO map_averages (name, avg_playtime, avg_player_change)"
+            " VALUES (?, ?, ?)",
+            (
+                (entry.name, entry.avg_playtime, entry.avg_player_change)
+                for entry in statistics
+            ),
+        )
+        # Averages saved by an older version have no other statistics
+        connection.executemany(
+            "INSERT INTO map_statistics (name, count, median_playtime, p90_playtime, std_playtime,"
+            " median_player_change, p90_player_change, std_player_change, playtime_histogram)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    entry.name,
+                    entry.count,
+                    entry.median_playtime,
+                    entry.p90_playtime,
+                    entry.std_playtime,
+                    entry.median_player_change,
+                    entry.p90_player_change,
+                    entry.std_player_change,
+                    ",".join(str(count) for count in entry.playtime_histogram),
+                )
+                for entry in statistics
+                if entry.count is not None
+            ),
+        )
+
+    def write_map_statistics(self, statistics):
+        with self._connection() as connection:
+            self._insert_map_statistics(connection, statistics)
+        self._io_stats.syscalls += 1
+
+    def read_map_statistics(self):
+        statistics = {}
+        for row in self._connection().execute(
+            "SELECT map_averages.name, count, avg_playtime, median_playtime, p90_playtime, std_playtime,"
+            " avg_player_change, median_player_change, p90_player_change, std_player_change, playtime_histogram"
+            " FROM map_averages LEFT JOIN map_statistics ON map_averages.name = map_statistics.name"
+        ):
+            histogram = row[10]
+            if histogram is not None:
+                histogram = [int(count) for count in histogram.split(",")]
+            statistics[row[0]] = MapStatistics(*row[:10], histogram)
+        return statistics
+
+    def write_active_map(self, name):
+        self._write_state("active_map", name)
+
+    def read_active_map(self):
+        return self._read_state("active_map")
+
+    def write_game_time(self, game_time):
+        self._write_state("game_time", str(game_time))
+
+    def read_game_time(self):
+        return int(self._read_state("game_time", "0"))
+
+    def write_online_players(self, players):
+        self._write_state("online", "\n".join(players))
+
+    def read_online_players(self):
+        online = self._read_state("online")
+        return online.split("\n") if online else []
+
+    def append_player_sample(self, sample: PlayerSample):
+        players = "|".join(sample.players)
+        self._execute(
+            "INSERT INTO player_history (time, playercount, players) VALUES (?, ?, ?)",
+            (sample.time.isoformat(), sample.playercount, players),
+        )
+        self._io_stats.bytes_written += len(players)
+
+    def iter_player_samples(self, start=None, end=None):
+        conditions = []
+        parameters = []
+        if start is not None:
+            conditions.append("time >= ?")
+            parameters.append(start.isoformat())
+        if end is not None:
+            conditions.append("time < ?")
+            parameters.append(end.isoformat())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        for time, playercount, players in self._connection().execute(
+            f"SELECT time, playercount, players FROM player_history {where} ORDER BY time",
+            parameters,
+        ):
+            yield PlayerSample(
+                _parse_time(time), playercount, players.split("|") if players else []
+            )
+
+    def append_session(self, session: Session):
+        self._execute(
+            "INSERT INTO player_sessions (player, start_time, end_time) VALUES (?, ?, ?)",
+            (session.player, session.start.isoformat(), session.end.isoformat()),
+        )
+
+    def write_sessions(self, sessions):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM player_sessions")
+            connection.executemany(
+                "INSERT INTO player_sessions (player, start_time, end_time) VALUES (?, ?, ?)",
+                (
+                    (session.player, session.start.isoformat(), session.end.isoformat())
+                    for session in sessions
+                ),
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO state (key, value) VALUES ('sessions_built', '1')"
+            )
+        self._io_stats.syscalls += 1
+
+    def load_sessions(self):
+        if not self._read_state("sessions_built"):
+            return None
+        return [
+            Session(player, _parse_time(start), _parse_time(end))
+            for player, start, end in self._connection().execute(
+                "SELECT player, start_time, end_time FROM player_sessions ORDER BY rowid"
+            )
+        ]
+
+    def count_sessions(self):
+        if not self._read_state("sessions_built"):
+            return None
+        return (
+            self._connection()
+            .execute("SELECT COUNT(*) FROM player_sessions")
+            .fetchone()[0]
+        )
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def get_io_stats(self):
+        return self._io_stats.to_dict()
+
+    def import_from(self, source: Storage):
+        """
+        Copy everything from another storage into this one, replacing what is here. Used by migrate.py.
+        :param source: The Storage to copy from
+        """
+        self.create()
+        with self._connection() as connection:
+            for table in (
+                "map_history",
+                "playcounts",
+                "map_averages",
+                "map_statistics",
+                "player_history",
+                "player_sessions",
+                "state",
+            ):
+                connection.execute(f"DELETE FROM {table}")  # noqa - fixed table names
+            connection.executemany(
+                "INSERT INTO map_history (name, start_time, playtime, start_players, player_change)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        entry.name,
+                        entry.start_date.isoformat(" "),
+                        entry.playtime,
+                        entry.start_players,
+                        entry.player_change,
+                    )
+                    for entry in source.query_map_history()
+                ),
+            )
+            connection.executemany(
+                "INSERT INTO playcounts (name, playcount) VALUES (?, ?)",
+                source.read_playcounts().items(),
+            )
+            self._insert_map_statistics(
+                connection, source.read_map_statistics().values()
+            )
+            connection.executemany(
+                "INSERT INTO player_history (time, playercount, players) VALUES (?, ?, ?)",
+                (
+                    (
+                        sample.time.isoformat(),
+                        sample.playercount,
+                        "|".join(sample.players),
+                    )
+                    for sample in source.iter_player_samples()
+                ),
+            )
+            try:
+                game_time = str(source.read_game_time())
+            except ValueError:
+                game_time = "0"
+            connection.executemany(
+                "INSERT INTO state (key, value) VALUES (?, ?)",
+                [
+                    ("first_write", source.read_first_write()),
+                    ("last_cache_time", source.read_last_cache_time()),
+                    ("active_map", source.read_active_map()),
+                    ("game_time", game_time),
+                    ("online", "\n".join(source.read_online_players())),
+                ],
+            )
+        self._state_cache = {}
+
+        sessions = source.load_sessions()
+        if sessions is not None:
+            self.write_sessions(sessions)
@@ -0,0 +1,55 @@
+import datetime
+import importlib
+import pathlib
+import sys
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# The monitor is imported as src.monitor, and the API's modules import each other by name (like in src/api/wsgi.py)
+for path in (ROOT, ROOT / "src" / "api"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+from src.monitor.storage import (
+    FlatFileStorage,
+    MapHistoryEntry,
+    PlayerSample,
+)  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def api_save(tmp_path_factory):
+    """
+    A copy of the repository's folder layout with one save folder, the API is run from its src/api.
+    :return: pathlib.Path of the save folder of the monitored server
+    """
+    root = tmp_path_factory.mktemp("repository")
+    (root / "src" / "api").mkdir(parents=True)
+    storage = FlatFileStorage(root / "save" / "Overcast Community")
+    storage.create()
+    storage.init_first_write(datetime.datetime(2023, 1, 1))
+    for hour in range(10, 13):
+        storage.append_match(
+            MapHistoryEntry(
+                "Airship Battle", datetime.datetime(2023, 1, 1, hour), 1800, 10, 2
+            )
+        )
+        storage.increment_playcount("Airship Battle")
+        storage.append_player_sample(
+            PlayerSample(datetime.datetime(2023, 1, 1, hour), hour, [f"Player{hour}"])
+        )
+    storage.close()
+    return root / "save" / "Overcast Community"
+
+
+@pytest.fixture
+def api_client(api_save, monkeypatch, request):
+    """
+    Flask test client of the API. Each test is a client with its own address, so the rate limits don't carry over.
+    """
+    monkeypatch.chdir(api_save.parent.parent / "src" / "api")
+    flaskapp = importlib.import_module("flaskapp")
+    client = flaskapp.app.test_client()
+    client.environ_base["HTTP_X_FORWARDED_FOR"] = request.node.nodeid
+    return client
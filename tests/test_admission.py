@@ -0,0 +1,24 @@
+from src.api.admission import AdmissionController, AdmissionLimit
+
+
+def test_creates_the_state_folder(tmp_path):
+    path = tmp_path / "save" / "api_admission"
+    controller = AdmissionController(path, {"cheap": AdmissionLimit(1, 1, 1)})
+    assert path.is_file()
+    assert controller.admit("client", "cheap") is None
+
+
+def test_rejecting_a_saturated_class_costs_no_token(tmp_path):
+    controller = AdmissionController(
+        tmp_path / "admission", {"expensive": AdmissionLimit(0.001, 2, 1)}
+    )
+    assert controller.admit("busy", "expensive") is None
+    for _ in range(5):
+        assert controller.admit("waiting", "expensive") == (503, 1)
+    controller.release("expensive")
+    # Both of its tokens are left
+    assert controller.admit("waiting", "expensive") is None
+    controller.release("expensive")
+    assert controller.admit("waiting", "expensive") is None
+    controller.release("expensive")
+    assert controller.admit("waiting", "expensive")[0] == 429
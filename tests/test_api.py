@@ -0,0 +1,86 @@
+import time
+import pytest
+
+
+@pytest.fixture
+def utc_plus_one(monkeypatch):
+    monkeypatch.setenv("TZ", "Etc/GMT-1")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_map_history_between_local_times(api_client):
+    with api_client.get(
+        "/Overcast Community/maps/Airship Battle/history/",
+        query_string={"from": "2023-01-01T10:30:00", "to": "2023-01-01T12:00:00"},
+    ) as response:
+        assert response.status_code == 200
+        assert [entry["start_date"] for entry in response.json["history"]] == [
+            "2023-01-01 11:00:00"
+        ]
+
+
+@pytest.mark.parametrize("offset", ["Z", "+00:00"])
+def test_map_history_converts_times_with_an_offset(api_client, utc_plus_one, offset):
+    with api_client.get(
+        "/Overcast Community/maps/Airship Battle/history/",
+        query_string={"from": f"2023-01-01T10:30:00{offset}"},
+    ) as response:
+        assert response.status_code == 200
+        # 10:30 UTC is 11:30 local time
+        assert [entry["start_date"] for entry in response.json["history"]] == [
+            "2023-01-01 12:00:00"
+        ]
+
+
+def test_map_history_finds_the_map_in_any_case(api_client):
+    with api_client.get("/Overcast Community/maps/airship BATTLE/history/") as response:
+        assert response.status_code == 200
+        assert response.json["map_name"] == "Airship Battle"
+        assert len(response.json["history"]) == 3
+    with api_client.get("/Overcast Community/maps/Airship/history/") as response:
+        assert response.status_code == 404
+
+
+@pytest.mark.parametrize("value", ["yesterday", "0001-01-01T00:00:00+01:00"])
+def test_map_history_rejects_invalid_times(api_client, value):
+    with api_client.get(
+        "/Overcast Community/maps/Airship Battle/history/",
+        query_string={"from": value},
+    ) as response:
+        assert response.status_code == 400
+
+
+def test_player_snapshots_with_an_offset(api_client, utc_plus_one):
+    with api_client.get(
+        "/Overcast Community/players/snapshots/",
+        query_string={"from": "2023-01-01T09:30:00Z", "to": "2023-01-01T11:00:00Z"},
+    ) as response:
+        assert response.status_code == 200
+        # 10:30 to 12:00 local time
+        assert response.json == {
+            "server_name": "Overcast Community",
+            "snapshots": [
+                {
+                    "time": "2023-01-01 11:00:00",
+                    "playercount": 11,
+                    "players": ["Player11"],
+                }
+            ],
+        }
+
+
+@pytest.mark.parametrize(
+    "query_string",
+    [
+        {"from": "2023-01-01T11:00:00", "to": "2023-01-01T10:00:00"},
+        {"from": "2023-01-01T10:00:00+25:00"},
+    ],
+)
+def test_player_snapshots_rejects_invalid_ranges(api_client, query_string):
+    with api_client.get(
+        "/Overcast Community/players/snapshots/", query_string=query_string
+    ) as response:
+        assert response.status_code == 400
@@ -0,0 +1,50 @@
+import datetime
+from src.monitor.columnar import ColumnarHistory
+from src.monitor.migrate import migrate_server
+from src.monitor.storage import FlatFileStorage, MapHistoryEntry, SqliteStorage
+
+
+def _add_matches(storage, count, start=datetime.datetime(2023, 1, 1)):
+    for i in range(count):
+        storage.append_match(
+            MapHistoryEntry(
+                f"Map {i % 3}", start + datetime.timedelta(minutes=20 * i), 1200, 10, i
+            )
+        )
+    storage.flush()
+
+
+def test_load_after_migrating_to_sqlite(tmp_path):
+    flat = FlatFileStorage(tmp_path)
+    flat.create()
+    flat.init_first_write(datetime.datetime(2023, 1, 1))
+    _add_matches(flat, 5)
+    # Leaves the flat file cursor in meta.json
+    assert len(ColumnarHistory(flat).load()) == 5
+    flat.close()
+
+    assert migrate_server(tmp_path)
+    sqlite = SqliteStorage(tmp_path)
+    history = ColumnarHistory(sqlite).load()
+    assert len(history) == 5
+    assert history.cursor == 5
+
+    _add_matches(sqlite, 2, datetime.datetime(2023, 2, 1))
+    assert len(ColumnarHistory(sqlite).load()) == 7
+    sqlite.close()
+
+
+def test_load_after_the_database_was_replaced(tmp_path):
+    sqlite = SqliteStorage(tmp_path)
+    sqlite.create()
+    _add_matches(sqlite, 4)
+    assert len(ColumnarHistory(sqlite).load()) == 4
+    sqlite.close()
+
+    (tmp_path / "data.sqlite3").unlink()
+    sqlite = SqliteStorage(tmp_path)
+    sqlite.create()
+    _add_matches(sqlite, 2)
+    # The cached cursor is past the last row of the new database
+    assert len(ColumnarHistory(sqlite).load()) == 2
+    sqlite.close()
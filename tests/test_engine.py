@@ -0,0 +1,146 @@
+import asyncio
+import time
+from src.monitor.engine import MonitorEngine
+from src.monitor.fake_server import FakeSLPServer
+from src.monitor.metrics import Metrics
+
+QUERY_TIME = 0.5
+QUERY_TIMEOUT = 0.4
+DURATION = 2.2
+
+
+def _run_engine(tmp_path, configure):
+    """
+    Monitor 8 fake servers that answer right away, one slow one, one that never answers and one that refuses
+    connections, for DURATION seconds.
+    :param configure: Called with the engine and the servers by name once they are started
+    :return: (engine, metrics, dict of name -> FakeSLPServer)
+    """
+    metrics = Metrics()
+
+    async def run():
+        servers = {f"Fast {i}": FakeSLPServer(f"Map {i}") for i in range(8)}
+        servers["Slow"] = FakeSLPServer("Slow Map")
+        servers["Slow"].delay = 0.2
+        servers["Hung"] = FakeSLPServer("Hung Map")
+        servers["Hung"].hang = True
+        servers["Closed"] = FakeSLPServer("Closed Map")
+        for server in servers.values():
+            await server.start()
+        # Nothing listens on its port anymore
+        await servers["Closed"].close()
+
+        engine = MonitorEngine(
+            query_timeout=QUERY_TIMEOUT, save_directory=tmp_path, metrics=metrics
+        )
+        for name, server in servers.items():
+            engine.add_server(
+                name, "127.0.0.1", port=server.port, query_time=QUERY_TIME
+            )
+        configure(engine, servers)
+        asyncio.get_running_loop().call_later(DURATION, engine.stop)
+        await engine.run()
+        for server in servers.values():
+            await server.close()
+        return engine, servers
+
+    engine, servers = asyncio.run(run())
+    return engine, metrics, servers
+
+
+def _failures(metrics, name, reason):
+    return metrics.get_counter(
+        "query_failures_total", {"server": name, "reason": reason}
+    )
+
+
+def test_failing_servers_only_delay_themselves(tmp_path):
+    engine, metrics, servers = _run_engine(tmp_path, lambda *_: None)
+
+    # A query at the start, then one every QUERY_TIME seconds, whatever the other servers do
+    expected = int(DURATION / QUERY_TIME)
+    for name, server in servers.items():
+        queries = metrics.get_counter("queries_total", {"server": name})
+        assert queries >= expected, name
+        if name.startswith("Fast") or name == "Slow":
+            # Less one query, if the engine stopped before it reached the server
+            assert server.requests >= queries - 1, name
+            for reason in ("timeout", "error", "parse"):
+                assert _failures(metrics, name, reason) == 0, name
+
+    assert _failures(metrics, "Hung", "timeout") >= expected
+    assert _failures(metrics, "Hung", "error") == 0
+    assert _failures(metrics, "Closed", "error") >= expected
+    assert _failures(metrics, "Closed", "timeout") == 0
+
+    assert metrics.get_histogram("query_seconds", {"server": "Slow"}).max >= 0.2
+    # Waiting on the slow and hung servers never held up the other jobs
+    for name in servers:
+        lateness = metrics.get_histogram(
+            "job_lateness_seconds", {"job": f"{name} query"}
+        )
+        assert lateness.max < 0.25, name
+
+
+def test_map_changes_are_detected_and_saved(tmp_path):
+    def change_map(_engine, servers):
+        loop = asyncio.get_running_loop()
+        loop.call_later(
+            1.2, lambda: setattr(servers["Fast 0"], "map_name", "Airship Battle")
+        )
+
+    engine, metrics, _ = _run_engine(tmp_path, change_map)
+
+    # The first map seen (after SYS_INIT) isn't counted, its detection latency is unknown
+    assert metrics.get_counter("map_changes_total", {"server": "Fast 0"}) == 1
+    assert metrics.get_counter("map_changes_total", {"server": "Fast 1"}) == 0
+    latency = metrics.get_histogram("detection_latency_seconds", {"server": "Fast 0"})
+    assert latency.max < QUERY_TIME + 0.1
+    fast = next(server for server in engine.get_servers() if server.name == "Fast 0")
+    history = list(fast.writer.get_storage().query_map_history("Map 0"))
+    assert len(history) == 1
+    assert 0 <= history[0].playtime <= 2
+
+
+def test_one_process_monitors_many_servers(tmp_path):
+    server_count = 60
+    metrics = Metrics()
+
+    async def run():
+        servers = {
+            f"Server {i}": FakeSLPServer(f"Map {i}") for i in range(server_count)
+        }
+        for server in servers.values():
+            await server.start()
+        engine = MonitorEngine(
+            query_timeout=QUERY_TIMEOUT, save_directory=tmp_path, metrics=metrics
+        )
+        for name, server in servers.items():
+            engine.add_server(
+                name, "127.0.0.1", port=server.port, query_time=QUERY_TIME
+            )
+        asyncio.get_running_loop().call_later(DURATION, engine.stop)
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        await engine.run()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        for server in servers.values():
+            await server.close()
+        return servers, cpu, wall
+
+    servers, cpu, wall = asyncio.run(run())
+
+    expected = int(DURATION / QUERY_TIME)
+    for name, server in servers.items():
+        queries = metrics.get_counter("queries_total", {"server": name})
+        assert queries >= expected, name
+        assert server.requests >= queries - 1, name
+        for reason in ("timeout", "error", "parse"):
+            assert _failures(metrics, name, reason) == 0, name
+        lateness = metrics.get_histogram(
+            "job_lateness_seconds", {"job": f"{name} query"}
+        )
+        assert lateness.max < 0.25, name
+    # The monitor, and the fake servers answering it, never needed all of one core
+    assert cpu < wall
@@ -0,0 +1,67 @@
+import asyncio
+import types
+from src.monitor import events
+from src.monitor.events import EventServer
+
+REQUEST = b"GET /Server/events/ HTTP/1.1\r\nHost: localhost\r\n\r\n"
+
+
+async def _subscribe(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(REQUEST)
+    status = await reader.readline()
+    return reader, writer, status
+
+
+def test_rejects_subscribers_over_the_limit():
+    async def run():
+        server = EventServer(port=0, max_subscribers=2)
+        server.add_server("Server")
+        await server.start()
+        port = server.get_port()
+        first = await _subscribe(port)
+        second = await _subscribe(port)
+        assert first[2] == second[2] == b"HTTP/1.1 200 OK\r\n"
+        third = await _subscribe(port)
+        assert third[2] == b"HTTP/1.1 503 Service Unavailable\r\n"
+        assert server.get_stats()["rejected"] == 1
+
+        # A subscriber leaving makes room for another
+        first[1].close()
+        await first[1].wait_closed()
+        for _ in range(100):
+            if server.get_stats()["subscribers"] < 2:
+                break
+            await asyncio.sleep(0.01)
+        fourth = await _subscribe(port)
+        assert fourth[2] == b"HTTP/1.1 200 OK\r\n"
+
+        server.publish("Server", "game_time", {"game_time": 5})
+        await second[0].readuntil(b"retry: 5000\n\n")
+        assert await second[0].readuntil(b"\n\n") == (
+            b'id: 1\nevent: game_time\ndata: {"game_time": 5}\n\n'
+        )
+        for _, writer, _ in (second, third, fourth):
+            writer.close()
+        await server.close()
+
+    asyncio.run(run())
+
+
+def test_max_subscribers_follow_the_file_descriptor_limit(monkeypatch):
+    limits = {}
+
+    def setrlimit(_, limit):
+        limits["set"] = limit
+
+    fake = types.SimpleNamespace(
+        RLIMIT_NOFILE=7,
+        RLIM_INFINITY=-1,
+        getrlimit=lambda _: (1024, 4096),
+        setrlimit=setrlimit,
+    )
+    monkeypatch.setattr(events, "resource", fake)
+    # The soft limit is raised as far as the hard limit allows
+    assert events.get_max_subscribers(10000) == 4096 - events.RESERVED_FILE_DESCRIPTORS
+    assert limits["set"] == (4096, 4096)
+    assert events.get_max_subscribers(500) == 500
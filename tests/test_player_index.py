@@ -0,0 +1,50 @@
+import datetime
+from src.monitor.player_index import PlayerIndex, PlayerIndexReader, PlayerSummary
+from src.monitor.storage import Session
+
+START = datetime.datetime(2023, 5, 1, 20)
+
+
+def _session(name, start_minutes, end_minutes):
+    return Session(
+        name,
+        START + datetime.timedelta(minutes=start_minutes),
+        START + datetime.timedelta(minutes=end_minutes),
+    )
+
+
+def test_lookup_finds_every_spelling_of_a_name(tmp_path):
+    index = PlayerIndex(tmp_path)
+    sessions = [
+        _session("alice", 0, 10),
+        _session("Bob", 0, 20),
+        _session("alice", 30, 40),
+        # Alice changes the case of her name
+        _session("Alice", 50, 80),
+        _session("Bob", 60, 90),
+        _session("ALICE", 100, 101),
+    ]
+    for session in sessions:
+        index.add_session(session)
+
+    reader = PlayerIndexReader(tmp_path)
+    summary, recent = reader.lookup("aLiCe")
+    assert summary == PlayerSummary(
+        "ALICE",
+        4,
+        (10 + 10 + 30 + 1) * 60,
+        START,
+        START + datetime.timedelta(minutes=101),
+    )
+    assert recent == [sessions[5], sessions[3], sessions[2], sessions[0]]
+    assert reader.lookup("alice", recent=2)[1] == [sessions[5], sessions[3]]
+    assert reader.lookup("bob")[0].sessions == 2
+    assert reader.lookup("Carol") is None
+
+    # Spellings added after the reader was opened are found too
+    index.add_session(_session("aLICE", 110, 120))
+    summary, recent = reader.lookup("alice", recent=1)
+    assert summary.name == "aLICE" and summary.sessions == 5
+    assert recent == [_session("aLICE", 110, 120)]
+    reader.close()
+    index.close()
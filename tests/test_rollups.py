@@ -0,0 +1,63 @@
+import datetime
+from src.monitor.rollups import (
+    RESOLUTIONS,
+    PlayerRollups,
+    read_rollup,
+    rebuild_rollups,
+)
+from src.monitor.storage import FlatFileStorage, PlayerSample
+
+QUERY_TIME = 10
+
+
+def _playercount(i):
+    # Stable for long stretches, like most of a real server's samples, with a few quick changes
+    if i % 700 < 3:
+        return 20 + i % 700
+    return 10 + (i // 700) % 4
+
+
+def test_rebuilt_rollups_match_live_ones(tmp_path):
+    storage = FlatFileStorage(tmp_path / "server")
+    storage.create()
+    live = PlayerRollups(tmp_path / "live")
+    # Two days, across a segment change and many keyframes
+    start = datetime.datetime(2023, 3, 1, 21, 0, 5)
+    for i in range(2 * 86400 // QUERY_TIME):
+        time = start + datetime.timedelta(seconds=QUERY_TIME * i)
+        storage.append_player_sample(PlayerSample(time, _playercount(i), []))
+        live.add_sample(time, _playercount(i))
+    storage.flush()
+    live.flush()
+
+    rebuilt = rebuild_rollups(
+        storage, QUERY_TIME, end=time + datetime.timedelta(seconds=QUERY_TIME)
+    )
+    end = time + datetime.timedelta(days=1)
+    for resolution in RESOLUTIONS:
+        expected = read_rollup(tmp_path / "live", resolution, start, end)
+        assert read_rollup(storage.directory, resolution, start, end) == expected
+    rebuilt.close()
+    live.close()
+    storage.close()
+
+
+def test_rebuild_stops_carrying_after_the_keyframe_interval(tmp_path):
+    storage = FlatFileStorage(tmp_path)
+    storage.create()
+    start = datetime.datetime(2023, 3, 1, 12)
+    storage.append_player_sample(PlayerSample(start, 5, []))
+    # The monitor was stopped for a day
+    storage.append_player_sample(
+        PlayerSample(start + datetime.timedelta(days=1), 7, [])
+    )
+    storage.flush()
+
+    rollups = rebuild_rollups(
+        storage, 30, end=start + datetime.timedelta(days=1, seconds=30)
+    )
+    hours = read_rollup(tmp_path, "hour", start, start + datetime.timedelta(days=2))
+    # One hour of queries after the first sample, then only the one of the second
+    assert [bucket[1:] for bucket in hours] == [(5, 5, 5 * 120, 120), (7, 7, 7, 1)]
+    rollups.close()
+    storage.close()
@@ -0,0 +1,26 @@
+import datetime
+from src.monitor.storage import FlatFileStorage, MapHistoryEntry
+
+LINE = "Airship Battle | 2023-01-01 10:00:00 | 1800 | 10 | 2\n"
+
+
+def test_legacy_history_is_imported_and_kept(tmp_path):
+    directory = tmp_path / "server"
+    directory.mkdir()
+    (directory / "map_history").write_text(LINE)
+
+    storage = FlatFileStorage(directory)
+    storage.create()
+    assert not (directory / "map_history").exists()
+    assert (directory / "map_history.legacy").read_text() == LINE
+    storage.append_match(
+        MapHistoryEntry("Map 1", datetime.datetime(2023, 1, 2, 10), 600, 5, 1)
+    )
+
+    # Starting again doesn't import the kept file twice
+    storage = FlatFileStorage(directory)
+    storage.create()
+    assert [entry.name for entry in storage.query_map_history()] == [
+        "Airship Battle",
+        "Map 1",
+    ]
@@ -0,0 +1,72 @@
+import datetime
+import types
+from src.monitor.monitor import DataWriter, TimedData
+from src.monitor.storage import Session
+
+START = datetime.datetime(2023, 5, 1, 20)
+
+
+class ManualClock:
+    def __init__(self):
+        self.time = START
+
+    def monotonic(self):
+        return (self.time - START).total_seconds()
+
+    def now(self):
+        return self.time
+
+
+def _write(writer, clock, minutes, players):
+    clock.time = START + datetime.timedelta(minutes=minutes)
+    writer.write_timeds(
+        TimedData(
+            [types.SimpleNamespace(name=name) for name in players],
+            True,
+            len(players),
+            0,
+        )
+    )
+
+
+def _at(minutes):
+    return START + datetime.timedelta(minutes=minutes)
+
+
+def test_sessions_are_looked_up_from_the_saved_ones(tmp_path):
+    clock = ManualClock()
+    writer = DataWriter(
+        "Server", save_directory=tmp_path, clock=clock, live_state=False
+    )
+    _write(writer, clock, 0, ["Alice", "Bob"])
+    _write(writer, clock, 10, ["Alice"])
+    _write(writer, clock, 20, ["Alice", "Bob"])
+    _write(writer, clock, 30, [])
+    _write(writer, clock, 40, ["Bob"])
+    assert writer.get_sessions("Bob") == [
+        Session("Bob", _at(0), _at(10)),
+        Session("Bob", _at(20), _at(30)),
+        Session("Bob", _at(40), None),
+    ]
+    writer.close()
+    assert writer.get_storage().count_sessions() == 4
+
+    # A restarted writer only keeps the ongoing sessions in memory
+    writer = DataWriter(
+        "Server", save_directory=tmp_path, clock=clock, live_state=False
+    )
+    _write(writer, clock, 50, ["Alice"])
+    assert writer.get_sessions("Bob") == [
+        Session("Bob", _at(0), _at(10)),
+        Session("Bob", _at(20), _at(30)),
+        Session("Bob", _at(40), _at(40)),
+    ]
+    assert writer.get_sessions("Bob", start=_at(10), end=_at(40)) == [
+        Session("Bob", _at(20), _at(30))
+    ]
+    assert writer.get_sessions("Alice", start=_at(25)) == [
+        Session("Alice", _at(0), _at(30)),
+        Session("Alice", _at(50), None),
+    ]
+    assert writer.get_sessions("Carol") == []
+    writer.close()